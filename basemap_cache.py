@@ -0,0 +1,207 @@
+import os
+from functools import lru_cache
+import numpy as np
+import geopandas as gpd
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import build_cache
+
+water_color = '#4a79a5'
+
+# Static layers of the maps: name -> (shapefile, CRS of the file, fill color)
+BASEMAP_LAYERS = {
+    'europecoastline': (os.path.join('basisdaten', 'europecoastline.shp'), 25832, '#e9e6be'),  # light background europe
+    'secondbackground': (os.path.join('basisdaten', 'secondbackground.shp'), 25832, water_color),  # water
+    'germanyshape': (os.path.join('basisdaten', 'germanyshape.shp'), 25832, '#dcd798'),  # darker background for germany shape
+    'lakes': (os.path.join('basisdaten', 'lakes.shp'), 4326, water_color),  # lakes, drawn above the data
+}
+
+# Layers below the data, in drawing order. The lakes are drawn above the data as an overlay.
+BACKGROUND_LAYERS = ['europecoastline', 'secondbackground', 'germanyshape']
+
+# Size of the rendered frames in inches (at the default 100 dpi this is 3840x2160 pixels)
+frame_figsize = (38.4, 21.6)
+frame_dpi = 100
+
+# zorders matching the vector drawing: polygons are drawn at 1 (background, data, lakes in this
+# order) and the track lines at 2, so the lakes end up above the data but below the lines
+background_zorder = 0
+lakes_zorder = 1.5
+
+
+@lru_cache(maxsize=None)
+def load_layer(name, base_dir='.'):
+    """Return a basemap layer reprojected to EPSG:3857. Read once per process and cached in /cache."""
+    path, epsg, _ = BASEMAP_LAYERS[name]
+    shapefile_path = os.path.join(base_dir, path)
+    key = {'source': os.path.abspath(shapefile_path), 'signature': build_cache.shapefile_signature(shapefile_path), 'epsg': epsg}
+    cache_path = os.path.join(base_dir, build_cache.cache_dir, f'basemap_{name}_3857.pickle')
+    gdf = build_cache.load_cached(cache_path, key)
+    if gdf is None:
+        gdf = gpd.read_file(shapefile_path)
+        gdf.set_crs(epsg=epsg, inplace=True, allow_override=True)
+        gdf = gdf.to_crs(epsg=3857)
+        build_cache.save_cached(cache_path, key, gdf)
+    return gdf
+
+
+def plot_layer(ax, name, base_dir='.', **kwargs):
+    """Plot a basemap layer with its fill color."""
+    color = BASEMAP_LAYERS[name][2]
+    load_layer(name, base_dir).plot(ax=ax, color=color, edgecolor='none', **kwargs)
+
+
+def map_bounds(country_gdf, zoom_out_factor=1.2):
+    """Return the x and y limits of the map: the bounds of country_gdf, zoomed out a little."""
+    bounds = country_gdf.total_bounds
+    x_center = (bounds[0] + bounds[2]) / 2
+    y_center = (bounds[1] + bounds[3]) / 2
+    x_range = (bounds[2] - bounds[0]) * zoom_out_factor / 2
+    y_range = (bounds[3] - bounds[1]) * zoom_out_factor / 2
+    return (x_center - x_range, x_center + x_range), (y_center - y_range, y_center + y_range)
+
+
+@lru_cache(maxsize=None)
+def frame_limits(figsize=frame_figsize, base_dir='.'):
+    """
+    Return the final x and y limits of a map frame.
+
+    The frames set the limits from the germany shape and then force an equal aspect by adjusting
+    the data limits. Which axis gets expanded depends on the extent of the plotted data, which is
+    dominated by the basemap layers, so this replays it on an axes filling the figure that holds
+    the extent of all basemap layers.
+    """
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    for name in BASEMAP_LAYERS:
+        minx, miny, maxx, maxy = load_layer(name, base_dir).total_bounds
+        ax.update_datalim([(minx, miny), (maxx, maxy)])
+    xlim, ylim = map_bounds(load_layer('germanyshape', base_dir))
+    ax.set_xlim(*xlim)
+    ax.set_ylim(*ylim)
+    ax.set_aspect('equal', adjustable='datalim')
+    ax.apply_aspect()
+    return tuple(ax.get_xlim()), tuple(ax.get_ylim())
+
+
+def _rasterize_layers(names, limits, figsize, dpi, facecolor, base_dir):
+    """Draw the given layers on an axes covering the whole figure and return the RGBA pixels."""
+    fig = Figure(figsize=figsize, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    fig.patch.set_facecolor(facecolor)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_facecolor(facecolor)
+    ax.set_axis_off()
+    for name in names:
+        plot_layer(ax, name, base_dir)
+    ax.set_xlim(*limits[0])
+    ax.set_ylim(*limits[1])
+    ax.set_aspect('auto')
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba()).copy()
+
+
+def _pixel_extent(extent, shape, rows, columns):
+    """Return the data extent of the pixel block rows[0]:rows[1], columns[0]:columns[1] of a raster covering extent."""
+    xmin, xmax, ymin, ymax = extent
+    x_step = (xmax - xmin) / shape[1]
+    y_step = (ymax - ymin) / shape[0]
+    # Row 0 is the top of the image
+    return (xmin + columns[0] * x_step, xmin + columns[1] * x_step, ymax - rows[1] * y_step, ymax - rows[0] * y_step)
+
+
+@lru_cache(maxsize=None)
+def basemap_rasters(figsize=frame_figsize, dpi=frame_dpi, base_dir='.'):
+    """
+    Return (background, extent, lakes overlay, lakes extent) for frames of the given size.
+
+    The background holds the static layers below the data on the water color, the lakes overlay
+    is transparent except for the lakes and cropped to the area they cover. Both are rendered at
+    the pixel size of the frame and cached in /cache until a basemap shapefile or the frame
+    geometry changes.
+    """
+    limits = frame_limits(figsize, base_dir)
+    extent = (limits[0][0], limits[0][1], limits[1][0], limits[1][1])
+    key = {
+        'signatures': {name: build_cache.shapefile_signature(os.path.join(base_dir, path)) for name, (path, _, _) in BASEMAP_LAYERS.items()},
+        'limits': limits,
+        'figsize': list(figsize),
+        'dpi': dpi,
+    }
+    cache_path = os.path.join(base_dir, build_cache.cache_dir, f'basemap_raster_{int(figsize[0] * dpi)}x{int(figsize[1] * dpi)}.pickle')
+    rasters = build_cache.load_cached(cache_path, key)
+    if rasters is None:
+        print("Rendering basemap rasters...")
+        background = _rasterize_layers(BACKGROUND_LAYERS, limits, figsize, dpi, water_color, base_dir)
+        lakes = _rasterize_layers(['lakes'], limits, figsize, dpi, 'none', base_dir)
+        # Only keep the part of the overlay that has lakes in it, compositing the transparent rest is wasted time
+        rows, columns = np.nonzero(lakes[:, :, 3])
+        if len(rows):
+            box = ((rows.min(), rows.max() + 1), (columns.min(), columns.max() + 1))
+        else:
+            box = ((0, 1), (0, 1))
+        lakes_extent = _pixel_extent(extent, lakes.shape, *box)
+        lakes = lakes[box[0][0]:box[0][1], box[1][0]:box[1][1]].copy()
+        rasters = {'background': background, 'lakes': lakes, 'lakes_extent': lakes_extent}
+        build_cache.save_cached(cache_path, key, rasters)
+    return rasters['background'], extent, rasters['lakes'], rasters['lakes_extent']
+
+
+def draw_background(ax, base_dir='.'):
+    """Draw the pre-rendered static background into a frame axes."""
+    fig = ax.get_figure()
+    background, extent, _, _ = basemap_rasters(tuple(fig.get_size_inches()), fig.dpi, base_dir)
+    ax.imshow(background, extent=extent, interpolation='nearest', zorder=background_zorder)
+
+
+def set_frame_limits(ax, base_dir='.'):
+    """Set the limits the rasters were rendered for. They already have the equal aspect, so it does not change them again."""
+    xlim, ylim = frame_limits(tuple(ax.get_figure().get_size_inches()), base_dir)
+    ax.set_xlim(*xlim)
+    ax.set_ylim(*ylim)
+
+
+class FrameCanvas(FigureCanvasAgg):
+    """Agg canvas that only draws when the frame is saved."""
+
+    def draw_idle(self, *args, **kwargs):
+        # geopandas requests a redraw after every plot call, which would draw the whole frame
+        # with all its static layers again for every track layer added to it
+        pass
+
+
+def frame_figure(base_dir='.', cached=True):
+    """
+    Return (fig, ax, bbox_inches) of a new map figure with the static layers, to be reused for
+    many frames: the background below and the lakes above the data (rasters if cached, else the
+    shapefiles), limits and aspect set, and the bounding box to save the frames with.
+    """
+    fig = Figure(figsize=frame_figsize)
+    FrameCanvas(fig)
+    ax = fig.add_subplot()
+    fig.patch.set_facecolor(water_color)
+    ax.set_facecolor(water_color)
+    if cached:
+        draw_background(ax, base_dir)
+        draw_lakes(ax, base_dir)
+    else:
+        for layer_name in BACKGROUND_LAYERS:
+            plot_layer(ax, layer_name, base_dir)
+        # Added before the data, so the zorder has to put the lakes above it
+        plot_layer(ax, 'lakes', base_dir, zorder=lakes_zorder)
+    ax.set_axis_off()
+    fig.subplots_adjust(left=0, right=1, top=1, bottom=0)
+    set_frame_limits(ax, base_dir)
+    ax.set_aspect('equal', adjustable='datalim')
+    # The axes are off and everything is clipped to them, so the tight bounding box is the
+    # same for every frame. Saving with it directly saves the extra draw that measures it.
+    bbox_inches = fig.get_tightbbox(fig.canvas.get_renderer()).padded(0.1)
+    return fig, ax, bbox_inches
+
+
+def draw_lakes(ax, base_dir='.'):
+    """Draw the pre-rendered lakes overlay into a frame axes."""
+    fig = ax.get_figure()
+    _, _, lakes, lakes_extent = basemap_rasters(tuple(fig.get_size_inches()), fig.dpi, base_dir)
+    ax.imshow(lakes, extent=lakes_extent, interpolation='nearest', zorder=lakes_zorder)
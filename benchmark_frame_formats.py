@@ -0,0 +1,67 @@
+import os
+import sys
+import time
+import shutil
+import subprocess
+import tempfile
+from PIL import Image
+import frame_formats
+
+# Frame the formats are compared on (default: the first frame in /visualizations_geopandas)
+base_dir = '.'
+visualizations_dir = os.path.join(base_dir, 'visualizations_geopandas')
+
+# How often every format is written and read, the times are averaged
+repeats = 3
+
+
+def first_frame(directory):
+    """Return the path of the first rendered frame in a directory, in any frame format."""
+    extensions = tuple(extension for extension, _ in frame_formats.FRAME_FORMATS.values())
+    frames = sorted(f for f in os.listdir(directory) if f.endswith(extensions)) if os.path.exists(directory) else []
+    if not frames:
+        return None
+    return os.path.join(directory, frames[0])
+
+
+def time_ffmpeg_decode(path):
+    """Seconds ffmpeg needs to decode the frame, or None if ffmpeg is not installed."""
+    if shutil.which('ffmpeg') is None:
+        return None
+    start = time.perf_counter()
+    subprocess.run(['ffmpeg', '-v', 'error', '-i', path, '-f', 'null', '-'], check=True)
+    return time.perf_counter() - start
+
+
+def benchmark(image_path):
+    """Write and read the frame in every format and print the times and file sizes."""
+    with Image.open(image_path) as img:
+        img.load()
+        print(f"Frame {image_path}: {img.width}x{img.height} {img.mode}, {repeats} runs per format\n")
+        print(f"{'format':<10} {'write s':>8} {'PIL read s':>11} {'ffmpeg read s':>14} {'size MB':>8}")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in frame_formats.FRAME_FORMATS:
+                path = os.path.join(tmp_dir, 'frame' + frame_formats.frame_extension(name))
+
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    frame_formats.save_frame(img, path, name)
+                write_time = (time.perf_counter() - start) / repeats
+
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    with Image.open(path) as frame:
+                        frame.load()
+                read_time = (time.perf_counter() - start) / repeats
+
+                ffmpeg_time = time_ffmpeg_decode(path)
+                ffmpeg_text = f"{ffmpeg_time:.3f}" if ffmpeg_time is not None else 'n/a'
+                print(f"{name:<10} {write_time:>8.3f} {read_time:>11.3f} {ffmpeg_text:>14} {os.path.getsize(path) / 1e6:>8.2f}")
+
+
+if __name__ == '__main__':
+    image_path = sys.argv[1] if len(sys.argv) > 1 else first_frame(visualizations_dir)
+    if image_path is None:
+        print(f"No frame found in {visualizations_dir}. Pass the path of an image.")
+        sys.exit(1)
+    benchmark(image_path)
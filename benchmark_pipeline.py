@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import glob
+import shutil
+import subprocess
+import frame_formats
+import instrumentation
+import synthetic_data
+
+# Numbers of days of synthetic data the whole pipeline is run on, one after another
+scales = [7, 28]
+
+# Seconds between two logged points of the synthetic data (see synthetic_data.py)
+log_interval = 30
+
+# Every scale runs in <benchmark_dir>/work, which is emptied before each scale except for the region
+# and basemap caches, so only the first run pays for building them (they are keyed to the path of
+# the region files, which is the same for all scales and runs)
+benchmark_dir = os.path.join('.', 'benchmark')
+
+# Results of every benchmark run (<run>.json), each run is compared with the one before
+results_dir = 'benchmark_results'
+
+# A stage that is this much slower (in points or frames per second) than in the run before is reported as a regression
+regression_threshold = 0.2
+
+# Stages that took less than this many seconds are too short to compare, they are not reported as regressions
+regression_min_wall = 1.0
+
+# Changes to the config of run_all_scripts.py for the benchmark runs, e.g. {'visualize_points_with_counts': {'onlygermany': True}}
+config_overrides = {}
+
+# Number of CPUs the stages may use (see run_all_scripts.py), None for the default
+cpu_budget = None
+
+# Folders of the project the work folder needs (linked, or copied where links are not possible)
+SHARED_DIRS = ['basisdaten', 'static']
+
+# The stages measured in frames per second, all others in points of the dataset per second
+FRAME_STAGES = ['visualize_points_geopandas', 'create_cropped_images', 'create_video_from_images']
+
+
+def link_or_copy(source, target):
+    try:
+        os.symlink(os.path.abspath(source), target, target_is_directory=True)
+    except OSError:
+        shutil.copytree(source, target)
+
+
+def prepare_work_dir(work_dir):
+    """Empty the work folder but for the cached region layers and basemaps, and add the scripts and shared folders."""
+    os.makedirs(os.path.join(work_dir, 'cache'), exist_ok=True)
+    for entry in os.listdir(work_dir):
+        path = os.path.join(work_dir, entry)
+        if entry == 'cache':
+            continue
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    cache_dir = os.path.join(work_dir, 'cache')
+    for entry in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, entry)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif not entry.endswith('.pickle'):
+            os.remove(path)
+    for script in glob.glob('*.py'):
+        shutil.copy2(script, work_dir)
+    for directory in SHARED_DIRS:
+        if os.path.exists(directory):
+            link_or_copy(directory, os.path.join(work_dir, directory))
+
+
+def run_pipeline():
+    """Run run_all_scripts.py in this folder with the config of benchmark_config.json (written by run_scale)."""
+    import run_all_scripts
+    with open('benchmark_config.json', 'r') as f:
+        benchmark_config = json.load(f)
+    for stage, settings in benchmark_config['config'].items():
+        run_all_scripts.config.setdefault(stage, {}).update(settings)
+    if benchmark_config['cpu_budget'] is not None:
+        run_all_scripts.cpu_budget = benchmark_config['cpu_budget']
+    run_all_scripts.main()
+
+
+def run_scale(days, run):
+    """Generate days of data, run the whole pipeline on them and return the throughput of every stage."""
+    work_dir = os.path.join(benchmark_dir, 'work')
+    prepare_work_dir(work_dir)
+    data = synthetic_data.generate(work_dir, days)
+
+    config = {stage: dict(settings) for stage, settings in config_overrides.items()}
+    first_day = sorted(os.listdir(os.path.join(work_dir, 'gps')))[0][:8]
+    for stage in ('cumulative_points', 'visualize_points_geopandas'):
+        config.setdefault(stage, {})['start_date'] = first_day
+    with open(os.path.join(work_dir, 'benchmark_config.json'), 'w') as f:
+        json.dump({'config': config, 'cpu_budget': cpu_budget}, f)
+
+    subprocess.run([sys.executable, 'benchmark_pipeline.py', '--pipeline'], cwd=work_dir, check=True)
+
+    # The run report of the pipeline (see instrumentation.py), kept with the results
+    report_path = sorted(glob.glob(os.path.join(work_dir, 'reports', 'run_*_*.json')))[-1]
+    with open(report_path, 'r') as f:
+        report = json.load(f)
+    os.makedirs(results_dir, exist_ok=True)
+    shutil.copy2(report_path, os.path.join(results_dir, f'{run}_days_{days}_report.json'))
+    frames_dir = os.path.join(work_dir, 'visualizations_geopandas')
+    frames = len([f for f in os.listdir(frames_dir) if frame_formats.is_frame(f)]) if os.path.exists(frames_dir) else 0
+
+    stages = {}
+    for record in report['stages']:
+        unit, count = ('frames', frames) if record['stage'] in FRAME_STAGES else ('points', data['points'])
+        stages[record['stage']] = {
+            'wall': record['wall'], 'cpu': record['cpu'], 'peak_rss_mb': record['peak_rss_mb'],
+            'unit': unit, 'rate': count / record['wall'] if record['wall'] > 0 else None,
+        }
+    return {'days': days, 'points': data['points'], 'frames': frames, 'wall': report['wall'], 'stages': stages}
+
+
+def previous_results(run):
+    """The results of the benchmark run before this one, None if there is none."""
+    paths = sorted(path for path in glob.glob(os.path.join(results_dir, 'run_*_*.json')) if not path.endswith('_report.json') and os.path.basename(path) < f'{run}.json')
+    if not paths:
+        return None
+    with open(paths[-1], 'r') as f:
+        return json.load(f)
+
+
+def compare(results, previous):
+    """Print the throughput of every stage and scale with the change to the previous run. Returns the regressions."""
+    regressions = []
+    for days, scale in results['scales'].items():
+        print(f"\n{days} days: {scale['points']} points, {scale['frames']} frames, {scale['wall']:.1f} s")
+        print(f"{'stage':42} {'wall s':>8} {'cpu s':>8} {'rate':>20} {'change':>8}")
+        old_scale = previous['scales'].get(days) if previous else None
+        for stage, values in scale['stages'].items():
+            rate = f"{values['rate']:.1f} {values['unit']}/s" if values['rate'] is not None else '-'
+            change = ''
+            old = old_scale['stages'].get(stage) if old_scale else None
+            if old and old['rate'] and values['rate'] is not None:
+                ratio = values['rate'] / old['rate'] - 1
+                change = f'{ratio:+.0%}'
+                if ratio < -regression_threshold and values['wall'] >= regression_min_wall:
+                    change += ' !'
+                    regressions.append(f'{stage} ({days} days): {ratio:+.0%}')
+            print(f"{stage:42} {values['wall']:8.1f} {values['cpu']:8.1f} {rate:>20} {change:>8}")
+    return regressions
+
+
+def main():
+    run = instrumentation.run_id()
+    synthetic_data.log_interval = log_interval
+    results = {'run': run, 'log_interval': log_interval, 'scales': {}}
+    for days in scales:
+        print(f"\nBenchmarking {days} days of synthetic data...")
+        results['scales'][str(days)] = run_scale(days, run)
+
+    os.makedirs(results_dir, exist_ok=True)
+    previous = previous_results(run)
+    if previous is not None and previous.get('log_interval') != log_interval:
+        print(f"The previous run {previous['run']} used another log_interval, not comparing.")
+        previous = None
+    with open(os.path.join(results_dir, f'{run}.json'), 'w') as f:
+        json.dump(results, f, indent=1)
+
+    regressions = compare(results, previous)
+    print(f"\nResults written to {os.path.join(results_dir, run + '.json')}" + (f", compared with {previous['run']}" if previous else ''))
+    if regressions:
+        print(f"Slower by more than {regression_threshold:.0%} than the run before:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+
+# The stages start their worker processes with spawn, which imports this file again in every worker
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--pipeline']:
+        run_pipeline()
+    else:
+        main()
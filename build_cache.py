@@ -0,0 +1,85 @@
+import os
+import json
+import pickle
+import tempfile
+from contextlib import contextmanager
+
+# Directory for derived data that can always be rebuilt from the source files (safe to delete)
+cache_dir = 'cache'
+
+
+def file_signature(path):
+    """Return a cheap signature (size and modification time) for a file, or None if it is missing."""
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def shapefile_signature(shapefile_path):
+    """Return the signature of a shapefile including its sidecar files (.dbf, .shx, .prj)."""
+    stem = os.path.splitext(shapefile_path)[0]
+    return [file_signature(stem + ext) for ext in ('.shp', '.dbf', '.shx', '.prj')]
+
+
+def load_cached(cache_path, key):
+    """Load a pickled cache entry. Returns None if it is missing, unreadable or was built for another key."""
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, 'rb') as f:
+            entry = pickle.load(f)
+    except Exception as e:
+        print(f"Warning: Could not read cache {cache_path}: {e}")
+        return None
+    if entry.get('key') != key:
+        return None
+    return entry.get('value')
+
+
+def save_cached(cache_path, key, value):
+    """
+    Pickle a cache entry together with its key. Written to a temporary file of its own first, so
+    readers never see half a file and stages building the same entry at the same time (see
+    stage_scheduler.py) do not move each other's file away. The last one to finish wins.
+    """
+    with atomic_file(cache_path, 'wb') as f:
+        pickle.dump({'key': key, 'value': value}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+@contextmanager
+def atomic_file(path, mode):
+    """Write a new temporary file next to path, which replaces path if the block ends without an error."""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def files_manifest(paths):
+    """Return a manifest {file name: signature} describing the current version of a set of input files."""
+    return {os.path.basename(path): file_signature(path) for path in sorted(paths)}
+
+
+def load_manifest(manifest_path):
+    """Load a JSON manifest written by save_manifest, or an empty dict if there is none."""
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not read manifest {manifest_path}: {e}")
+        return {}
+
+
+def save_manifest(manifest_path, manifest):
+    """Write a JSON manifest atomically."""
+    with atomic_file(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
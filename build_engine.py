@@ -0,0 +1,266 @@
+import os
+import glob
+import json
+import time
+import hashlib
+from datetime import datetime, timedelta
+import build_cache
+
+# Inputs and outputs of one unit (a day or a year) of every stage, relative to the base directory.
+# {day} is the day of the unit (YYYYMMDD), {previous_day} the day before, {year} the year and
+# {frame_extension} the extension of the frame format. Inputs may be glob patterns. Inputs that
+# depend on the configuration (e.g. the days of the trail) are added by the stage itself.
+STAGES = {
+    'calculate_speed_and_filter': {
+        'inputs': ['csv/{day}.csv'],
+        'outputs': ['all/{day}_all.geojson', 'slow/{day}_slow.geojson', 'fast/{day}_fast.geojson', 'points/{day}_points.geojson'],
+    },
+    # Every day adds its points to the day before, so a changed day rebuilds all later days until
+    # a cumulative file comes out the same as before
+    'cumulative_points': {
+        'inputs': ['points/{day}_points.geojson', 'cumulative/{previous_day}_cumulative.geojson'],
+        'outputs': ['cumulative/{day}_cumulative.geojson'],
+    },
+    'combine_points_yearly': {
+        'inputs': ['points/{year}*_points.geojson'],
+        'outputs': ['points_yearly/{year}_points.geojson'],
+    },
+    'visualize_points_with_counts': {
+        'inputs': ['points_yearly/{year}_points.geojson'],
+        'outputs': ['shapefile_yearly/{year}_VG5000_GEM_with_counts.shp'],
+    },
+    'visualize_cumulative_points_with_counts': {
+        'inputs': ['cumulative/{day}_cumulative.geojson'],
+        'outputs': ['shapefile_cumulative/{day}_VG5000_GEM_with_counts.shp'],
+    },
+    'visualize_points_geopandas': {
+        'inputs': ['shapefile_cumulative/{day}_VG5000_GEM_with_counts.shp'],
+        'outputs': ['visualizations_geopandas/{day}_visualization{frame_extension}'],
+    },
+    'visualize_points_geopandas_yearly_new': {
+        'inputs': ['shapefile_yearly/{year}_VG5000_GEM_with_counts.shp', 'all/{year}*_all.geojson'],
+        'outputs': [],
+    },
+}
+
+# Directory of the fingerprints, one file per stage so stages running at the same time never write the same file
+fingerprint_dir = os.path.join(build_cache.cache_dir, 'build')
+
+# Seconds between two saves of the fingerprints while a stage runs (they are always saved at the end)
+save_interval = 30
+
+# Directory of the progress files of stages that another stage running at the same time waits for
+# (see stage_scheduler.py): one line per finished unit, and FINISHED when the stage has ended
+progress_dir = os.path.join(build_cache.cache_dir, 'progress')
+
+# Seconds between two looks at the progress file of a stage that is waited for
+progress_poll_interval = 0.5
+
+FINISHED = '*finished*'
+
+SHAPEFILE_PARTS = ('.shp', '.dbf', '.shx', '.prj')
+
+
+def file_digest(path):
+    """Return the SHA-1 of a file's content. The date of the last update in a .dbf header is left out."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        if path.endswith('.dbf'):
+            # Byte 0 is the version, bytes 1-3 the date the file was written
+            digest.update(f.read(1))
+            f.seek(4)
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def expand_template(template, base_dir, fields):
+    """Return the paths (relative to base_dir) a template stands for: one path, or all files matching a glob pattern."""
+    path = template.format(**fields)
+    if '*' not in path:
+        return [path]
+    matches = glob.glob(os.path.join(base_dir, path))
+    return sorted(os.path.relpath(match, base_dir) for match in matches)
+
+
+def unit_fields(day=None, year=None, frame_extension=''):
+    """Return the template fields of a unit of one day (YYYYMMDD) or one year."""
+    fields = {'frame_extension': frame_extension}
+    if day is not None:
+        fields['day'] = day
+        fields['previous_day'] = (datetime.strptime(day, '%Y%m%d') - timedelta(days=1)).strftime('%Y%m%d')
+        fields['year'] = day[:4]
+    if year is not None:
+        fields['year'] = year
+    return fields
+
+
+def progress_path(stage, base_dir='.'):
+    """Path of the progress file of a stage."""
+    return os.path.join(base_dir, progress_dir, f'{stage}.txt')
+
+
+def start_progress(stage, base_dir='.'):
+    """Start an empty progress file for a stage, so it reports every unit it finishes from now on."""
+    path = progress_path(stage, base_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'w').close()
+
+
+def finish_progress(stage, base_dir='.'):
+    """Mark a stage as ended, so nothing waits for units it did not finish."""
+    with open(progress_path(stage, base_dir), 'a') as f:
+        f.write(FINISHED + '\n')
+
+
+def stop_progress(stage, base_dir='.'):
+    """Remove the progress file of a stage."""
+    path = progress_path(stage, base_dir)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def wait_for_unit(stage, key, base_dir='.', ordered=False):
+    """
+    Wait until a running stage has finished the unit `key`. Returns False if the stage ended without
+    it, or, for a stage that finishes its units in the order of their keys (ordered), as soon as it
+    finished a later unit.
+    """
+    path = progress_path(stage, base_dir)
+    while True:
+        with open(path, 'r') as f:
+            # A line is only complete (and the unit finished) once its newline was written
+            lines = f.read().split('\n')[:-1]
+        if key in lines:
+            return True
+        if FINISHED in lines:
+            return False
+        if ordered and any(line > key for line in lines):
+            return False
+        time.sleep(progress_poll_interval)
+
+
+class StageBuild:
+    """
+    The fingerprints of one stage: for every unit (a day or a year), the content of the inputs it
+    was built from, its outputs and the settings. A unit is built again when an output is missing
+    or was changed, or when an input or the settings differ from the last build. Content hashes
+    are used, so a unit whose inputs were rebuilt with the same content is not built again, and
+    every file is only hashed again when its size or modification time changed.
+
+    Outputs that already exist when a unit has no fingerprints yet (e.g. from before the first run
+    with fingerprints) are taken as up to date if none of them is older than an input.
+
+    If the stage has a progress file (see start_progress), every unit that is up to date or was
+    just built is added to it.
+    """
+
+    def __init__(self, stage, base_dir='.', overwrite=False):
+        self.stage = stage
+        self.base_dir = base_dir
+        self.overwrite = overwrite
+        self.path = os.path.join(base_dir, fingerprint_dir, f'{stage}.json')
+        state = build_cache.load_manifest(self.path)
+        self.files = state.get('files', {})  # path: [size, mtime_ns, digest]
+        self.units = state.get('units', {})  # key: {'inputs', 'outputs', 'settings'}
+        self.last_save = time.monotonic()
+        self.progress_path = progress_path(stage, base_dir)
+        self.report_progress = os.path.exists(self.progress_path)
+
+    def fingerprint(self, path):
+        """Return the content fingerprint of a path relative to base_dir (all parts of a shapefile), None if it is missing."""
+        if path.endswith('.shp'):
+            stem = path[:-len('.shp')]
+            parts = [self.file_fingerprint(stem + ext) for ext in SHAPEFILE_PARTS]
+            return None if parts[0] is None else ':'.join(part or '-' for part in parts)
+        return self.file_fingerprint(path)
+
+    def file_fingerprint(self, path):
+        """Return the digest of a file, hashed again only when its size or modification time changed."""
+        signature = build_cache.file_signature(os.path.join(self.base_dir, path))
+        if signature is None:
+            return None
+        known = self.files.get(path)
+        if known is not None and known[:2] == signature:
+            return known[2]
+        digest = file_digest(os.path.join(self.base_dir, path))
+        self.files[path] = signature + [digest]
+        return digest
+
+    def unit(self, key, settings=None, extra_inputs=(), extra_outputs=(), **fields):
+        """
+        Return the unit `key` of this stage with its inputs and outputs from STAGES, filled in with
+        the fields (see unit_fields), plus extra inputs (paths or patterns) and outputs relative to base_dir.
+        """
+        fields = unit_fields(**fields)
+        templates = STAGES[self.stage]
+        inputs = [path for template in templates['inputs'] for path in expand_template(template, self.base_dir, fields)]
+        outputs = [path for template in templates['outputs'] for path in expand_template(template, self.base_dir, fields)]
+        return {
+            'key': key,
+            'inputs': inputs + [path for template in extra_inputs for path in expand_template(template, self.base_dir, fields) if path not in inputs],
+            'outputs': outputs + [path for path in extra_outputs if path not in outputs],
+            # As they come back from the JSON file, so e.g. tuples compare equal to the lists read back
+            'settings': json.loads(json.dumps(settings)),
+        }
+
+    def stale_reason(self, unit):
+        """Return why a unit has to be built, or None if it is up to date."""
+        if self.overwrite:
+            return 'overwrite'
+        missing = [path for path in unit['outputs'] if self.fingerprint(path) is None]
+        if missing:
+            return f'{missing[0]} is missing'
+        inputs = {path: self.fingerprint(path) for path in unit['inputs']}
+        record = self.units.get(unit['key'])
+        if record is None:
+            if not self.newer_than_inputs(unit):
+                return 'not built yet'
+            # Built before there were fingerprints: keep it and track it from now on
+            self.record(unit, inputs)
+            return None
+        if record['settings'] != unit['settings']:
+            return 'settings changed'
+        for path, fingerprint in inputs.items():
+            if record['inputs'].get(path) != fingerprint:
+                return f'{path} changed'
+        removed = [path for path in record['inputs'] if path not in inputs]
+        if removed:
+            return f'{removed[0]} was removed'
+        for path in unit['outputs']:
+            if record['outputs'].get(path) != self.fingerprint(path):
+                return f'{path} was changed'
+        self.mark_done(unit)
+        return None
+
+    def newer_than_inputs(self, unit):
+        """True if no output of a unit is older than one of its inputs."""
+        def mtimes(paths):
+            return [os.path.getmtime(os.path.join(self.base_dir, path)) for path in paths if os.path.exists(os.path.join(self.base_dir, path))]
+        input_times = mtimes(unit['inputs'])
+        output_times = mtimes(unit['outputs'])
+        return not input_times or not output_times or min(output_times) >= max(input_times)
+
+    def record(self, unit, inputs=None):
+        """Record that a unit was built from its current inputs (or the fingerprints given) and settings."""
+        if inputs is None:
+            inputs = {path: self.fingerprint(path) for path in unit['inputs']}
+        self.units[unit['key']] = {
+            'inputs': inputs,
+            'outputs': {path: self.fingerprint(path) for path in unit['outputs']},
+            'settings': unit['settings'],
+        }
+        self.mark_done(unit)
+        if time.monotonic() - self.last_save > save_interval:
+            self.save()
+
+    def mark_done(self, unit):
+        """Add a unit to the progress file, if a stage running at the same time waits for this one."""
+        if self.report_progress:
+            with open(self.progress_path, 'a') as f:
+                f.write(unit['key'] + '\n')
+
+    def save(self):
+        """Write the fingerprints of this stage."""
+        build_cache.save_manifest(self.path, {'files': self.files, 'units': self.units})
+        self.last_save = time.monotonic()
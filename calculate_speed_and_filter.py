@@ -5,6 +5,12 @@ from geopy.distance import geodesic, distance as geopy_distance
 import os
 import math
 import pytz
+import build_engine
+import pipeline_context
+import instrumentation
+import region_cache
+import visualize_points_with_counts
+import visualize_cumulative_points_with_counts
 
 # Define the root directory
 root_dir = os.path.dirname(os.path.abspath(__file__))
@@ -22,19 +28,36 @@ slow_file_template = '{}_slow.geojson'
 fast_file_template = '{}_fast.geojson'
 points_file_template = '{}_points.geojson'
 
-# Introduce the overwrite variable
-overwrite = True
+# Introduce the overwrite variable. Days whose CSV file or exclusions changed since they were
+# processed are processed again anyway (see build_engine.py), so this forces a full rebuild.
+overwrite = False
 
-# Load exclusion timeframes from exclusion.json
+# Tag every generated point with the id of the region it lies in, so the count scripts can
+# count by id instead of locating the points again. The region layer is the one selected by the
+# onlygermany setting of the count scripts.
+tag_regions = False
+
+# The count stages whose onlygermany setting selects the region layer, the first one decides if they differ
+COUNT_STAGES = [visualize_points_with_counts, visualize_cumulative_points_with_counts]
+
+# Exclusion timeframes from exclusion.json, loaded by main()
 exclusion_file_path = os.path.join(root_dir, 'exclusion.json')
 excluded_timeframes = []
-if os.path.exists(exclusion_file_path):
+
+# Function to load the exclusion timeframes
+def load_excluded_timeframes():
+    if not os.path.exists(exclusion_file_path):
+        print("Warning: exclusion.json not found. No timeframes will be excluded.")
+        return []
     with open(exclusion_file_path, 'r') as exclusion_file:
         exclusion_data = json.load(exclusion_file)
-        excluded_timeframes = exclusion_data.get('times', [])
-    print(f"Loaded {len(excluded_timeframes)} excluded timeframes from exclusion.json")
-else:
-    print("Warning: exclusion.json not found. No timeframes will be excluded.")
+    timeframes = exclusion_data.get('times', [])
+    print(f"Loaded {len(timeframes)} excluded timeframes from exclusion.json")
+    return timeframes
+
+# Excluded timeframes that start on a day (YYYYMMDD), the only ones applied to that day's file
+def day_exclusions(file_date):
+    return [timeframe for timeframe in excluded_timeframes if str(timeframe.get('start', ''))[:10].replace('-', '') == file_date]
 
 # Function to check if a timestamp falls within excluded timeframes
 def is_excluded(timestamp_str):
@@ -143,210 +166,249 @@ def generate_points_along_path(path, interval_meters=500):
 
     return points
 
-# Iterate over all CSV files in the csv directory
-for csv_filename in os.listdir(csv_dir):
-    if csv_filename.endswith('.csv'):
-        file_date = os.path.splitext(csv_filename)[0]  # Extract date from filename
-        csv_path = os.path.join(csv_dir, csv_filename)
-
-        # Check if all four files exist
-        all_file_exists = os.path.exists(os.path.join(all_dir, all_file_template.format(file_date)))
-        slow_file_exists = os.path.exists(os.path.join(slow_dir, slow_file_template.format(file_date)))
-        fast_file_exists = os.path.exists(os.path.join(fast_dir, fast_file_template.format(file_date)))
-        points_file_exists = os.path.exists(os.path.join(points_dir, points_file_template.format(file_date)))
-
-        # If all four files exist and overwrite is False, skip processing
-        if all_file_exists and slow_file_exists and fast_file_exists and points_file_exists and not overwrite:
-            continue
-
-        # Read CSV and process data
-        with open(csv_path, newline='') as csvfile:
-            reader = csv.reader(csvfile)
-            data = list(reader)
-
-        # Skip the header row
-        data = data[1:]
-        
-        # Print the excluded timeframes for debugging
-        print(f"Processing file {file_date} with {len(data)} points")
-        print(f"Excluded timeframes: {excluded_timeframes}")
-        
-        # Check if this date has exclusion timeframes
-        should_check_exclusion = False
-        for timeframe in excluded_timeframes:
-            try:
-                exclusion_date = datetime.strptime(timeframe['start'], "%Y-%m-%d %H:%M:%S.000Z").date()
-                file_date_obj = datetime.strptime(file_date, "%Y%m%d").date()
-                if exclusion_date == file_date_obj:
-                    should_check_exclusion = True
-                    print(f"File date {file_date} matches exclusion date {exclusion_date}")
-                    break
-            except ValueError as e:
-                print(f"Error parsing exclusion date: {e}")
-        
-        # Create filtered data for slow paths (used for point counting)
-        # ALL data is used for all_paths (used for drawing lines)
-        if should_check_exclusion:
-            filtered_data = [point for point in data if not is_excluded(point[0])]
-            excluded_count = len(data) - len(filtered_data)
-            if excluded_count > 0:
-                print(f"Will exclude {excluded_count} points from slow paths (for region counting), but include in all_paths (for line drawing)")
-        else:
-            filtered_data = data
-            print(f"File date {file_date} does not match any exclusion dates")
-        
-        # Create empty GeoJSON files if no points in original data
-        if not data:
-            print(f"No points in {file_date}. Creating empty GeoJSON files.")
-            # Prepare empty GeoJSON structures
-            slow_paths_geojson = {
-                "type": "FeatureCollection",
-                "features": []
-            }
-            fast_paths_geojson = {
-                "type": "FeatureCollection",
-                "features": []
-            }
-            all_paths_geojson = {
-                "type": "FeatureCollection",
-                "features": []
-            }
-            date_points_geojson = {
-                "type": "FeatureCollection",
-                "features": []
-            }
-            
-            # Write empty GeoJSON files
-            with open(os.path.join(all_dir, all_file_template.format(file_date)), 'w') as all_geojson_file:
-                json.dump(all_paths_geojson, all_geojson_file, indent=2)
-            
-            with open(os.path.join(slow_dir, slow_file_template.format(file_date)), 'w') as slow_geojson_file:
-                json.dump(slow_paths_geojson, slow_geojson_file, indent=2)
-            
-            with open(os.path.join(fast_dir, fast_file_template.format(file_date)), 'w') as fast_geojson_file:
-                json.dump(fast_paths_geojson, fast_geojson_file, indent=2)
-            
-            with open(os.path.join(points_dir, points_file_template.format(file_date)), 'w') as points_geojson_file:
-                json.dump(date_points_geojson, points_geojson_file, indent=2)
-                
-            continue
+# The onlygermany setting of the count stages (their config in the context, else their default)
+def count_onlygermany(context):
+    values = [(context.stage_config(stage.__name__) if context is not None else {}).get('onlygermany', stage.onlygermany) for stage in COUNT_STAGES]
+    if len(set(values)) > 1:
+        print(f"Warning: the count stages use different onlygermany settings, points are tagged for {COUNT_STAGES[0].__name__} "
+              f"and located again by the others.")
+    return values[0]
+
+# Function to write the four GeoJSON files of one day from its CSV file, tagging the points with
+# their region when tag_onlygermany is set (see count_onlygermany)
+def process_csv_file(csv_path, file_date, tag_onlygermany=None):
+    # Read CSV and process data
+    with open(csv_path, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        data = list(reader)
+
+    # Skip the header row
+    data = data[1:]
+
+    # Print the excluded timeframes for debugging
+    print(f"Processing file {file_date} with {len(data)} points")
+    print(f"Excluded timeframes: {excluded_timeframes}")
+
+    # Check if this date has exclusion timeframes
+    should_check_exclusion = False
+    for timeframe in excluded_timeframes:
+        try:
+            exclusion_date = datetime.strptime(timeframe['start'], "%Y-%m-%d %H:%M:%S.000Z").date()
+            file_date_obj = datetime.strptime(file_date, "%Y%m%d").date()
+            if exclusion_date == file_date_obj:
+                should_check_exclusion = True
+                print(f"File date {file_date} matches exclusion date {exclusion_date}")
+                break
+        except ValueError as e:
+            print(f"Error parsing exclusion date: {e}")
+
+    # Create filtered data for slow paths (used for point counting)
+    # ALL data is used for all_paths (used for drawing lines)
+    if should_check_exclusion:
+        filtered_data = [point for point in data if not is_excluded(point[0])]
+        excluded_count = len(data) - len(filtered_data)
+        if excluded_count > 0:
+            print(f"Will exclude {excluded_count} points from slow paths (for region counting), but include in all_paths (for line drawing)")
+    else:
+        filtered_data = data
+        print(f"File date {file_date} does not match any exclusion dates")
 
-        # Prepare GeoJSON structures
+    # Create empty GeoJSON files if no points in original data
+    if not data:
+        print(f"No points in {file_date}. Creating empty GeoJSON files.")
+        # Prepare empty GeoJSON structures
         slow_paths_geojson = {
             "type": "FeatureCollection",
             "features": []
         }
-
         fast_paths_geojson = {
             "type": "FeatureCollection",
             "features": []
         }
-
         all_paths_geojson = {
             "type": "FeatureCollection",
             "features": []
         }
+        date_points_geojson = {
+            "type": "FeatureCollection",
+            "features": []
+        }
+
+        # Write empty GeoJSON files
+        with open(os.path.join(all_dir, all_file_template.format(file_date)), 'w') as all_geojson_file:
+            json.dump(all_paths_geojson, all_geojson_file, indent=2)
+
+        with open(os.path.join(slow_dir, slow_file_template.format(file_date)), 'w') as slow_geojson_file:
+            json.dump(slow_paths_geojson, slow_geojson_file, indent=2)
+
+        with open(os.path.join(fast_dir, fast_file_template.format(file_date)), 'w') as fast_geojson_file:
+            json.dump(fast_paths_geojson, fast_geojson_file, indent=2)
+
+        with open(os.path.join(points_dir, points_file_template.format(file_date)), 'w') as points_geojson_file:
+            json.dump(date_points_geojson, points_geojson_file, indent=2)
+
+        return
+
+    # Prepare GeoJSON structures
+    slow_paths_geojson = {
+        "type": "FeatureCollection",
+        "features": []
+    }
+
+    fast_paths_geojson = {
+        "type": "FeatureCollection",
+        "features": []
+    }
+
+    all_paths_geojson = {
+        "type": "FeatureCollection",
+        "features": []
+    }
+
+    # Iterate over ALL points for all_paths (used for drawing lines)
+    for i in range(len(data) - 1):
+        point1 = data[i]
+        point2 = data[i + 1]
+
+        # Convert latitude and longitude to float
+        point1[1] = float(point1[1])
+        point1[2] = float(point1[2])
+        point2[1] = float(point2[1])
+        point2[2] = float(point2[2])
+
+        speed = calculate_speed(point1, point2)
+
+        # Create a feature for all paths (includes ALL data for line drawing)
+        all_feature = {
+            "type": "Feature",
+            "geometry": {
+                "type": "LineString",
+                "coordinates": [
+                    [point1[2], point1[1]],  # GeoJSON uses [longitude, latitude]
+                    [point2[2], point2[1]]
+                ]
+            },
+            "properties": {
+                "speed": speed
+            }
+        }
+        all_paths_geojson["features"].append(all_feature)
 
-        # Iterate over ALL points for all_paths (used for drawing lines)
-        for i in range(len(data) - 1):
-            point1 = data[i]
-            point2 = data[i + 1]
+        # fast_paths uses all data too
+        if speed > 15:
+            fast_paths_geojson["features"].append(all_feature)
 
-            # Convert latitude and longitude to float
-            point1[1] = float(point1[1])
-            point1[2] = float(point1[2])
-            point2[1] = float(point2[1])
-            point2[2] = float(point2[2])
+    # Iterate over FILTERED points for slow_paths (used for region point counting)
+    for i in range(len(filtered_data) - 1):
+        point1 = filtered_data[i]
+        point2 = filtered_data[i + 1]
 
-            speed = calculate_speed(point1, point2)
+        # Convert latitude and longitude to float
+        try:
+            p1_lat = float(point1[1])
+            p1_lon = float(point1[2])
+            p2_lat = float(point2[1])
+            p2_lon = float(point2[2])
+        except (ValueError, IndexError):
+            continue
 
-            # Create a feature for all paths (includes ALL data for line drawing)
-            all_feature = {
+        speed = calculate_speed([point1[0], p1_lat, p1_lon], [point2[0], p2_lat, p2_lon])
+
+        if speed <= 15:
+            slow_feature = {
                 "type": "Feature",
                 "geometry": {
                     "type": "LineString",
                     "coordinates": [
-                        [point1[2], point1[1]],  # GeoJSON uses [longitude, latitude]
-                        [point2[2], point2[1]]
+                        [p1_lon, p1_lat],
+                        [p2_lon, p2_lat]
                     ]
                 },
                 "properties": {
                     "speed": speed
                 }
             }
-            all_paths_geojson["features"].append(all_feature)
-
-            # fast_paths uses all data too
-            if speed > 15:
-                fast_paths_geojson["features"].append(all_feature)
-        
-        # Iterate over FILTERED points for slow_paths (used for region point counting)
-        for i in range(len(filtered_data) - 1):
-            point1 = filtered_data[i]
-            point2 = filtered_data[i + 1]
-
-            # Convert latitude and longitude to float
-            try:
-                p1_lat = float(point1[1])
-                p1_lon = float(point1[2])
-                p2_lat = float(point2[1])
-                p2_lon = float(point2[2])
-            except (ValueError, IndexError):
+            slow_paths_geojson["features"].append(slow_feature)
+
+    # Combine paths in each GeoJSON file
+    slow_paths_geojson = combine_paths(slow_paths_geojson)
+    fast_paths_geojson = combine_paths(fast_paths_geojson)
+    all_paths_geojson = combine_paths(all_paths_geojson)
+
+    # Write to GeoJSON files in respective subfolders
+    with open(os.path.join(all_dir, all_file_template.format(file_date)), 'w') as all_geojson_file:
+        json.dump(all_paths_geojson, all_geojson_file, indent=2)
+
+    with open(os.path.join(slow_dir, slow_file_template.format(file_date)), 'w') as slow_geojson_file:
+        json.dump(slow_paths_geojson, slow_geojson_file, indent=2)
+
+    with open(os.path.join(fast_dir, fast_file_template.format(file_date)), 'w') as fast_geojson_file:
+        json.dump(fast_paths_geojson, fast_geojson_file, indent=2)
+
+    # Prepare GeoJSON structure for points
+    date_points_geojson = {
+        "type": "FeatureCollection",
+        "features": []
+    }
+
+    # Generate points along each path in the slow paths file
+    for feature in slow_paths_geojson['features']:
+        points = generate_points_along_path(feature)
+        for point in points:
+            point_feature = {
+                "type": "Feature",
+                "geometry": {
+                    "type": "Point",
+                    "coordinates": point
+                },
+                "properties": {}
+            }
+            date_points_geojson["features"].append(point_feature)
+
+    # Attach the region id to all points of the day in one lookup
+    if tag_onlygermany is not None:
+        point_features = date_points_geojson["features"]
+        region_ids = region_cache.locate_points([f["geometry"]["coordinates"] for f in point_features], tag_onlygermany, root_dir)
+        id_column = region_cache.region_id_column(tag_onlygermany)
+        for point_feature, region_id in zip(point_features, region_ids):
+            point_feature["properties"][id_column] = str(region_id)
+
+    # Write points to GeoJSON file
+    with open(os.path.join(points_dir, points_file_template.format(file_date)), 'w') as points_geojson_file:
+        json.dump(date_points_geojson, points_geojson_file, indent=2)
+
+
+# Main function to process all CSV files whose day is not up to date
+def main(context=None):
+    global excluded_timeframes
+    settings = pipeline_context.stage_settings(context, 'calculate_speed_and_filter', overwrite=overwrite, tag_regions=tag_regions)
+    excluded_timeframes = load_excluded_timeframes()
+    for directory in (all_dir, slow_dir, fast_dir, points_dir):
+        os.makedirs(directory, exist_ok=True)
+
+    # Fingerprints of the CSV files and the four files written from each of them
+    build = build_engine.StageBuild('calculate_speed_and_filter', root_dir, settings['overwrite'])
+    # The region layer the points are tagged with and its shapefile, so replacing it tags all days again
+    tag_onlygermany = count_onlygermany(context) if settings['tag_regions'] else None
+    regions = region_cache.region_source_signature(tag_onlygermany, root_dir) if settings['tag_regions'] else None
+
+    # Iterate over all CSV files in the csv directory
+    for csv_filename in sorted(os.listdir(csv_dir)):
+        if csv_filename.endswith('.csv'):
+            file_date = os.path.splitext(csv_filename)[0]  # Extract date from filename
+            csv_path = os.path.join(csv_dir, csv_filename)
+
+            # Skip the day if all four files exist and were written from this CSV file with the same exclusions
+            unit = build.unit(file_date, day=file_date, settings={'exclusions': day_exclusions(file_date), 'tag_regions': settings['tag_regions'], 'onlygermany': tag_onlygermany, 'regions': regions})
+            if build.stale_reason(unit) is None:
                 continue
 
-            speed = calculate_speed([point1[0], p1_lat, p1_lon], [point2[0], p2_lat, p2_lon])
-
-            if speed <= 15:
-                slow_feature = {
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "LineString",
-                        "coordinates": [
-                            [p1_lon, p1_lat],
-                            [p2_lon, p2_lat]
-                        ]
-                    },
-                    "properties": {
-                        "speed": speed
-                    }
-                }
-                slow_paths_geojson["features"].append(slow_feature)
-
-        # Combine paths in each GeoJSON file
-        slow_paths_geojson = combine_paths(slow_paths_geojson)
-        fast_paths_geojson = combine_paths(fast_paths_geojson)
-        all_paths_geojson = combine_paths(all_paths_geojson)
+            with instrumentation.measure_unit('calculate_speed_and_filter', file_date, unit['inputs'], unit['outputs'], base_dir=root_dir):
+                process_csv_file(csv_path, file_date, tag_onlygermany)
+            build.record(unit)
 
-        # Write to GeoJSON files in respective subfolders
-        with open(os.path.join(all_dir, all_file_template.format(file_date)), 'w') as all_geojson_file:
-            json.dump(all_paths_geojson, all_geojson_file, indent=2)
+    build.save()
 
-        with open(os.path.join(slow_dir, slow_file_template.format(file_date)), 'w') as slow_geojson_file:
-            json.dump(slow_paths_geojson, slow_geojson_file, indent=2)
 
-        with open(os.path.join(fast_dir, fast_file_template.format(file_date)), 'w') as fast_geojson_file:
-            json.dump(fast_paths_geojson, fast_geojson_file, indent=2)
-
-        # Prepare GeoJSON structure for points
-        date_points_geojson = {
-            "type": "FeatureCollection",
-            "features": []
-        }
-
-        # Generate points along each path in the slow paths file
-        for feature in slow_paths_geojson['features']:
-            points = generate_points_along_path(feature)
-            for point in points:
-                point_feature = {
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "Point",
-                        "coordinates": point
-                    },
-                    "properties": {}
-                }
-                date_points_geojson["features"].append(point_feature)
-
-        # Write points to GeoJSON file
-        with open(os.path.join(points_dir, points_file_template.format(file_date)), 'w') as points_geojson_file:
-            json.dump(date_points_geojson, points_geojson_file, indent=2)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import numpy as np
+import shapely
+from matplotlib.collections import PathCollection
+from matplotlib.colors import ListedColormap
+from matplotlib.path import Path
+
+# Regions with fewer points are not drawn
+min_points = 3
+
+
+def build_colormap(steps=60):
+    """Return the colormap of the count maps: #caaea8 followed by a ramp of `steps` colors to #8616e2."""
+    colors = ['#caaea8']  # First color in the colormap list
+
+    # Define start and end RGB for the ramp
+    r_start, g_start, b_start = 202, 174, 168  # RGB for #caaea8
+    r_end, g_end, b_end = 134, 22, 226          # RGB for #8616e2
+
+    # Generate `steps` colors for the ramp, these will be appended to the initial '#caaea8'
+    for i in range(1, steps + 1):
+        fraction = i / steps
+        r = max(0, min(255, int(r_start + (r_end - r_start) * fraction)))
+        g = max(0, min(255, int(g_start + (g_end - g_start) * fraction)))
+        b = max(0, min(255, int(b_start + (b_end - b_start) * fraction)))
+        colors.append(f"#{r:02x}{g:02x}{b:02x}")
+    colors.extend(['#8616e2' for _ in range(7501, 10001)])  # Extend to cover potential higher values
+    return ListedColormap(colors)
+
+
+def region_paths(geoms):
+    """
+    Return (paths, row index) for an array of (Multi)Polygons, one compound path per non-empty geometry.
+
+    Built the same way geopandas plots polygons (normalized rings, one path per row), so a
+    collection of these paths draws exactly like GeoDataFrame.plot.
+    """
+    geoms = shapely.normalize(np.asarray(geoms))
+    paths = []
+    rows = []
+    for row, geom in enumerate(geoms):
+        if geom is None or geom.is_empty:
+            continue
+        rings = []
+        for part in shapely.get_parts(geom):
+            rings.append(Path(np.asarray(part.exterior.coords)[:, :2], closed=True))
+            rings.extend(Path(np.asarray(ring.coords)[:, :2], closed=True) for ring in part.interiors)
+        paths.append(Path.make_compound_path(*rings))
+        rows.append(row)
+    return paths, np.array(rows, dtype=np.int64)
+
+
+class RegionCollection:
+    """
+    The polygons of a region layer, added to an axes once and recolored for every frame.
+
+    update() takes the count vector of a day (in the row order of the layer) and only swaps the
+    visible paths and their colors, the paths themselves are built once.
+    """
+
+    def __init__(self, ax, geoms, cmap=None, zorder=1):
+        self.paths, self.rows = region_paths(geoms)
+        self.collection = PathCollection([], cmap=cmap if cmap is not None else build_colormap(), edgecolors='none', zorder=zorder)
+        ax.add_collection(self.collection, autolim=False)
+
+    def update(self, counts):
+        """Show the regions with at least min_points, colored from the smallest to the largest visible count."""
+        values = np.asarray(counts)[self.rows]
+        visible = np.flatnonzero(values >= min_points)
+        self.collection.set_paths([self.paths[i] for i in visible])
+        self.collection.set_array(values[visible])
+        if len(visible):
+            self.collection.set_clim(values[visible].min(), values[visible].max())
+        self.collection.set_visible(len(visible) > 0)
+
+    def hide(self):
+        self.collection.set_visible(False)
@@ -1,37 +1,71 @@
 import os
 import json
 from collections import defaultdict
+import build_engine
+import pipeline_context
+import instrumentation
 
 # Define directories
 base_dir = '.'
 points_dir = os.path.join(base_dir, 'points')
 yearly_dir = os.path.join(base_dir, 'points_yearly')
-os.makedirs(yearly_dir, exist_ok=True)
 
-# Introduce the overwrite variable
-overwrite = True
+# Introduce the overwrite variable. Years whose daily files changed since the last run are
+# rebuilt anyway (see build_engine.py), so this is only needed to force a full rebuild.
+overwrite = False
 
-# Collect points by year
-yearly_points = defaultdict(list)
 
-for filename in os.listdir(points_dir):
-    if filename.endswith('_points.geojson'):
-        # Extract year from the filename
-        year = filename[:4]
-        if int(year) >= 2020:
-            with open(os.path.join(points_dir, filename), 'r') as file:
+def write_yearly_points(yearly_file_path, daily_files):
+    """Stream the features of the daily files into one year file, holding only one day in memory."""
+    tmp_path = yearly_file_path + '.tmp'
+    feature_count = 0
+    with open(tmp_path, 'w') as outfile:
+        outfile.write('{"type": "FeatureCollection", "features": [')
+        for daily_file in daily_files:
+            with open(daily_file, 'r') as file:
                 data = json.load(file)
-                yearly_points[year].extend(data.get('features', []))
-
-# Write combined points for each year
-for year, features in yearly_points.items():
-    yearly_geojson = {
-        "type": "FeatureCollection",
-        "features": features
-    }
-    # Check if the yearly file exists and overwrite is False
-    yearly_file_path = os.path.join(yearly_dir, f'{year}_points.geojson')
-    if os.path.exists(yearly_file_path) and not overwrite:
-        continue
-    with open(yearly_file_path, 'w') as outfile:
-        json.dump(yearly_geojson, outfile, indent=2)
+            for feature in data.get('features', []):
+                if feature_count:
+                    outfile.write(',\n')
+                json.dump(feature, outfile)
+                feature_count += 1
+        outfile.write(']}\n')
+    os.replace(tmp_path, yearly_file_path)
+    return feature_count
+
+
+def main(context=None):
+    settings = pipeline_context.stage_settings(context, 'combine_points_yearly', overwrite=overwrite)
+    os.makedirs(yearly_dir, exist_ok=True)
+
+    # Collect the daily points files by year (only the file names, the content is read per year)
+    daily_files_by_year = defaultdict(list)
+    for filename in sorted(os.listdir(points_dir)):
+        if filename.endswith('_points.geojson'):
+            # Extract year from the filename
+            year = filename[:4]
+            if int(year) >= 2020:
+                daily_files_by_year[year].append(os.path.join(points_dir, filename))
+
+    # Records which daily files (and which content of them) each year file was built from
+    build = build_engine.StageBuild('combine_points_yearly', base_dir, settings['overwrite'])
+
+    # Write combined points for each year whose daily files changed
+    for year, daily_files in sorted(daily_files_by_year.items()):
+        yearly_file_path = os.path.join(yearly_dir, f'{year}_points.geojson')
+
+        # Skip the year if the file exists, was built from exactly these daily files and overwrite is False
+        unit = build.unit(year, year=year)
+        if build.stale_reason(unit) is None:
+            continue
+
+        with instrumentation.measure_unit('combine_points_yearly', year, unit['inputs'], unit['outputs'], items=len(daily_files)):
+            feature_count = write_yearly_points(yearly_file_path, daily_files)
+        build.record(unit)
+        print(f"Combined {len(daily_files)} daily files with {feature_count} points into {yearly_file_path}")
+
+    build.save()
+
+
+if __name__ == '__main__':
+    main()
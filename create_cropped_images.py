@@ -1,6 +1,12 @@
 import os
 import sys
+from concurrent.futures import as_completed
 from PIL import Image
+import date_overlay
+import frame_formats
+import video_encoding
+import pipeline_context
+import instrumentation
 
 # Define directories
 base_dir = '.'
@@ -8,6 +14,11 @@ visualizations_dir = os.path.join(base_dir, 'visualizations_geopandas')
 square_images_dir = os.path.join(base_dir, 'visualizations_square')
 vertical_images_dir = os.path.join(base_dir, 'visualizations_vertical')
 
+# Directories of the dated images for create_video_from_images.py with date_stamping = 'images'
+dated_images_dir = os.path.join(base_dir, 'visualizations_with_dates')
+square_dated_images_dir = os.path.join(base_dir, 'visualizations_square_with_dates')
+vertical_dated_images_dir = os.path.join(base_dir, 'visualizations_vertical_with_dates')
+
 # Create directories if they don't exist
 os.makedirs(square_images_dir, exist_ok=True)
 os.makedirs(vertical_images_dir, exist_ok=True)
@@ -15,50 +26,129 @@ os.makedirs(vertical_images_dir, exist_ok=True)
 # Default overwrite setting
 overwrite = False
 
+# Also write the dated copies of all three formats, from the same decoded image. Only needed
+# when create_video_from_images.py runs with date_stamping = 'images'.
+dated_variants = False
+
+# Number of processes cropping images at the same time
+crop_workers = os.cpu_count() or 1
+
+
+def is_up_to_date(output_path, source_path):
+    """True if output_path exists and is not older than source_path."""
+    return os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(source_path)
+
+
+def layout_image(img, layout):
+    """Return the image of a layout (see video_encoding.VIDEO_LAYOUTS) cut from a full frame."""
+    crop, pad = video_encoding.layout_geometry(layout, img.width, img.height)
+    if crop is not None:
+        x, y, width, height = crop
+        img = img.crop((x, y, x + width, y + height))
+    if pad is not None:
+        # Create a new image with a white background
+        canvas_width, canvas_height, x, y = pad
+        canvas = Image.new('RGB', (canvas_width, canvas_height), (255, 255, 255))
+        canvas.paste(img, (x, y))
+        img = canvas
+    return img
+
+
+def frame_variants(filename, dated=False):
+    """Return (layout, output path, with date) of all images derived from one frame."""
+    variants = [
+        ('square', os.path.join(square_images_dir, filename), False),
+        ('vertical', os.path.join(vertical_images_dir, filename), False),
+    ]
+    if dated:
+        variants += [
+            ('landscape', os.path.join(dated_images_dir, filename), True),
+            ('square', os.path.join(square_dated_images_dir, filename), True),
+            ('vertical', os.path.join(vertical_dated_images_dir, filename), True),
+        ]
+    return variants
+
+
+def derive_images(filename, overwrite=False, dated=False):
+    """
+    Write the images derived from one frame that are missing or older than the frame. The frame
+    is decoded once for all of them. Returns the paths written.
+    """
+    img_path = os.path.join(visualizations_dir, filename)
+    todo = [variant for variant in frame_variants(filename, dated) if overwrite or not is_up_to_date(variant[1], img_path)]
+    if not todo:
+        return []
+
+    written = []
+    # The images written are counted when the measurement ends
+    with instrumentation.measure_unit('create_cropped_images', filename.split('_')[0], [img_path], written, items=len(todo)):
+        with Image.open(img_path) as img:
+            img.load()
+            layouts = {}
+            for layout, output_path, with_date in todo:
+                if layout not in layouts:
+                    layouts[layout] = layout_image(img, layout) if layout != 'landscape' else img.copy()
+                variant = layouts[layout]
+                if with_date:
+                    variant = date_overlay.draw_date(variant.copy(), filename.split('_')[0], video_encoding.VIDEO_LAYOUTS[layout]['date_position'])
+                frame_formats.save_frame(variant, output_path)
+                written.append(output_path)
+    return written
+
+
+def derive_images_batch(filenames, overwrite=False, dated=False):
+    """Process a list of frames in one worker. Returns (filename, paths written) per frame and the unit records."""
+    return [(filename, derive_images(filename, overwrite, dated)) for filename in filenames], instrumentation.collect_units()
+
+
 # Function to crop images
-def crop_images(overwrite=False):
-    png_files = [f for f in os.listdir(visualizations_dir) if f.endswith('.png')]
+def crop_images(overwrite=False, workers=None, context=None):
+    png_files = sorted(f for f in os.listdir(visualizations_dir) if frame_formats.is_frame(f))
     total_files = len(png_files)
-    print(f"Found {total_files} PNG files to process.")
-
-    for i, filename in enumerate(png_files):
-        square_output_path = os.path.join(square_images_dir, filename)
-        vertical_output_path = os.path.join(vertical_images_dir, filename)
-        
-        # Skip if files exist and overwrite is False
-        if not overwrite and os.path.exists(square_output_path) and os.path.exists(vertical_output_path):
-            print(f"Skipping {filename} (files already exist and overwrite=False)")
-            continue
-            
-        print(f"\nProcessing image {i+1} of {total_files}: {filename}")
-        img_path = os.path.join(visualizations_dir, filename)
-        img = Image.open(img_path)
-
-        # Crop to square
-        min_dimension = min(img.width, img.height)
-        square_img = img.crop(((img.width - min_dimension) // 2,
-                               (img.height - min_dimension) // 2,
-                               (img.width + min_dimension) // 2,
-                               (img.height + min_dimension) // 2))
-        square_img.save(square_output_path)
-        print(f"  Saved square image to {square_output_path}")
-
-        # Crop to a slightly wider vertical 9:16 area
-        vertical_width = int(img.height * 9 / 16 * 1.2)  # 20% wider
-        vertical_img = img.crop(((img.width - vertical_width) // 2,
-                                 0,
-                                 (img.width + vertical_width) // 2,
-                                 img.height))
+    print(f"Found {total_files} frames to process.")
+    if dated_variants:
+        for directory in (dated_images_dir, square_dated_images_dir, vertical_dated_images_dir):
+            os.makedirs(directory, exist_ok=True)
+
+    workers = max(1, min(crop_workers if workers is None else workers, total_files))
+    processed = 0
+
+    def report(result):
+        nonlocal processed
+        for filename, written in result:
+            processed += 1
+            if not written:
+                print(f"Skipping {filename} (images are up to date and overwrite=False)")
+                continue
+            print(f"\nProcessed image {processed} of {total_files}: {filename}")
+            for output_path in written:
+                print(f"  Saved {output_path}")
+
+    if workers == 1:
+        results, unit_records = derive_images_batch(png_files, overwrite, dated_variants)
+        instrumentation.add_units(unit_records)
+        report(results)
+        return
+
+    # A few batches per worker, so the frames are not sent to the workers one by one
+    batch_size = max(1, total_files // (workers * 4))
+    batches = [png_files[i:i + batch_size] for i in range(0, total_files, batch_size)]
+    with pipeline_context.process_pool(context, workers) as executor:
+        futures = [executor.submit(derive_images_batch, batch, overwrite, dated_variants) for batch in batches]
+        for future in as_completed(futures):
+            results, unit_records = future.result()
+            instrumentation.add_units(unit_records)
+            report(results)
+
+
+def main(context=None):
+    settings = pipeline_context.stage_settings(context, 'create_cropped_images', overwrite=overwrite, crop_workers=crop_workers)
+    print(f"Running with overwrite={settings['overwrite']}")
+    crop_images(settings['overwrite'], pipeline_context.stage_workers(context, settings['crop_workers']), context)
 
-        # Create a new image with a white background
-        vertical_final = Image.new('RGB', (vertical_img.width, int(vertical_img.width * 16 / 9)), (255, 255, 255))
-        vertical_final.paste(vertical_img, (0, (vertical_final.height - vertical_img.height) // 2))
-        vertical_final.save(vertical_output_path)
-        print(f"  Saved vertical image to {vertical_output_path}")
 
 if __name__ == "__main__":
     # Check for command line arguments
     if len(sys.argv) > 1 and sys.argv[1].lower() == 'true':
         overwrite = True
-    print(f"Running with overwrite={overwrite}")
-    crop_images(overwrite=overwrite)
+    main()
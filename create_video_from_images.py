@@ -1,7 +1,13 @@
 import os
-from PIL import Image, ImageDraw, ImageFont
-import subprocess
+import tempfile
+from PIL import Image
 from datetime import datetime
+import build_cache
+import date_overlay
+import frame_formats
+import video_encoding
+import pipeline_context
+import instrumentation
 
 # Add a toggle for recreating images
 recreate_images = False
@@ -9,6 +15,29 @@ recreate_images = False
 # Introduce the overwrite variable
 overwrite = True
 
+# Put the background music (static/timecode.mp3) under the videos
+add_music = True
+
+# Create all three videos with one ffmpeg run straight from /visualizations_geopandas: the frames
+# are decoded once and cropped, dated and scaled inside ffmpeg. No cropped or dated images are
+# written, so create_cropped_images.py is not needed in this mode.
+single_pass = False
+
+# Encode the videos as one segment per month, kept in cache/video_segments, and join them. Only
+# the months whose images changed since the last run are encoded again.
+incremental = False
+
+# Number of ffmpeg processes encoding a video at the same time. With more than 1 the images are
+# split into that many contiguous parts (or, in incremental mode, the changed months are encoded
+# side by side), which are joined without re-encoding. 1 encodes each video in one run.
+encode_workers = 1
+
+# How the dates get on the frames: 'images' draws them on copies of all images in the *_with_dates
+# directories, 'sprites' overlays small pre-rendered date images while encoding and 'drawtext' lets
+# ffmpeg write them while encoding (needs an ffmpeg built with freetype). 'sprites' gives the same
+# videos as 'images' without writing a second set of full-size images.
+date_stamping = 'sprites'
+
 # Define directories
 base_dir = '.'
 
@@ -29,11 +58,6 @@ video_output_path = os.path.join(base_dir, f'visualization_video_{current_date}.
 video_output_path_square = os.path.join(base_dir, f'visualization_video_square_{current_date}.mp4')
 video_output_path_vertical = os.path.join(base_dir, f'visualization_video_vertical_{current_date}.mp4')
 
-# Create new directory for images with date text
-os.makedirs(dated_images_dir, exist_ok=True)
-os.makedirs(square_dated_images_dir, exist_ok=True)
-os.makedirs(vertical_dated_images_dir, exist_ok=True)
-
 # Define the path to the JetBrains font
 font_path = os.path.join(base_dir, 'static', 'droid', 'droid.ttf')
 
@@ -46,117 +70,148 @@ def add_date_to_image(image_path, date_text, output_dir):
     if not recreate_images and os.path.exists(output_path):
         print(f"Image {output_path} already exists. Skipping creation.")
         return
-    # Format date to German preferences (DD.MM.YYYY)
-    formatted_date = datetime.strptime(date_text, '%Y%m%d').strftime('%d.%m.%Y')
     with Image.open(image_path) as img:
-        draw = ImageDraw.Draw(img)
-        # Calculate font size based on desired text height
-        text_height = 150
-        # Use a truetype font if available
-        try:
-            font = ImageFont.truetype(font_path, text_height)
-        except IOError:
-            print("JetBrains font not found. Using default font.")
-            sleep(50)
-            font = ImageFont.load_default()
-
-        # Calculate text width and adjust position
-        text_bbox = draw.textbbox((0, 0), formatted_date, font=font)
-        text_width = text_bbox[2] - text_bbox[0]
-        text_position = (10, img.height - text_height - 10)
-
-        # Draw text on the image
-        draw.text(text_position, formatted_date, font=font, fill='black')
-
+        date_overlay.draw_date(img, date_text, 'bottom_left', date_overlay.load_font(font_path))
         # Save the modified image
-        img.save(output_path)
+        frame_formats.save_frame(img, output_path)
 
 # Function to add date text to images in different formats
 def add_date_to_cropped_images(image_dir, output_dir, position):
+    font = date_overlay.load_font(font_path)
     for filename in os.listdir(image_dir):
-        if filename.endswith('.png'):
+        if frame_formats.is_frame(filename):
             img_path = os.path.join(image_dir, filename)
             output_path = os.path.join(output_dir, filename)
             if not recreate_images and os.path.exists(output_path):
                 print(f"Image {output_path} already exists. Skipping creation.")
                 continue
-            img = Image.open(img_path)
-            draw = ImageDraw.Draw(img)
-
-            date_text = filename.split('_')[0]
-            formatted_date = datetime.strptime(date_text, '%Y%m%d').strftime('%d.%m.%Y')
-            # Calculate font size based on desired text height
-            text_height = 150
-            # Use a truetype font if available
-            try:
-                font = ImageFont.truetype(font_path, text_height)
-            except IOError:
-                print("JetBrains font not found. Using default font.")
-                sleep(50)
-                font = ImageFont.load_default()
-
-            # Calculate text width and adjust position
-            text_bbox = draw.textbbox((0, 0), formatted_date, font=font)
-            text_width = text_bbox[2] - text_bbox[0]
-            if position == 'center':
-                text_position = ((img.width - text_width) / 2, img.height - text_height - 10)
-            else:  # 'bottom_left'
-                text_position = (10, img.height - text_height - 10)
-            draw.text(text_position, formatted_date, font=font, fill='black')
-            img.save(output_path)
-
-
-# Process regular visualization images
-image_files = sorted(os.listdir(visualizations_dir))
-for image_file in image_files:
-    if image_file.endswith('_visualization.png'):
-        date_text = image_file.split('_')[0]
-        image_path = os.path.join(visualizations_dir, image_file)
-        add_date_to_image(image_path, date_text, dated_images_dir)
-
-# Process regular cropped images
-add_date_to_cropped_images(square_images_dir, square_dated_images_dir, 'bottom_left')
-add_date_to_cropped_images(vertical_images_dir, vertical_dated_images_dir, 'center')
-
-# Function to create a video from image directory
-def create_video(image_dir, output_path, music_path, aspect_ratio=None):
+            with Image.open(img_path) as img:
+                date_overlay.draw_date(img, filename.split('_')[0], position, font)
+                frame_formats.save_frame(img, output_path)
+
+
+# Function to create all videos in one pass from the undated images
+def create_videos_single_pass(image_dir, outputs, music_path, overwrite=False):
+    image_files = sorted(f for f in os.listdir(image_dir) if frame_formats.is_frame(f, '_visualization')) if os.path.exists(image_dir) else []
+    if not image_files:
+        print(f"No images found in {image_dir}. Skipping video creation.")
+        return False
+
+    if not overwrite and all(os.path.exists(output_path) for output_path in outputs.values()):
+        print("Videos already exist. Skipping creation.")
+        return True
+
+    with Image.open(os.path.join(image_dir, image_files[0])) as img:
+        width, height = img.size
+
+    frame_paths = [os.path.join(image_dir, f) for f in image_files]
+    with instrumentation.measure_unit('create_video_from_images', 'single_pass', frame_paths, list(outputs.values()), items=len(image_files)):
+        # The dates of every video, written while encoding. The sprites are named like the frames,
+        # so both sequences sort the same.
+        with tempfile.TemporaryDirectory() as stamp_dir:
+            date_stages = {}
+            for layout in outputs:
+                layout_width, layout_height = video_encoding.layout_size(layout, width, height)
+                position = video_encoding.VIDEO_LAYOUTS[layout]['date_position']
+                mode = 'drawtext' if date_stamping == 'drawtext' else 'sprites'
+                date_stages[layout] = video_encoding.prepare_date_stamp(mode, image_files, layout_width, layout_height, position, os.path.join(stamp_dir, layout))
+
+            video_encoding.encode_fanout(frame_formats.frame_pattern(image_dir, suffix='_visualization'), width, height, outputs, date_stages, music_path)
+
+    for output_path in outputs.values():
+        print(f'Video created at {output_path}')
+    return True
+
+
+# Function to write the dated copies of all images (date_stamping = 'images')
+def add_dates_to_images():
+    # Create new directory for images with date text
+    os.makedirs(dated_images_dir, exist_ok=True)
+    os.makedirs(square_dated_images_dir, exist_ok=True)
+    os.makedirs(vertical_dated_images_dir, exist_ok=True)
+
+    # Process regular visualization images
+    image_files = sorted(os.listdir(visualizations_dir))
+    for image_file in image_files:
+        if frame_formats.is_frame(image_file, '_visualization'):
+            date_text = image_file.split('_')[0]
+            image_path = os.path.join(visualizations_dir, image_file)
+            add_date_to_image(image_path, date_text, dated_images_dir)
+
+    # Process regular cropped images
+    add_date_to_cropped_images(square_images_dir, square_dated_images_dir, 'bottom_left')
+    add_date_to_cropped_images(vertical_images_dir, vertical_dated_images_dir, 'center')
+
+# Function to create a video from image directory, with the dates written while encoding if a
+# date position is given
+def create_video(image_dir, output_path, music_path, aspect_ratio=None, date_position=None, overwrite=False):
     if not os.path.exists(image_dir):
         print(f"Directory {image_dir} does not exist. Skipping video creation.")
         return False
-        
-    if not os.listdir(image_dir):
+
+    image_files = sorted(f for f in os.listdir(image_dir) if frame_formats.is_frame(f))
+    if not image_files:
         print(f"No images found in {image_dir}. Skipping video creation.")
         return False
         
     if not overwrite and os.path.exists(output_path):
         print(f"Video {output_path} already exists. Skipping creation.")
         return True
-    
-    # Build ffmpeg command
-    command = [
-        'ffmpeg', '-y', '-pattern_type', 'glob', '-framerate', '30', 
-        '-i', os.path.join(image_dir, '*.png'),
-        '-i', music_path, '-c:v', 'libx264', '-r', '30', '-pix_fmt', 'yuv420p', '-shortest'
-    ]
-    
-    # Add scaling filter if aspect ratio is specified
-    if aspect_ratio == 'square':
-        command.insert(-1, '-vf')
-        command.insert(-1, 'scale=1080:1080,setsar=1:1')
-    elif aspect_ratio == 'vertical':
-        command.insert(-1, '-vf')
-        command.insert(-1, 'scale=1080:1920,setsar=1:1')
-    
-    # Add output path
-    command.append(output_path)
-    
-    # Run command
-    subprocess.run(command)
-    print(f'Video created at {output_path}')
-    return True
 
-# Create regular videos
-print("\nCreating regular videos...")
-create_video(dated_images_dir, video_output_path, background_music_path)
-create_video(square_dated_images_dir, video_output_path_square, background_music_path, 'square')
-create_video(vertical_dated_images_dir, video_output_path_vertical, background_music_path, 'vertical')
+    # One unit per video: all its frames in, the video out
+    frame_paths = [os.path.join(image_dir, f) for f in image_files]
+    with instrumentation.measure_unit('create_video_from_images', os.path.basename(output_path), frame_paths, [output_path], items=len(image_files)):
+        # Scale to the size of the format if an aspect ratio is specified
+        scale = video_encoding.VIDEO_LAYOUTS[aspect_ratio]['scale'] if aspect_ratio else None
+
+        if incremental:
+            segment_dir = os.path.join(base_dir, build_cache.cache_dir, 'video_segments', os.path.basename(os.path.normpath(image_dir)))
+            date_mode = date_stamping if date_position is not None else None
+            encoded = video_encoding.encode_incremental(image_dir, image_files, output_path, segment_dir, music_path, date_mode, date_position, scale, encode_workers)
+            print(f'Video created at {output_path} ({encoded} segments encoded)')
+            return True
+
+        if encode_workers > 1:
+            date_mode = date_stamping if date_position is not None else None
+            video_encoding.encode_parallel(image_dir, image_files, output_path, encode_workers, music_path, date_mode, date_position, scale)
+            print(f'Video created at {output_path} ({encode_workers} parts)')
+            return True
+
+        with tempfile.TemporaryDirectory() as stamp_dir:
+            date_stage = None
+            if date_position is not None:
+                with Image.open(os.path.join(image_dir, image_files[0])) as img:
+                    width, height = img.size
+                date_stage = video_encoding.prepare_date_stamp(date_stamping, image_files, width, height, date_position, stamp_dir)
+            video_encoding.encode_sequence(frame_formats.frame_pattern(image_dir), output_path, music_path, date_stage, scale)
+        print(f'Video created at {output_path}')
+        return True
+
+def main(context=None):
+    settings = pipeline_context.stage_settings(context, 'create_video_from_images', overwrite=overwrite, add_music=add_music)
+    music_path = background_music_path if settings['add_music'] else None
+    overwrite_videos = settings['overwrite']
+
+    if not single_pass and date_stamping == 'images':
+        add_dates_to_images()
+
+    # Create regular videos
+    print("\nCreating regular videos...")
+    if single_pass:
+        create_videos_single_pass(visualizations_dir, {
+            'landscape': video_output_path,
+            'square': video_output_path_square,
+            'vertical': video_output_path_vertical,
+        }, music_path, overwrite_videos)
+    elif date_stamping == 'images':
+        create_video(dated_images_dir, video_output_path, music_path, overwrite=overwrite_videos)
+        create_video(square_dated_images_dir, video_output_path_square, music_path, 'square', overwrite=overwrite_videos)
+        create_video(vertical_dated_images_dir, video_output_path_vertical, music_path, 'vertical', overwrite=overwrite_videos)
+    else:
+        create_video(visualizations_dir, video_output_path, music_path, date_position='bottom_left', overwrite=overwrite_videos)
+        create_video(square_images_dir, video_output_path_square, music_path, 'square', 'bottom_left', overwrite_videos)
+        create_video(vertical_images_dir, video_output_path_vertical, music_path, 'vertical', 'center', overwrite_videos)
+
+
+if __name__ == '__main__':
+    main()
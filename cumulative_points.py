@@ -3,57 +3,79 @@ import json
 import geopandas as gpd
 import pandas as pd
 from datetime import datetime, timedelta
+import build_engine
+import pipeline_context
+import instrumentation
 
-# Set your start date here!
+# Set your start date here! (run_all_scripts.py can set it as 'YYYYMMDD')
 start_date = datetime(2020, 1, 1)
 
 # Define directories
 points_dir = 'points'
 cumulative_dir = 'cumulative'
 
-# Create cumulative directory if it doesn't exist
-os.makedirs(cumulative_dir, exist_ok=True)
-
-# Load all points files
-points_files = sorted([f for f in os.listdir(points_dir) if f.endswith('.geojson')])
-
-# Process each day
-overwrite = True #This takes a while but better to redo if you are not starting fresh anyway. Might introduce some errors otherwise
-current_date = start_date
-
-while current_date <= datetime.now():
-    # Format date
-    date_str = current_date.strftime('%Y%m%d')
-    
-    # Save cumulative points
-    cumulative_file_path = os.path.join(cumulative_dir, f'{date_str}_cumulative.geojson')
-    
-    # Check if the cumulative file exists and overwrite is False
-    if os.path.exists(cumulative_file_path) and not overwrite:
+# A day is processed again when its points or the cumulative points of the day before changed
+# (see build_engine.py), so a changed day also updates all later days. overwrite forces a full rebuild.
+overwrite = False
+
+
+def main(context=None):
+    settings = pipeline_context.stage_settings(context, 'cumulative_points', overwrite=overwrite, start_date=start_date)
+    current_date = settings['start_date']
+    if isinstance(current_date, str):
+        current_date = datetime.strptime(current_date, '%Y%m%d')
+
+    # Create cumulative directory if it doesn't exist
+    os.makedirs(cumulative_dir, exist_ok=True)
+
+    # Load all points files
+    points_files = sorted([f for f in os.listdir(points_dir) if f.endswith('.geojson')])
+
+    # Process each day
+    build = build_engine.StageBuild('cumulative_points', '.', settings['overwrite'])
+
+    while current_date <= datetime.now():
+        # Format date
+        date_str = current_date.strftime('%Y%m%d')
+
+        # Save cumulative points
+        cumulative_file_path = os.path.join(cumulative_dir, f'{date_str}_cumulative.geojson')
+
+        # Skip the day if its cumulative file was built from the current points of the day and the day before
+        unit = build.unit(date_str, day=date_str)
+        if build.stale_reason(unit) is None:
+            current_date += timedelta(days=1)
+            continue
+
+        with instrumentation.measure_unit('cumulative_points', date_str, unit['inputs'], unit['outputs']):
+            # Determine the previous date
+            previous_date = current_date - timedelta(days=1)
+            previous_date_str = previous_date.strftime('%Y%m%d')
+            previous_cumulative_file_path = os.path.join(cumulative_dir, f'{previous_date_str}_cumulative.geojson')
+
+            # Load cumulative points from the previous date if the file exists
+            if os.path.exists(previous_cumulative_file_path):
+                cumulative_gdf = gpd.read_file(previous_cumulative_file_path)
+            else:
+                cumulative_gdf = gpd.GeoDataFrame()
+
+            # Find points file for the current day
+            points_file = next((f for f in points_files if date_str in f), None)
+
+            # Load points for the current day if available
+            if points_file:
+                points_gdf = gpd.read_file(os.path.join(points_dir, points_file))
+                cumulative_gdf = gpd.GeoDataFrame(pd.concat([cumulative_gdf, points_gdf], ignore_index=True))
+
+            cumulative_gdf.to_file(cumulative_file_path, driver='GeoJSON')
+        build.record(unit)
+        print(date_str)
+
+        # Move to the next day
         current_date += timedelta(days=1)
-        continue
-
-    # Determine the previous date
-    previous_date = current_date - timedelta(days=1)
-    previous_date_str = previous_date.strftime('%Y%m%d')
-    previous_cumulative_file_path = os.path.join(cumulative_dir, f'{previous_date_str}_cumulative.geojson')
-
-    # Load cumulative points from the previous date if the file exists
-    if os.path.exists(previous_cumulative_file_path):
-        cumulative_gdf = gpd.read_file(previous_cumulative_file_path)
-    else:
-        cumulative_gdf = gpd.GeoDataFrame()
-
-    # Find points file for the current day
-    points_file = next((f for f in points_files if date_str in f), None)
-    
-    # Load points for the current day if available
-    if points_file:
-        points_gdf = gpd.read_file(os.path.join(points_dir, points_file))
-        cumulative_gdf = gpd.GeoDataFrame(pd.concat([cumulative_gdf, points_gdf], ignore_index=True))
-    
-    cumulative_gdf.to_file(cumulative_file_path, driver='GeoJSON')
-    print(date_str)
-    
-    # Move to the next day
-    current_date += timedelta(days=1)
+
+    build.save()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import os
+import math
+from functools import lru_cache
+from datetime import datetime
+from PIL import Image, ImageDraw, ImageFont
+
+# Font and height in pixels of the date written on the video frames
+font_path = os.path.join('static', 'droid', 'droid.ttf')
+text_height = 150
+
+
+@lru_cache(maxsize=None)
+def load_font(path=font_path, size=text_height):
+    """Load the TrueType font once per process."""
+    try:
+        return ImageFont.truetype(path, size)
+    except IOError:
+        print(f"Font {path} not found. Using default font.")
+        return ImageFont.load_default()
+
+
+def format_date(date_text):
+    """Format a YYYYMMDD date to German preferences (DD.MM.YYYY)."""
+    return datetime.strptime(date_text, '%Y%m%d').strftime('%d.%m.%Y')
+
+
+def text_position(image_width, image_height, text, position='bottom_left', font=None):
+    """Return where the date text goes: 10 pixels from the bottom left corner, or centered at the bottom."""
+    font = font if font is not None else load_font()
+    if position == 'center':
+        left, _, right, _ = font.getbbox(text)
+        return ((image_width - (right - left)) / 2, image_height - text_height - 10)
+    return (10, image_height - text_height - 10)
+
+
+def draw_date(img, date_text, position='bottom_left', font=None):
+    """Write the date (YYYYMMDD) onto a PIL image in black."""
+    font = font if font is not None else load_font()
+    formatted_date = format_date(date_text)
+    draw = ImageDraw.Draw(img)
+    draw.text(text_position(img.width, img.height, formatted_date, position, font), formatted_date, font=font, fill='black')
+    return img
+
+
+def date_sprite(date_text, image_width, image_height, position='bottom_left', font=None):
+    """
+    Return (sprite, top) for overlaying the date on an image of the given size.
+
+    The sprite is a transparent strip as wide as the image, from row `top` to the bottom, with the
+    date drawn exactly where draw_date would put it, so overlaying it at (0, top) gives the same
+    pixels as drawing on the image.
+    """
+    font = font if font is not None else load_font()
+    formatted_date = format_date(date_text)
+    x, y = text_position(image_width, image_height, formatted_date, position, font)
+    top = max(0, math.floor(y))
+    sprite = Image.new('RGBA', (image_width, image_height - top), (0, 0, 0, 0))
+    ImageDraw.Draw(sprite).text((x, y - top), formatted_date, font=font, fill='black')
+    return sprite, top
+
+
+def write_date_sprites(image_names, image_width, image_height, output_dir, position='bottom_left'):
+    """Write a date sprite for every image name (starting with YYYYMMDD) as a PNG with the same name. Returns the top row."""
+    os.makedirs(output_dir, exist_ok=True)
+    top = None
+    for image_name in image_names:
+        sprite, top = date_sprite(image_name.split('_')[0], image_width, image_height, position)
+        sprite.save(os.path.join(output_dir, os.path.splitext(image_name)[0] + '.png'))
+    return top
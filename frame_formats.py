@@ -0,0 +1,64 @@
+import os
+import io
+from PIL import Image
+
+# File format of the intermediate frames: the rendered maps (/visualizations_geopandas), their
+# crops and dated copies, which mostly exist to be encoded by ffmpeg. Used by all scripts that
+# write or read them, so change it here and render again. See benchmark_frame_formats.py.
+#   'png'       PNG with the default compression, smallest of the PNG options but slowest to write
+#   'png_fast'  PNG with the lowest compression level
+#   'ppm'       uncompressed RGB, fastest to write and read, but about 25 MB per 4K frame
+#   'tiff'      TIFF with deflate compression, faster to write and much faster to read than PNG
+#   'webp'      lossless WebP with the fastest settings
+frame_format = 'png'
+
+# File extension and PIL save options of every frame format
+FRAME_FORMATS = {
+    'png': ('.png', {'format': 'PNG'}),
+    'png_fast': ('.png', {'format': 'PNG', 'compress_level': 1}),
+    'ppm': ('.ppm', {'format': 'PPM'}),
+    'tiff': ('.tiff', {'format': 'TIFF', 'compression': 'tiff_deflate'}),
+    'webp': ('.webp', {'format': 'WEBP', 'lossless': True, 'quality': 0, 'method': 0}),
+}
+
+
+def frame_extension(name=None):
+    """Return the file extension of a frame format (default: frame_format)."""
+    return FRAME_FORMATS[name or frame_format][0]
+
+
+def is_frame(filename, suffix='', name=None):
+    """True if filename is a frame (ending in suffix) in the frame format."""
+    return filename.endswith(suffix + frame_extension(name))
+
+
+def frame_pattern(directory, prefix='', suffix='', name=None):
+    """Return the glob pattern matching the frames in a directory, starting with prefix and ending in suffix."""
+    return os.path.join(directory, f'{prefix}*{suffix}{frame_extension(name)}')
+
+
+def save_frame(img, path, name=None):
+    """Save a PIL image as a frame."""
+    options = dict(FRAME_FORMATS[name or frame_format][1])
+    if options['format'] == 'PPM' and img.mode != 'RGB':
+        img = img.convert('RGB')  # PPM has no alpha channel
+    img.save(path, **options)
+
+
+def save_figure(fig, path, name=None, **savefig_kwargs):
+    """Save a matplotlib figure as a frame. 'png' is written exactly like fig.savefig(path) would."""
+    name = name or frame_format
+    if name == 'png':
+        fig.savefig(path, **savefig_kwargs)
+        return
+    options = dict(FRAME_FORMATS[name][1])
+    file_format = options.pop('format')
+    if file_format == 'PPM':
+        # Matplotlib cannot write PPM, so go through an uncompressed TIFF in memory
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format='tiff', **savefig_kwargs)
+        buffer.seek(0)
+        with Image.open(buffer) as img:
+            save_frame(img, path, name)
+        return
+    fig.savefig(path, format=file_format.lower(), pil_kwargs=options, **savefig_kwargs)
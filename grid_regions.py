@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+# Grid cells are laid out in web mercator, the CRS all maps are drawn in
+grid_epsg = 3857
+
+GRID_SHAPES = ('square', 'hex')
+
+
+def _hex_lattice(cell_size):
+    """Return (width, height) of the two interleaved rectangular lattices that make up a pointy-top hex grid."""
+    half = max(1, int(cell_size) // 2)
+    width = 2 * half                             # distance between the flat sides of a hexagon
+    height = int(round(width * 3 ** 0.5))        # distance between two rows of the same lattice
+    return width, height
+
+
+def bin_points(x, y, cell_size, shape='square'):
+    """
+    Return the integer (column, row) of the grid cell every point (EPSG:3857 meters) falls into.
+
+    Coordinates are floored to whole meters first, everything after that is integer arithmetic.
+    A hex grid is the union of two rectangular lattices of cell centers offset by half a cell;
+    each point goes to the nearer of its closest center in either lattice. Hex cells use doubled
+    coordinates so that both lattices fit in one integer (column, row) scheme.
+    """
+    if shape not in GRID_SHAPES:
+        raise ValueError(f"Unknown grid shape {shape!r}, expected one of {GRID_SHAPES}")
+    xi = np.floor(np.asarray(x, dtype=float)).astype(np.int64)
+    yi = np.floor(np.asarray(y, dtype=float)).astype(np.int64)
+
+    if shape == 'square':
+        size = int(cell_size)
+        return xi // size, yi // size
+
+    width, height = _hex_lattice(cell_size)
+    # Closest center of lattice A, centers at (i * width, j * height)
+    ia = (xi + width // 2) // width
+    ja = (yi + height // 2) // height
+    da = (xi - ia * width) ** 2 + (yi - ja * height) ** 2
+    # Closest center of lattice B, centers at (i * width + width / 2, j * height + height / 2)
+    ib = xi // width
+    jb = yi // height
+    db = (2 * (xi - ib * width) - width) ** 2 + (2 * (yi - jb * height) - height) ** 2
+    use_b = 4 * da > db
+    columns = np.where(use_b, 2 * ib + 1, 2 * ia)
+    rows = np.where(use_b, 2 * jb + 1, 2 * ja)
+    return columns, rows
+
+
+def cell_polygons(columns, rows, cell_size, shape='square'):
+    """Return the polygons (EPSG:3857) of the given grid cells."""
+    columns = np.asarray(columns, dtype=np.int64)
+    rows = np.asarray(rows, dtype=np.int64)
+    if shape == 'square':
+        size = int(cell_size)
+        return shapely.box(columns * size, rows * size, (columns + 1) * size, (rows + 1) * size)
+
+    width, height = _hex_lattice(cell_size)
+    # Doubled coordinates: the center is at (column * width / 2, row * height / 2)
+    center_x = columns * (width / 2)
+    center_y = rows * (height / 2)
+    radius = height / 3
+    corner_x = np.array([0, width / 2, width / 2, 0, -width / 2, -width / 2, 0])
+    corner_y = np.array([radius, radius / 2, -radius / 2, -radius, -radius / 2, radius / 2, radius])
+    coords = np.stack([center_x[:, None] + corner_x, center_y[:, None] + corner_y], axis=-1)
+    return shapely.polygons(coords)
+
+
+def count_points_in_grid(points_gdf, cell_size, shape='square'):
+    """
+    Count the points (in EPSG:3857) per grid cell.
+
+    Returns a GeoDataFrame of the occupied cells with CELL_ID and NUMPOINTS, which can be written
+    as a count shapefile and drawn by the renderers like the region counts.
+    """
+    if points_gdf.empty:
+        return gpd.GeoDataFrame({'CELL_ID': [], 'NUMPOINTS': []}, geometry=[], crs=f'EPSG:{grid_epsg}')
+
+    columns, rows = bin_points(points_gdf.geometry.x.values, points_gdf.geometry.y.values, cell_size, shape)
+    counts = pd.DataFrame({'column': columns, 'row': rows}).value_counts(sort=False).reset_index(name='NUMPOINTS')
+    counts = counts.sort_values(['row', 'column'], ignore_index=True)
+    cell_ids = shape[0] + counts['column'].astype(str) + '_' + counts['row'].astype(str)
+    return gpd.GeoDataFrame(
+        {'CELL_ID': cell_ids, 'NUMPOINTS': counts['NUMPOINTS'].astype(np.int64)},
+        geometry=cell_polygons(counts['column'].values, counts['row'].values, cell_size, shape),
+        crs=f'EPSG:{grid_epsg}',
+    )
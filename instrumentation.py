@@ -0,0 +1,269 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+import build_engine
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Unit records of this process that were not collected by a stage yet (see measure_unit)
+_units = []
+
+
+# Highest peak RSS in MB of this process that reset_peak_rss cleared since the stage started (see measure_stage)
+_cleared_peak = None
+
+
+def peak_rss_mb(children=False):
+    """
+    Peak resident memory in MB of this process since the last reset_peak_rss (or of its largest
+    finished child process), None where unknown.
+    """
+    if not children and os.path.exists('/proc/self/status'):
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def reset_peak_rss():
+    """
+    Start measuring the peak RSS of this process anew (Linux only, by writing 5 to /proc/self/clear_refs).
+    Returns False where that is not possible, then peak_rss_mb is the peak of the process so far.
+    """
+    global _cleared_peak
+    peak = peak_rss_mb()
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    if peak is not None:
+        _cleared_peak = peak if _cleared_peak is None else max(_cleared_peak, peak)
+    return True
+
+
+def children_cpu_time():
+    """CPU seconds of the finished child processes (e.g. ffmpeg) of this process."""
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def file_bytes(path):
+    """Size of a file in bytes (of all parts of a shapefile), 0 if it is missing."""
+    paths = [path[:-len('.shp')] + ext for ext in build_engine.SHAPEFILE_PARTS] if path.endswith('.shp') else [path]
+    return sum(os.path.getsize(part) for part in paths if os.path.exists(part))
+
+
+@contextmanager
+def measure_unit(stage, key, inputs=(), outputs=(), items=1, base_dir='.'):
+    """
+    Measure one unit (a day, a year, a frame or a video) of a stage: wall and CPU time (with its
+    finished child processes, e.g. ffmpeg), the peak RSS of the process during the unit, the items
+    processed and the bytes of its input and output files (paths relative to base_dir, e.g. the
+    inputs and outputs of a build_engine unit). The record is kept until the stage collects it, or
+    returned by a worker process with collect_units(). Where the peak can not be reset (see
+    reset_peak_rss), peak_rss_scope is 'process' and peak_rss_mb the peak of the process so far.
+    """
+    record = {'stage': stage, 'key': key, 'items': items, 'pid': os.getpid()}
+    record['peak_rss_scope'] = 'unit' if reset_peak_rss() else 'process'
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    children_start = children_cpu_time()
+    try:
+        yield record
+    finally:
+        record['wall'] = time.perf_counter() - wall_start
+        record['cpu'] = (time.process_time() - cpu_start) + (children_cpu_time() - children_start)
+        record['peak_rss_mb'] = peak_rss_mb()
+        record['bytes_read'] = sum(file_bytes(os.path.join(base_dir, path)) for path in inputs)
+        record['bytes_written'] = sum(file_bytes(os.path.join(base_dir, path)) for path in outputs)
+        _units.append(record)
+
+
+def collect_units():
+    """Return the unit records of this process and forget them."""
+    records = list(_units)
+    del _units[:]
+    return records
+
+
+def add_units(records):
+    """Add unit records a worker process returned."""
+    _units.extend(records)
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of the thread that started it every interval seconds. Much less overhead than
+    cProfile on code with many small calls, and the stacks can be drawn as a flame graph.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.thread_id = None
+
+    def start(self):
+        self.thread_id = threading.get_ident()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def write(self, path):
+        """Write the collapsed stacks (one 'caller;callee count' line per stack, for flamegraph.pl or speedscope)."""
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+    def summary(self, limit=20):
+        """Functions the most samples were taken in, with their share of all samples."""
+        total = sum(self.stacks.values()) or 1
+        own = Counter()
+        for stack, count in self.stacks.items():
+            own[stack.rsplit(';', 1)[-1]] += count
+        return '\n'.join(f'{count / total:6.1%}  {function}' for function, count in own.most_common(limit))
+
+
+@contextmanager
+def profile_stage(path, mode='cprofile', interval=0.005):
+    """
+    Profile the code run inside with cProfile (mode 'cprofile', written to path.prof) or the sampling
+    profiler (mode 'sampling', written to path.stacks.txt), with the top functions in path.txt.
+    Worker processes of the stage are not profiled.
+    """
+    if mode == 'sampling':
+        profiler = SamplingProfiler(interval)
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if mode == 'sampling':
+            profiler.stop()
+            profiler.write(path + '.stacks.txt')
+            with open(path + '.txt', 'w') as f:
+                f.write(profiler.summary() + '\n')
+        else:
+            profiler.disable()
+            profiler.dump_stats(path + '.prof')
+            with open(path + '.txt', 'w') as f:
+                pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(30)
+        print(f'Profile of this stage written to {path}.txt')
+
+
+@contextmanager
+def measure_stage(stage, profile=None):
+    """
+    Measure a whole stage run in this process and yield its record, filled in when the stage ends:
+    wall and CPU time (of this process, of its finished child processes and of the units its worker
+    processes returned), peak RSS during the stage (of this process, of the units of its workers and
+    of child processes that grew the peak of all finished children), and the items and bytes of all
+    its units. Where the peak can not be reset (see reset_peak_rss), peak_rss_scope is 'process' and
+    peak_rss_mb the peak of the process so far. profile is None or a dict with the 'path', 'mode' and
+    'interval' of a profile_stage capture.
+    """
+    global _cleared_peak
+    record = {'stage': stage, 'pid': os.getpid()}
+    collect_units()
+    record['peak_rss_scope'] = 'stage' if reset_peak_rss() else 'process'
+    _cleared_peak = None
+    children_rss_start = peak_rss_mb(children=True)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    children_start = children_cpu_time()
+    try:
+        if profile is None:
+            yield record
+        else:
+            with profile_stage(profile['path'], profile.get('mode', 'cprofile'), profile.get('interval', 0.005)):
+                yield record
+    finally:
+        units = collect_units()
+        worker_units = [unit for unit in units if unit['pid'] != os.getpid()]
+        record['wall'] = time.perf_counter() - wall_start
+        record['cpu'] = (time.process_time() - cpu_start) + (children_cpu_time() - children_start) + sum(unit['cpu'] for unit in worker_units)
+        # The peak of all finished children can not be reset, it only belongs to this stage if it grew
+        children_rss = peak_rss_mb(children=True)
+        if record['peak_rss_scope'] == 'stage' and children_rss == children_rss_start:
+            children_rss = None
+        rss = [value for value in [peak_rss_mb(), _cleared_peak, children_rss] + [unit['peak_rss_mb'] for unit in worker_units] if value is not None]
+        record['peak_rss_mb'] = max(rss) if rss else None
+        if any(unit['peak_rss_scope'] == 'process' for unit in worker_units):
+            record['peak_rss_scope'] = 'process'
+        record['items'] = sum(unit['items'] for unit in units)
+        record['bytes_read'] = sum(unit['bytes_read'] for unit in units)
+        record['bytes_written'] = sum(unit['bytes_written'] for unit in units)
+        record['units'] = units
+
+
+def run_id():
+    """Name of a run, from the time it started."""
+    return datetime.now().strftime('run_%Y%m%d_%H%M%S')
+
+
+def summary_text(report):
+    """Human readable summary of a run report: one line per stage and its slowest units."""
+    lines = [f"Run {report['run']}: {report['wall']:.1f} s wall, {report['cpu_budget']} CPUs", '']
+    lines.append(f"{'stage':42} {'wall s':>8} {'cpu s':>8} {'rss MB':>8} {'items':>7} {'read MB':>9} {'written MB':>10}")
+    for stage in report['stages']:
+        rss = '-' if stage['peak_rss_mb'] is None else f"{stage['peak_rss_mb']:.0f}"
+        if stage['peak_rss_mb'] is not None and stage.get('peak_rss_scope') == 'process':
+            rss += '*'
+        lines.append(f"{stage['stage']:42} {stage['wall']:8.1f} {stage['cpu']:8.1f} {rss:>8} {stage['items']:7d} "
+                     f"{stage['bytes_read'] / 1e6:9.1f} {stage['bytes_written'] / 1e6:10.1f}")
+    if any(stage.get('peak_rss_scope') == 'process' for stage in report['stages']):
+        lines.append("* peak RSS of the process so far, it could not be measured for the stage alone")
+    units = sorted((unit for stage in report['stages'] for unit in stage['units']), key=lambda unit: unit['wall'], reverse=True)
+    if units:
+        lines += ['', 'Slowest units:']
+        for unit in units[:10]:
+            lines.append(f"  {unit['stage']} {unit['key']}: {unit['wall']:.2f} s wall, {unit['cpu']:.2f} s cpu")
+    return '\n'.join(lines)
+
+
+def write_report(report, report_dir):
+    """Write a run report as JSON and as a summary (report_dir/<run>.json and .txt) and print the summary."""
+    os.makedirs(report_dir, exist_ok=True)
+    path = os.path.join(report_dir, report['run'])
+    with open(path + '.json', 'w') as f:
+        json.dump(report, f, indent=1)
+    summary = summary_text(report)
+    with open(path + '.txt', 'w') as f:
+        f.write(summary + '\n')
+    print(summary)
+    print(f'Run report written to {path}.json')
@@ -0,0 +1,100 @@
+import os
+import multiprocessing
+import build_engine
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+
+class PipelineContext:
+    """
+    What the stages of one pipeline run share: the configuration of every stage (see
+    run_all_scripts.py), the base directory, the number of processes they may use and their
+    worker pools. The stages run in one process, so the layers cached per process (region_cache,
+    basemap_cache) are read once for all of them.
+
+    streaming are the stages that run at the same time as this one (see stage_scheduler.py) and
+    report the units they finish, so a stage can start on their first days before they are done.
+    """
+
+    def __init__(self, config=None, base_dir='.', workers=None, streaming=()):
+        self.config = config or {}
+        self.base_dir = base_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.streaming = set(streaming)
+        self.pools = {}
+
+    def stage_config(self, stage):
+        """Return the configuration of a stage (an empty dict if it has none)."""
+        return self.config.get(stage, {})
+
+    def process_pool(self, workers, initializer=None, initargs=()):
+        """
+        Return a pool of spawned worker processes. The pool is kept until the context is closed, so
+        a later stage (or call) asking for the same number of workers and initializer reuses it.
+        """
+        workers = max(1, min(workers, self.workers))
+        key = (workers, initializer, initargs)
+        if key not in self.pools:
+            context = multiprocessing.get_context('spawn')
+            self.pools[key] = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=initializer, initargs=initargs)
+        return self.pools[key]
+
+    def close(self):
+        """Shut the worker pools down."""
+        for pool in self.pools.values():
+            pool.shutdown()
+        self.pools = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def stage_settings(context, stage, **defaults):
+    """
+    Return the settings of a stage: the defaults (the variables at the top of its script) with the
+    values from the configuration of the context. Configuration keys the stage does not know are
+    reported, so a setting never gets lost silently.
+    """
+    settings = dict(defaults)
+    if context is None:
+        return settings
+    for name, value in context.stage_config(stage).items():
+        if name == 'run':
+            continue
+        if name not in defaults:
+            print(f"Warning: {stage} has no setting '{name}', ignoring it.")
+            continue
+        settings[name] = value
+    return settings
+
+
+def stage_workers(context, workers):
+    """Number of processes a stage may use: its own setting, limited by the context."""
+    if context is None:
+        return max(1, workers)
+    return max(1, min(workers, context.workers))
+
+
+def is_streaming(context, stage):
+    """True if a stage is still running at the same time and reports its finished units."""
+    return context is not None and stage in context.streaming
+
+
+def wait_for_unit(context, stage, key, ordered=False):
+    """Wait until a stage running at the same time has finished the unit `key` (no wait if it is not running, see build_engine.wait_for_unit)."""
+    if is_streaming(context, stage):
+        build_engine.wait_for_unit(stage, key, context.base_dir, ordered)
+
+
+@contextmanager
+def process_pool(context, workers, initializer=None, initargs=()):
+    """Pool of spawned worker processes: the context's shared pool, or one for this stage only without a context."""
+    if context is not None:
+        yield context.process_pool(workers, initializer, initargs)
+        return
+    mp_context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=initializer, initargs=initargs) as executor:
+        yield executor
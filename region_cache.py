@@ -0,0 +1,211 @@
+import os
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely import STRtree
+from pyproj import Transformer
+import build_cache
+
+# Region layers used for counting points. Each entry names the source shapefile, its native CRS
+# and the column that identifies a region.
+REGION_SOURCES = {
+    # European Local Administrative Units from http://ec.europa.eu/eurostat/web/gisco/geodata/statistical-units/local-administrative-units
+    'lau': {
+        'path': os.path.join('basisdaten', 'LAU_RG_01M_2023_3035.shp'),
+        'epsg': 3035,
+        'id_column': 'GISCO_ID',
+    },
+    # German "Gemeinden"
+    'gem': {
+        'path': os.path.join('basisdaten', 'VG5000_GEM.shp'),
+        'epsg': 25832,
+        'id_column': 'AGS',
+    },
+}
+
+# All maps are drawn in web mercator
+target_epsg = 3857
+
+# Columns that identify the rows of a count table: the ids of the region layers and of grid cells
+COUNT_ID_COLUMNS = [source['id_column'] for source in REGION_SOURCES.values()] + ['CELL_ID']
+
+
+def region_source_name(onlygermany):
+    """Return the name of the region layer used for the onlygermany setting of the count scripts."""
+    return 'gem' if onlygermany else 'lau'
+
+
+@lru_cache(maxsize=None)
+def load_region_layer(name, base_dir='.'):
+    """
+    Return the region layer `name` reprojected to EPSG:3857 together with its spatial index.
+
+    The reprojected layer and the STRtree are pickled to the cache directory, keyed to the source
+    shapefile and both CRS, so only the first run after the shapefile changes pays for reading and
+    reprojecting it. Within a process the result is loaded once, on first use.
+    """
+    source = REGION_SOURCES[name]
+    shapefile_path = os.path.join(base_dir, source['path'])
+    key = {
+        'source': os.path.abspath(shapefile_path),
+        'signature': build_cache.shapefile_signature(shapefile_path),
+        'source_epsg': source['epsg'],
+        'target_epsg': target_epsg,
+    }
+    cache_path = os.path.join(base_dir, build_cache.cache_dir, f'regions_{name}_{target_epsg}.pickle')
+
+    cached = build_cache.load_cached(cache_path, key)
+    if cached is not None:
+        return cached['gdf'], cached['tree']
+
+    print(f"Building region cache for {shapefile_path}...")
+    gdf = gpd.read_file(shapefile_path)
+    gdf.set_crs(epsg=source['epsg'], inplace=True, allow_override=True)
+    gdf = gdf.to_crs(epsg=target_epsg)
+    tree = STRtree(gdf.geometry.values)
+    build_cache.save_cached(cache_path, key, {'gdf': gdf, 'tree': tree})
+    return gdf, tree
+
+
+def load_regions(onlygermany=False, base_dir='.'):
+    """Return a copy of the reprojected region layer that the caller may add columns to."""
+    gdf, _ = load_region_layer(region_source_name(onlygermany), base_dir)
+    return gdf.copy()
+
+
+def region_source_signature(onlygermany=False, base_dir='.'):
+    """Return the signature of the shapefile of the region layer used for the onlygermany setting."""
+    return build_cache.shapefile_signature(os.path.join(base_dir, REGION_SOURCES[region_source_name(onlygermany)]['path']))
+
+
+def region_id_column(onlygermany=False):
+    """Return the name of the point property holding the region id assigned by locate_points."""
+    return f'region_{region_source_name(onlygermany)}'
+
+
+def locate_points(lonlat_points, onlygermany=False, base_dir='.'):
+    """
+    Return the region id (from the id column of the region layer) for each [lon, lat] point, '' if it lies in no region.
+
+    Used to tag points once when they are created, so the count scripts can group by the id
+    instead of locating the same points again.
+    """
+    name = region_source_name(onlygermany)
+    gdf, tree = load_region_layer(name, base_dir)
+    region_ids = np.full(len(lonlat_points), '', dtype=object)
+    if not lonlat_points:
+        return region_ids
+    coords = np.asarray(lonlat_points, dtype=float)
+    transformer = Transformer.from_crs(4326, target_epsg, always_xy=True)
+    x, y = transformer.transform(coords[:, 0], coords[:, 1])
+    point_idx, region_idx = tree.query(shapely.points(x, y), predicate='within')
+    # A point within overlapping regions matches all of them; keep only the first match (the count
+    # of untagged points in count_points_in_regions counts it in every region)
+    ids = gdf[REGION_SOURCES[name]['id_column']].astype(str).to_numpy()
+    region_ids[point_idx[::-1]] = ids[region_idx[::-1]]
+    return region_ids
+
+
+def count_points_in_regions(points_gdf, onlygermany=False, base_dir='.'):
+    """
+    Count the points (in EPSG:3857) within each region, in the row order of the region layer.
+
+    If every point already carries a region id from locate_points, the ids are simply counted.
+    """
+    name = region_source_name(onlygermany)
+    gdf, tree = load_region_layer(name, base_dir)
+    if points_gdf.empty:
+        return np.zeros(len(gdf), dtype=np.int64)
+
+    id_column = region_id_column(onlygermany)
+    if id_column in points_gdf.columns and not points_gdf[id_column].isna().any():
+        # Ids the layer does not have (points in no region) are not counted
+        rows = pd.Index(gdf[REGION_SOURCES[name]['id_column']].astype(str)).get_indexer(points_gdf[id_column].astype(str))
+        return np.bincount(rows[rows >= 0], minlength=len(gdf))
+
+    _, region_idx = tree.query(points_gdf.geometry.values, predicate='within')
+    return np.bincount(region_idx, minlength=len(gdf))
+
+
+def match_region_layer(attributes, base_dir='.'):
+    """Return the name of the cached region layer whose ids match the rows of a count table, or None."""
+    for name, source in REGION_SOURCES.items():
+        id_column = source['id_column']
+        if id_column not in attributes.columns:
+            continue
+        if not os.path.exists(os.path.join(base_dir, source['path'])):
+            continue
+        gdf, _ = load_region_layer(name, base_dir)
+        if len(gdf) == len(attributes) and (gdf[id_column].values == attributes[id_column].values).all():
+            return name
+    return None
+
+
+def read_count_shapefile(shapefile_path, base_dir='.'):
+    """
+    Read a count shapefile written by the count scripts (EPSG:3857).
+
+    Only the attribute table is read; the geometry is taken from the cached region layer when the
+    ids match row by row. Any other shapefile is read completely.
+    """
+    attributes = gpd.read_file(shapefile_path, ignore_geometry=True)
+    name = match_region_layer(attributes, base_dir)
+    if name is not None:
+        gdf, _ = load_region_layer(name, base_dir)
+        return gpd.GeoDataFrame(attributes, geometry=gdf.geometry.values, crs=gdf.crs)
+
+    shapefile_gdf = gpd.read_file(shapefile_path)
+    shapefile_gdf.set_crs(epsg=target_epsg, inplace=True, allow_override=True)
+    return shapefile_gdf
+
+
+def count_ids(attributes, layer_name=None):
+    """
+    Return the region (or grid cell) ids of the rows of a count table, or the row numbers if it
+    has none. With the name of its region layer, the id column of that layer is used.
+    """
+    if layer_name is not None:
+        return attributes[REGION_SOURCES[layer_name]['id_column']].to_numpy()
+    for column in COUNT_ID_COLUMNS:
+        if column in attributes.columns:
+            return attributes[column].to_numpy()
+    return attributes.index.to_numpy()
+
+
+class CumulativeCounts:
+    """
+    Running totals of point counts per region, built by adding one count table after the other.
+
+    Counts are matched by region (or grid cell) id, not by row, so tables with different rows,
+    like the occupied grid cells of different years, add up correctly. Missing counts count as 0.
+    Geometries can be passed along for regions that are not part of a cached region layer.
+    """
+
+    def __init__(self):
+        self.totals = pd.Series(dtype=np.float64)
+        self.geometries = {}
+
+    def add(self, ids, counts, geometries=None):
+        """Add a count table given as ids and counts (and optionally the geometries of the regions)."""
+        counts = pd.Series(np.nan_to_num(np.asarray(counts, dtype=np.float64)), index=pd.Index(ids))
+        new_ids = counts.index.difference(self.totals.index, sort=False)
+        if len(new_ids):
+            self.totals = pd.concat([self.totals, pd.Series(0.0, index=new_ids)])
+        self.totals.loc[counts.index] += counts.to_numpy()
+        if geometries is not None:
+            for region_id, geometry in zip(ids, geometries):
+                self.geometries.setdefault(region_id, geometry)
+
+    def counts_for(self, ids):
+        """Return the totals for the given ids (in that order), 0 for regions without any counts."""
+        return self.totals.reindex(pd.Index(ids), fill_value=0).to_numpy()
+
+    def to_geodataframe(self):
+        """Return the totals with the geometries passed to add() as a GeoDataFrame (EPSG:3857) with NUMPOINTS."""
+        return gpd.GeoDataFrame(
+            {'NUMPOINTS': self.totals.to_numpy()},
+            geometry=[self.geometries.get(region_id) for region_id in self.totals.index],
+            crs=f'EPSG:{target_epsg}',
+        )
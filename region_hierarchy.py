@@ -0,0 +1,111 @@
+import os
+from functools import lru_cache
+import pandas as pd
+import geopandas as gpd
+import build_cache
+import region_cache
+
+# Aggregation levels, from finest to coarsest
+LEVELS = ['gemeinde', 'kreis', 'land']
+
+# Names of the German states, keyed by the first two digits of the AGS
+LAND_NAMES = {
+    '01': 'Schleswig-Holstein', '02': 'Hamburg', '03': 'Niedersachsen', '04': 'Bremen',
+    '05': 'Nordrhein-Westfalen', '06': 'Hessen', '07': 'Rheinland-Pfalz', '08': 'Baden-Württemberg',
+    '09': 'Bayern', '10': 'Saarland', '11': 'Berlin', '12': 'Brandenburg',
+    '13': 'Mecklenburg-Vorpommern', '14': 'Sachsen', '15': 'Sachsen-Anhalt', '16': 'Thüringen',
+}
+
+# Optional district layer, only used for the names of the districts
+kreis_shapefile = os.path.join('basisdaten', 'VG5000_KRS.shp')
+
+
+@lru_cache(maxsize=None)
+def load_hierarchy(onlygermany=False, base_dir='.'):
+    """
+    Return a table mapping every municipality of the region layer (same row order) to its district and state.
+
+    The German "Amtlicher Gemeindeschlüssel" (AGS) encodes the hierarchy: the first two digits are
+    the state, the first five the district. The LAU layer carries the AGS as LAU_ID for German
+    municipalities; municipalities of other countries are rolled up to their country on both levels.
+    """
+    name = region_cache.region_source_name(onlygermany)
+    gdf, _ = region_cache.load_region_layer(name, base_dir)
+    if name == 'gem':
+        ags = gdf['AGS'].astype(str)
+        hierarchy = pd.DataFrame({
+            'gemeinde': ags.values,
+            'kreis': ags.str[:5].values,
+            'land': ags.str[:2].values,
+        })
+    else:
+        country = gdf['CNTR_CODE'].astype(str)
+        lau_id = gdf['LAU_ID'].astype(str)
+        is_german = (country == 'DE').values
+        hierarchy = pd.DataFrame({
+            'gemeinde': gdf['GISCO_ID'].astype(str).values,
+            'kreis': country.where(~is_german, 'DE_' + lau_id.str[:5]).values,
+            'land': country.where(~is_german, 'DE_' + lau_id.str[:2]).values,
+        })
+    return hierarchy
+
+
+def level_names(level, onlygermany=False, base_dir='.'):
+    """Return a mapping from region id to a readable name for the given level (may be incomplete)."""
+    gdf, _ = region_cache.load_region_layer(region_cache.region_source_name(onlygermany), base_dir)
+    hierarchy = load_hierarchy(onlygermany, base_dir)
+    name_column = 'GEN' if onlygermany else 'LAU_NAME'
+    if level == 'gemeinde':
+        return dict(zip(hierarchy['gemeinde'], gdf[name_column]))
+
+    prefix = '' if onlygermany else 'DE_'
+    if level == 'land':
+        return {prefix + code: name for code, name in LAND_NAMES.items()}
+
+    kreis_path = os.path.join(base_dir, kreis_shapefile)
+    if not os.path.exists(kreis_path):
+        return {}
+    districts = gpd.read_file(kreis_path, ignore_geometry=True)
+    return {prefix + str(ags)[:5]: name for ags, name in zip(districts['AGS'], districts['GEN'])}
+
+
+def rollup_counts(counts, level, onlygermany=False, base_dir='.'):
+    """Sum per-municipality counts (row order of the region layer) up to the given level. Returns a Series indexed by region id."""
+    hierarchy = load_hierarchy(onlygermany, base_dir)
+    return pd.Series(counts).groupby(hierarchy[level].values).sum()
+
+
+def load_level_layer(level, onlygermany=False, base_dir='.'):
+    """
+    Return the region geometry of a level (EPSG:3857) with one row per region id in column REGION_ID.
+
+    The municipalities are dissolved once and the result is cached next to the region layer.
+    """
+    name = region_cache.region_source_name(onlygermany)
+    if level == 'gemeinde':
+        gdf, _ = region_cache.load_region_layer(name, base_dir)
+        return gpd.GeoDataFrame({'REGION_ID': load_hierarchy(onlygermany, base_dir)['gemeinde'].values},
+                                geometry=gdf.geometry.values, crs=gdf.crs)
+
+    source_path = os.path.join(base_dir, region_cache.REGION_SOURCES[name]['path'])
+    key = {'source': os.path.abspath(source_path), 'signature': build_cache.shapefile_signature(source_path), 'level': level}
+    cache_path = os.path.join(base_dir, build_cache.cache_dir, f'regions_{name}_{level}_{region_cache.target_epsg}.pickle')
+    layer = build_cache.load_cached(cache_path, key)
+    if layer is None:
+        print(f"Building {level} layer from {source_path}...")
+        gdf, _ = region_cache.load_region_layer(name, base_dir)
+        layer = gpd.GeoDataFrame({'REGION_ID': load_hierarchy(onlygermany, base_dir)[level].values},
+                                 geometry=gdf.geometry.values, crs=gdf.crs)
+        layer = layer.dissolve(by='REGION_ID', as_index=False)
+        build_cache.save_cached(cache_path, key, layer)
+    return layer.copy()
+
+
+def rollup_count_layer(counts, level, onlygermany=False, base_dir='.'):
+    """Return the level layer with a NUMPOINTS column derived from per-municipality counts, ready to be written as a count shapefile."""
+    layer = load_level_layer(level, onlygermany, base_dir)
+    names = level_names(level, onlygermany, base_dir)
+    totals = rollup_counts(counts, level, onlygermany, base_dir)
+    layer['NAME'] = layer['REGION_ID'].map(names)
+    layer['NUMPOINTS'] = layer['REGION_ID'].map(totals).fillna(0).astype(int)
+    return layer
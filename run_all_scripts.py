@@ -1,9 +1,17 @@
-import subprocess
+import os
+import time
+from datetime import datetime
 import extract_csv_files
 import split_csv_by_day
 import add_ice_export_to_csv
 import cleanup_for_speed
 import ccc_event_filter
+import stage_scheduler
+import instrumentation
+
+# First day of the cumulative points and of the frames (YYYYMMDD). Both stages need the same one,
+# the frames are rendered while the days are counted (see streams below).
+start_date = '20200101'
 
 # Configuration variables that will be passed to scripts
 config = {
@@ -26,12 +34,13 @@ config = {
     },
     'calculate_speed_and_filter': {
         'run': True,       # Whether to run this script
-        'overwrite': False  # Whether to overwrite existing filtered data
+        'overwrite': False,  # Whether to overwrite existing filtered data
+        'tag_regions': False  # Whether to tag the points with their region (layer from onlygermany of the count scripts)
     },
     'cumulative_points': {
         'run': True,       # Whether to run this script
         'overwrite': False,  # Whether to overwrite existing cumulative points
-        'start_date': '20200101'  # Start date for processing
+        'start_date': start_date  # Start date for processing
     },
     'combine_points_yearly': {
         'run': True,       # Whether to run this script
@@ -43,12 +52,12 @@ config = {
     },
     'visualize_cumulative_points_with_counts': {
         'run': True,       # Whether to run this script
-        'overwrite': False,  # Whether to overwrite existing visualizations
-        'progress_tracking': False  # Whether to track progress
+        'overwrite': False  # Whether to overwrite existing visualizations
     },
     'visualize_points_geopandas': {
         'run': True,       # Whether to run this script
-        'overwrite': False  # Whether to overwrite existing visualizations
+        'overwrite': False,  # Whether to overwrite existing visualizations
+        'start_date': start_date  # First day with a frame
     },
     'visualize_points_geopandas_yearly_new': {
         'run': True,       # Whether to run this script
@@ -70,83 +79,141 @@ prepare_data = [
     # No scripts here as we're now calling split_csv_by_day as a module
 ]
 
-# Define the scripts to run. This assumes that csv files are in the folder `csv` (and named yyyymmdd.csv)
+# Define the stages to run, in order. This assumes that csv files are in the folder `csv` (and named yyyymmdd.csv).
+# Every stage is a module with a main(context) function (see pipeline_context.py).
 scripts = [
     # Script to calculate speed and filter data
-    'calculate_speed_and_filter.py',
+    'calculate_speed_and_filter',
     # Script to create cumulative points files
-    'cumulative_points.py',
+    'cumulative_points',
     # Combine the points
-    'combine_points_yearly.py',
+    'combine_points_yearly',
     # Script to visualize counts to cumulative points
-    'visualize_points_with_counts.py',
+    'visualize_points_with_counts',
     # Script to visualize counts to cumulative points
-    'visualize_cumulative_points_with_counts.py',
+    'visualize_cumulative_points_with_counts',
     # Script to visualize points with geopandas
-    'visualize_points_geopandas.py',
+    'visualize_points_geopandas',
     # and yearly
-    'visualize_points_geopandas_yearly_new.py',
+    'visualize_points_geopandas_yearly_new',
     # create cropped images (square and vertical)
-    'create_cropped_images.py',
+    'create_cropped_images',
     # Script to create videos from images
-    'create_video_from_images.py'
+    'create_video_from_images'
 ]
 
-# Run extract_csv_files as a module if enabled
-if config['extract_csv_files']['run']:
-    print("Running extract_csv_files as a module...")
-    extract_csv_files.main(overwrite=config['extract_csv_files']['overwrite'])
-    print("Finished running extract_csv_files.")
-else:
-    print("Skipping extract_csv_files (disabled in config)")
-
-# Run split_csv_by_day as a module if enabled
-if config['split_csv_by_day']['run']:
-    print("Running split_csv_by_day as a module...")
-    split_csv_by_day.main()
-    print("Finished running split_csv_by_day.")
-else:
-    print("Skipping split_csv_by_day (disabled in config)")
-
-# Run add_ice_export_to_csv as a module if enabled
-if config['add_ice_export_to_csv']['run']:
-    print("Running add_ice_export_to_csv as a module...")
-    add_ice_export_to_csv.process_csv_directory()
-    print("Finished running add_ice_export_to_csv.")
-else:
-    print("Skipping add_ice_export_to_csv (disabled in config)")
-
-# Run cleanup_for_speed as a module if enabled
-if config['cleanup_for_speed']['run']:
-    print("Running cleanup_for_speed as a module...")
-    cleanup_for_speed.process_csv_directory()
-    print("Finished running cleanup_for_speed.")
-else:
-    print("Skipping cleanup_for_speed (disabled in config)")
-
-# Run ccc_event_filter as a module if enabled
-if config['ccc_event_filter']['run']:
-    print("Running ccc_event_filter as a module...")
-    ccc_event_filter.main()
-    print("Finished running ccc_event_filter.")
-else:
-    print("Skipping ccc_event_filter (disabled in config)")
-
-# Execute each main script in sequence if enabled
-for script_name in scripts:
-    script_base_name = script_name.replace('.py', '')
-    if script_base_name in config and config[script_base_name]['run']:
-        print(f"Running {script_name}...")
-        
-        # Pass overwrite parameter to scripts that support it
-        if script_base_name == 'create_cropped_images' and 'overwrite' in config[script_base_name]:
-            overwrite_value = str(config[script_base_name]['overwrite']).lower()
-            subprocess.run(['python3', script_name, overwrite_value], check=True)
-        else:
-            subprocess.run(['python3', script_name], check=True)
-            
-        print(f"Finished running {script_name}.")
+# The stages each stage needs to be finished first. After calculate_speed_and_filter, the yearly
+# images and the daily frames with their videos are two independent branches.
+dependencies = {
+    'cumulative_points': ['calculate_speed_and_filter'],
+    'combine_points_yearly': ['calculate_speed_and_filter'],
+    'visualize_points_with_counts': ['combine_points_yearly'],
+    'visualize_cumulative_points_with_counts': ['cumulative_points'],
+    'visualize_points_geopandas': ['visualize_cumulative_points_with_counts'],
+    'visualize_points_geopandas_yearly_new': ['visualize_points_with_counts'],
+    'create_cropped_images': ['visualize_points_geopandas'],
+    'create_video_from_images': ['create_cropped_images'],
+}
+
+# Stages that start together with the stage they depend on and render each day as soon as it is
+# counted, instead of waiting for all days
+streams = {
+    'visualize_points_geopandas': 'visualize_cumulative_points_with_counts',
+}
+
+# Stages that spread their work over worker processes, they share the CPUs the other stages leave
+parallel_stages = ['visualize_points_geopandas', 'visualize_points_geopandas_yearly_new', 'create_cropped_images']
+
+# Number of CPUs all stages together may use. Independent branches run at the same time in their
+# own processes (see stage_scheduler.py). With 1 all stages run one after another in this process.
+cpu_budget = os.cpu_count() or 1
+
+# Every run writes a report with the time, CPU, memory and I/O of each stage and of its units
+# (days, years, frames, videos) to report_dir/run_<date>_<time>.json and a summary to .txt
+report_dir = 'reports'
+
+# Stage to profile (e.g. 'visualize_cumulative_points_with_counts'), None for no profile. The profile
+# is written next to the report: profile_mode 'cprofile' writes a .prof file for snakeviz/pstats,
+# 'sampling' samples the stack every profile_interval seconds into collapsed stacks for a flame graph.
+profile_stage = None
+profile_mode = 'cprofile'
+profile_interval = 0.005
+
+
+def main():
+    run = instrumentation.run_id()
+    started = datetime.now().isoformat(timespec='seconds')
+    wall_start = time.perf_counter()
+    records = []
+
+    # Run extract_csv_files as a module if enabled
+    if config['extract_csv_files']['run']:
+        print("Running extract_csv_files as a module...")
+        with instrumentation.measure_stage('extract_csv_files') as record:
+            extract_csv_files.main(overwrite=config['extract_csv_files']['overwrite'])
+        records.append(record)
+        print("Finished running extract_csv_files.")
+    else:
+        print("Skipping extract_csv_files (disabled in config)")
+
+    # Run split_csv_by_day as a module if enabled
+    if config['split_csv_by_day']['run']:
+        print("Running split_csv_by_day as a module...")
+        with instrumentation.measure_stage('split_csv_by_day') as record:
+            split_csv_by_day.main()
+        records.append(record)
+        print("Finished running split_csv_by_day.")
     else:
-        print(f"Skipping {script_name} (disabled in config)")
+        print("Skipping split_csv_by_day (disabled in config)")
+
+    # Run add_ice_export_to_csv as a module if enabled
+    if config['add_ice_export_to_csv']['run']:
+        print("Running add_ice_export_to_csv as a module...")
+        with instrumentation.measure_stage('add_ice_export_to_csv') as record:
+            add_ice_export_to_csv.process_csv_directory()
+        records.append(record)
+        print("Finished running add_ice_export_to_csv.")
+    else:
+        print("Skipping add_ice_export_to_csv (disabled in config)")
+
+    # Run cleanup_for_speed as a module if enabled
+    if config['cleanup_for_speed']['run']:
+        print("Running cleanup_for_speed as a module...")
+        with instrumentation.measure_stage('cleanup_for_speed') as record:
+            cleanup_for_speed.process_csv_directory()
+        records.append(record)
+        print("Finished running cleanup_for_speed.")
+    else:
+        print("Skipping cleanup_for_speed (disabled in config)")
+
+    # Run ccc_event_filter as a module if enabled
+    if config['ccc_event_filter']['run']:
+        print("Running ccc_event_filter as a module...")
+        with instrumentation.measure_stage('ccc_event_filter') as record:
+            ccc_event_filter.main()
+        records.append(record)
+        print("Finished running ccc_event_filter.")
+    else:
+        print("Skipping ccc_event_filter (disabled in config)")
+
+    # Execute the enabled stages, independent ones at the same time
+    profile = None
+    if profile_stage is not None:
+        os.makedirs(report_dir, exist_ok=True)
+        profile = {'stage': profile_stage, 'mode': profile_mode, 'interval': profile_interval,
+                   'path': os.path.join(report_dir, f'{run}_{profile_stage}')}
+    records += stage_scheduler.run_stages(scripts, dependencies, config, cpu_budget, streams, parallel_stages, profile)
+
+    print("All scripts executed successfully.")
+    instrumentation.write_report({
+        'run': run,
+        'started': started,
+        'wall': time.perf_counter() - wall_start,
+        'cpu_budget': cpu_budget,
+        'stages': records,
+    }, report_dir)
+
 
-print("All scripts executed successfully.")
+# The stages start their worker processes with spawn, which imports this file again in every worker
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import os
+import json
+import tempfile
+import importlib
+import multiprocessing
+from multiprocessing.connection import wait
+import build_engine
+import pipeline_context
+import instrumentation
+
+
+def run_stage(stage, context, profile=None):
+    """Run the main() of one stage, measured (see instrumentation.py). Returns its record."""
+    print(f"Running {stage}...")
+    if profile is not None and profile['stage'] != stage:
+        profile = None
+    with instrumentation.measure_stage(stage, profile) as record:
+        importlib.import_module(stage).main(context)
+    print(f"Finished running {stage} in {record['wall']:.1f} s.")
+    return record
+
+
+def run_group(stages, config, base_dir='.', workers=None, streaming=(), producers=(), profile=None, records_path=None):
+    """
+    Run stages one after another in this process with one context and return their records.
+    streaming are the stages running at the same time in other processes that these stages may wait
+    for, producers the stages of this group that others wait for (they are marked as ended as soon
+    as they return). The records are also written to records_path, for the process that started this one.
+    """
+    records = []
+    try:
+        with pipeline_context.PipelineContext(config, base_dir, workers, streaming) as context:
+            for stage in stages:
+                records.append(run_stage(stage, context, profile))
+                if stage in producers:
+                    build_engine.finish_progress(stage, base_dir)
+    finally:
+        if records_path is not None:
+            with open(records_path, 'w') as f:
+                json.dump(records, f)
+    return records
+
+
+def enabled_dependencies(stage, dependencies, enabled):
+    """The enabled stages a stage waits for. A disabled stage is replaced by the stages it waits for."""
+    needs = []
+    for dependency in dependencies.get(stage, []):
+        found = [dependency] if dependency in enabled else enabled_dependencies(dependency, dependencies, enabled)
+        needs += [need for need in found if need not in needs]
+    return needs
+
+
+def stage_groups(stages, dependencies, streams):
+    """
+    Split the stages (in the order they would run one after another) into groups that run in one
+    process each: a stage joins the group of the stage before it if that is the only stage it waits
+    for and no other stage waits for that one. A stage in streams starts a group of its own.
+    """
+    groups = []
+    group_of = {}
+    for stage in stages:
+        needs = dependencies[stage]
+        if len(needs) == 1 and stage not in streams:
+            previous = needs[0]
+            dependents = [other for other in stages if previous in dependencies[other]]
+            if dependents == [stage] and groups[group_of[previous]][-1] == previous:
+                group_of[stage] = group_of[previous]
+                groups[group_of[stage]].append(stage)
+                continue
+        group_of[stage] = len(groups)
+        groups.append([stage])
+    return groups
+
+
+def run_stages(stages, dependencies, config, cpu_budget=1, streams=None, parallel_stages=(), profile=None, base_dir='.'):
+    """
+    Run the enabled stages (config[stage]['run']) in the order of their dependencies.
+
+    With a cpu_budget of 1 they run one after another in this process. Otherwise every group of
+    stages (see stage_groups) runs in its own process as soon as the stages it waits for are done,
+    so independent branches run at the same time. A group without parallel_stages (stages with
+    worker processes) gets one CPU, the others share the CPUs that are free when they start, which
+    limits the worker processes of their stages. A stage in streams (consumer:
+    producer) starts together with its producer and waits for each of the producer's units as it
+    needs them (see build_engine.wait_for_unit), instead of waiting for the whole producer.
+
+    Returns the records of the stages that ran (see instrumentation.measure_stage). profile is None
+    or the 'stage' to profile with the 'path', 'mode' and 'interval' of instrumentation.profile_stage.
+    """
+    enabled = [stage for stage in stages if config.get(stage, {}).get('run', True)]
+    for stage in stages:
+        if stage not in enabled:
+            print(f"Skipping {stage} (disabled in config)")
+
+    if cpu_budget <= 1:
+        return run_group(enabled, config, base_dir, profile=profile)
+
+    needs = {stage: enabled_dependencies(stage, dependencies, enabled) for stage in enabled}
+    streams = {consumer: producer for consumer, producer in (streams or {}).items() if consumer in enabled and producer in needs[consumer]}
+    producers = set(streams.values())
+    groups = stage_groups(enabled, needs, streams)
+
+    def ready(group):
+        first = group[0]
+        if first in streams:
+            # Starts with the group of its producer, the other stages it waits for have to be done
+            return streams[first] in started and all(need in done for need in needs[first] if need != streams[first])
+        return all(need in done for need in needs[first])
+
+    mp_context = multiprocessing.get_context('spawn')
+    waiting = list(groups)
+    running = {}  # process: (group, cpus)
+    started, done, failed = set(), set(), []
+    free = cpu_budget
+    records_dir = tempfile.TemporaryDirectory()
+    try:
+        while waiting or running:
+            # Start groups while CPUs are free, a started producer can make its consumer ready
+            while not failed and free >= 1:
+                startable = [group for group in waiting if ready(group)]
+                if not startable:
+                    break
+                group = startable[0]
+                parallel = [other for other in startable if any(stage in parallel_stages for stage in other)]
+                cpus = 1
+                if group in parallel:
+                    cpus = max(1, (free - (len(startable) - len(parallel))) // len(parallel))
+                for stage in group:
+                    if stage in producers:
+                        build_engine.start_progress(stage, base_dir)
+                streaming = [streams[stage] for stage in group if stage in streams]
+                records_path = os.path.join(records_dir.name, f'{groups.index(group)}.json')
+                process = mp_context.Process(target=run_group, args=(group, config, base_dir, cpus, streaming, producers, profile, records_path))
+                process.start()
+                print(f"Started {', '.join(group)} with {cpus} of {cpu_budget} CPUs")
+                running[process] = (group, cpus)
+                waiting.remove(group)
+                started.update(group)
+                free -= cpus
+            if not running:
+                break
+            wait([process.sentinel for process in running])
+            for process in [process for process in running if not process.is_alive()]:
+                process.join()
+                group, cpus = running.pop(process)
+                free += cpus
+                for stage in group:
+                    if stage in producers:
+                        # Also when it failed, so nothing waits for it forever
+                        build_engine.finish_progress(stage, base_dir)
+                if process.exitcode == 0:
+                    done.update(group)
+                else:
+                    print(f"{', '.join(group)} failed (exit code {process.exitcode}), no further stages are started.")
+                    failed.append(group)
+        records = []
+        for index in range(len(groups)):
+            records_path = os.path.join(records_dir.name, f'{index}.json')
+            if os.path.exists(records_path):
+                with open(records_path, 'r') as f:
+                    records += json.load(f)
+    finally:
+        records_dir.cleanup()
+        for stage in producers:
+            build_engine.stop_progress(stage, base_dir)
+
+    if failed or waiting:
+        raise RuntimeError(f"Stages did not finish: {', '.join(stage for group in failed + waiting for stage in group)}")
+    return sorted(records, key=lambda record: enabled.index(record['stage']))
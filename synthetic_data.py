@@ -0,0 +1,296 @@
+import os
+import io
+import sys
+import csv
+import json
+import math
+import random
+import zipfile
+from datetime import datetime, timedelta
+import extract_csv_files
+
+# Folder the data is written to, laid out like the project folder: GPSLogger zips in /gps, WifiOnICE
+# status files in /trips and exclusion.json. The pipeline can be run in that folder as it is.
+output_dir = os.path.join('.', 'synthetic')
+
+# Number of days, ending today (cumulative_points.py and visualize_points_geopandas.py go up to today)
+days = 30
+
+# Seconds between two logged points (GPSLogger's logging interval)
+log_interval = 30
+
+# How often each kind of day occurs (relative weights)
+travel_patterns = {
+    'home': 3,     # at home, with a walk in the afternoon
+    'commute': 4,  # by car to work and back
+    'train': 2,    # by ICE to another city and back, with WifiOnICE status files on board
+    'trip': 1,     # by car to another city, a walk there and back
+}
+
+# Share of the days logged as GPX instead of CSV (both end up in the zip of the day in /gps)
+gpx_share = 0.2
+
+# Share of the days with an excluded timeframe in exclusion.json
+exclusion_share = 0.1
+
+# Share of the points replaced by a far off network fix, like the jumps cleanup_for_speed.py removes
+outlier_share = 0.005
+
+# Seconds between two WifiOnICE status files on a train
+ice_interval = 60
+
+# The same seed gives the same data (for the same days)
+seed = 1
+
+# Home of the person logging, and the cities trains and trips go to (name, lat, lon)
+home = (52.5200, 13.4050)
+CITIES = [
+    ('Hamburg', 53.5511, 9.9937),
+    ('Hannover', 52.3759, 9.7320),
+    ('Leipzig', 51.3397, 12.3731),
+    ('Dresden', 51.0504, 13.7373),
+    ('Frankfurt', 50.1109, 8.6821),
+    ('Köln', 50.9375, 6.9603),
+    ('Nürnberg', 49.4521, 11.0767),
+    ('München', 48.1351, 11.5820),
+]
+
+# Average speeds in km/h
+SPEEDS = {'walk': 5, 'car': 60, 'motorway': 100, 'ice': 180}
+
+
+def distance_km(a, b):
+    """Great circle distance between two (lat, lon) points in km."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371 * math.asin(math.sqrt(h))
+
+
+def offset(point, km_north, km_east):
+    """Point moved by the given km to the north and east."""
+    return (point[0] + km_north / 111.32, point[1] + km_east / (111.32 * math.cos(math.radians(point[0]))))
+
+
+class DayPlan:
+    """The legs of a day: stays at a place and moves from one place to another, one after another."""
+
+    def __init__(self, start):
+        self.time = start
+        self.place = home
+        self.legs = []  # (start, end, from, to, mode), mode None for a stay
+
+    def stay(self, until):
+        if until > self.time:
+            self.legs.append((self.time, until, self.place, self.place, None))
+            self.time = until
+
+    def move(self, to, mode):
+        duration = timedelta(hours=distance_km(self.place, to) / SPEEDS[mode])
+        self.legs.append((self.time, self.time + duration, self.place, to, mode))
+        self.time += duration
+        self.place = to
+
+    def position(self, moment):
+        """(lat, lon, mode) at a moment of the day, None before the first and after the last leg."""
+        for start, end, a, b, mode in self.legs:
+            if start <= moment < end:
+                fraction = (moment - start) / (end - start)
+                return a[0] + (b[0] - a[0]) * fraction, a[1] + (b[1] - a[1]) * fraction, mode
+        return None
+
+
+def plan_day(day, pattern, work, rng):
+    """Plan a day of the given travel pattern, starting and ending at home."""
+    plan = DayPlan(day + timedelta(hours=6, minutes=rng.randint(0, 59)))
+    if pattern == 'commute':
+        plan.stay(day + timedelta(hours=7, minutes=rng.randint(0, 59)))
+        plan.move(work, 'car')
+        plan.stay(plan.time + timedelta(hours=8, minutes=rng.randint(0, 90)))
+        plan.move(home, 'car')
+    elif pattern in ('train', 'trip'):
+        _, lat, lon = rng.choice(CITIES)
+        mode = 'ice' if pattern == 'train' else 'motorway'
+        plan.stay(day + timedelta(hours=7, minutes=rng.randint(0, 59)))
+        plan.move((lat, lon), mode)
+        plan.stay(plan.time + timedelta(minutes=30))
+        walk_to = offset((lat, lon), rng.uniform(-2, 2), rng.uniform(-2, 2))
+        plan.move(walk_to, 'walk')
+        plan.move((lat, lon), 'walk')
+        plan.stay(max(plan.time + timedelta(minutes=30), day + timedelta(hours=15, minutes=rng.randint(0, 120))))
+        plan.move(home, mode)
+    else:
+        plan.stay(day + timedelta(hours=14, minutes=rng.randint(0, 120)))
+        park = offset(home, rng.uniform(-3, 3), rng.uniform(-3, 3))
+        plan.move(park, 'walk')
+        plan.stay(plan.time + timedelta(minutes=rng.randint(10, 60)))
+        plan.move(home, 'walk')
+    plan.stay(max(plan.time + timedelta(hours=1), day + timedelta(hours=22)))
+    return plan
+
+
+def format_time(moment):
+    """GPSLogger time, e.g. 2024-03-19T23:12:40.600Z"""
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.') + f'{moment.microsecond // 1000:03d}Z'
+
+
+def log_points(plan, rng):
+    """The points GPSLogger would log for a planned day, as rows with the columns of extract_csv_files.csv_headers."""
+    rows = []
+    moment = plan.legs[0][0]
+    end = plan.legs[-1][1]
+    battery = rng.randint(80, 100)
+    start_ms = int(moment.timestamp() * 1000)
+    while moment < end:
+        lat, lon, mode = plan.position(moment)
+        # Inside a train the phone mostly gets network fixes, and many are missing
+        on_train = mode == 'ice'
+        if on_train and rng.random() < 0.5:
+            moment += timedelta(seconds=log_interval)
+            continue
+        provider = 'network' if on_train or rng.random() < 0.1 else 'gps'
+        accuracy = rng.uniform(20, 1500) if provider == 'network' else rng.uniform(3, 15)
+        jitter = accuracy / 3 / 1000
+        if rng.random() < outlier_share:
+            # A far off fix, tens of km away
+            lat, lon = offset((lat, lon), rng.uniform(-80, 80), rng.uniform(-80, 80))
+            provider = 'network'
+        else:
+            lat, lon = offset((lat, lon), rng.gauss(0, jitter), rng.gauss(0, jitter))
+        speed = SPEEDS[mode] / 3.6 * rng.uniform(0.7, 1.3) if mode else 0.0
+        timestamp_ms = int(moment.timestamp() * 1000)
+        rows.append({
+            'time': format_time(moment), 'lat': f'{lat:.7f}', 'lon': f'{lon:.7f}',
+            'elevation': f'{rng.uniform(30, 120):.1f}', 'accuracy': f'{accuracy:.1f}',
+            'bearing': f'{rng.uniform(0, 360):.1f}' if mode else '', 'speed': f'{speed:.2f}' if provider == 'gps' else '',
+            'satellites': rng.randint(6, 14) if provider == 'gps' else 0, 'provider': provider,
+            'hdop': f'{rng.uniform(0.6, 2.5):.1f}' if provider == 'gps' else '', 'vdop': '', 'pdop': '',
+            'geoidheight': '', 'ageofdgpsdata': '', 'dgpsid': '', 'activity': '',
+            'battery': battery, 'annotation': '', 'timestamp_ms': timestamp_ms, 'time_offset': '',
+            'distance': '', 'starttimestamp_ms': start_ms, 'profile_name': 'Default Profile', 'battery_charging': 'false',
+        })
+        if rng.random() < 0.02:
+            battery = max(5, battery - 1)
+        moment += timedelta(seconds=log_interval, milliseconds=rng.randint(0, 999))
+    return rows
+
+
+def csv_text(rows):
+    """The rows as a GPSLogger CSV file."""
+    text = io.StringIO()
+    writer = csv.DictWriter(text, fieldnames=extract_csv_files.csv_headers)
+    writer.writeheader()
+    writer.writerows(rows)
+    return text.getvalue()
+
+
+def gpx_text(rows):
+    """The rows as a GPSLogger GPX 1.0 file."""
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>',
+        '<gpx version="1.0" creator="GPSLogger 131 - http://gpslogger.mendhak.com/" xmlns="http://www.topografix.com/GPX/1/0">',
+        f'<time>{rows[0]["time"]}</time><trk><trkseg>',
+    ]
+    for row in rows:
+        point = [f'<trkpt lat="{row["lat"]}" lon="{row["lon"]}"><ele>{row["elevation"]}</ele><time>{row["time"]}</time>']
+        if row['speed']:
+            point.append(f'<speed>{row["speed"]}</speed>')
+        point.append(f'<src>{row["provider"]}</src>')
+        if row['hdop']:
+            point.append(f'<sat>{row["satellites"]}</sat><hdop>{row["hdop"]}</hdop>')
+        point.append('</trkpt>')
+        lines.append(''.join(point))
+    lines.append('</trkseg></trk></gpx>')
+    return '\n'.join(lines) + '\n'
+
+
+def write_day_zip(gps_dir, date_str, rows, as_gpx):
+    """Write the points of a day like GPSLogger's zip upload: /gps/<date>.zip with <date>.csv or <date>.gpx."""
+    with zipfile.ZipFile(os.path.join(gps_dir, f'{date_str}.zip'), 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        if as_gpx:
+            zip_file.writestr(f'{date_str}.gpx', gpx_text(rows))
+        else:
+            zip_file.writestr(f'{date_str}.csv', csv_text(rows))
+
+
+def write_ice_status(trips_dir, date_str, plan, rng):
+    """Write a WifiOnICE status file (/trips/<date>/<ms>_status.json) every ice_interval seconds on a train. Returns their number."""
+    day_dir = os.path.join(trips_dir, date_str)
+    count = 0
+    train = rng.choice(['401', '403', '407', '412'])
+    for start, end, _, _, mode in plan.legs:
+        if mode != 'ice':
+            continue
+        os.makedirs(day_dir, exist_ok=True)
+        tzn = f'Tz{rng.randint(100, 9999)}'
+        moment = start
+        while moment < end:
+            lat, lon, _ = plan.position(moment)
+            # add_ice_export_to_csv.py reads the time from the file name, in local time like the portal
+            timestamp_ms = int(moment.timestamp() * 1000)
+            status = {
+                'connection': True, 'serviceLevel': 'AVAILABLE_SERVICE', 'gpsStatus': 'VALID', 'internet': 'HIGH',
+                'latitude': round(lat, 6), 'longitude': round(lon, 6), 'tileY': 0, 'tileX': 0,
+                'series': train, 'serverTime': timestamp_ms, 'speed': round(SPEEDS['ice'] * rng.uniform(0.6, 1.4), 1),
+                'trainType': 'ICE', 'tzn': tzn, 'wagonClass': 'SECOND', 'connectivity': {'currentState': 'HIGH'},
+                'bapInstalled': True,
+            }
+            with open(os.path.join(day_dir, f'{timestamp_ms}_status.json'), 'w') as f:
+                json.dump(status, f)
+            count += 1
+            moment += timedelta(seconds=ice_interval)
+    return count
+
+
+def exclusion_timeframe(plan, rng):
+    """An hour or two of a day to exclude, in the format of exclusion.json."""
+    first, last = plan.legs[0][0], plan.legs[-1][1]
+    start = first + (last - first) * rng.uniform(0, 0.8)
+    end = min(last, start + timedelta(minutes=rng.randint(60, 120)))
+    return {'start': start.strftime('%Y-%m-%d %H:%M:%S.000Z'), 'end': end.strftime('%Y-%m-%d %H:%M:%S.000Z')}
+
+
+def generate(target_dir=None, day_count=None, end_date=None, patterns=None, random_seed=None):
+    """
+    Write day_count days of synthetic location data ending on end_date (default: today) into
+    target_dir, with the variables above as defaults. Returns the numbers of days, points, WifiOnICE
+    status files, GPX days and excluded timeframes.
+    """
+    target_dir = output_dir if target_dir is None else target_dir
+    day_count = days if day_count is None else day_count
+    patterns = travel_patterns if patterns is None else patterns
+    rng = random.Random(seed if random_seed is None else random_seed)
+    end_date = datetime.combine((end_date or datetime.now()).date(), datetime.min.time())
+
+    gps_dir = os.path.join(target_dir, 'gps')
+    trips_dir = os.path.join(target_dir, 'trips')
+    os.makedirs(gps_dir, exist_ok=True)
+
+    work = offset(home, rng.uniform(-12, 12), rng.uniform(-12, 12))
+    stats = {'days': day_count, 'points': 0, 'ice_status_files': 0, 'gpx_days': 0, 'excluded_timeframes': 0}
+    timeframes = []
+    for index in range(day_count):
+        day = end_date - timedelta(days=day_count - 1 - index)
+        date_str = day.strftime('%Y%m%d')
+        pattern = rng.choices(list(patterns), weights=list(patterns.values()))[0]
+        plan = plan_day(day, pattern, work, rng)
+        rows = log_points(plan, rng)
+        as_gpx = rng.random() < gpx_share
+        write_day_zip(gps_dir, date_str, rows, as_gpx)
+        stats['points'] += len(rows)
+        stats['gpx_days'] += as_gpx
+        stats['ice_status_files'] += write_ice_status(trips_dir, date_str, plan, rng)
+        if rng.random() < exclusion_share:
+            timeframes.append(exclusion_timeframe(plan, rng))
+        print(f"{date_str}: {pattern}, {len(rows)} points{' (GPX)' if as_gpx else ''}")
+
+    with open(os.path.join(target_dir, 'exclusion.json'), 'w') as f:
+        json.dump({'times': timeframes}, f, indent=4)
+    stats['excluded_timeframes'] = len(timeframes)
+    stats['points'] += stats['ice_status_files']
+    return stats
+
+
+if __name__ == '__main__':
+    stats = generate(day_count=int(sys.argv[1]) if len(sys.argv) > 1 else None)
+    print(f"Wrote {stats['days']} days with {stats['points']} points ({stats['ice_status_files']} from WifiOnICE, "
+          f"{stats['gpx_days']} days as GPX) and {stats['excluded_timeframes']} excluded timeframes to {output_dir}")
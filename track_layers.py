@@ -0,0 +1,255 @@
+import os
+import math
+from collections import deque
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgb
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import build_cache
+
+
+def read_day_lines(all_dir, day):
+    """Read the lines of one day from /all, reprojected to EPSG:3857. None if there is no file for that day."""
+    geojson_path = os.path.join(all_dir, f'{day.strftime("%Y%m%d")}_all.geojson')
+    if not os.path.exists(geojson_path):
+        return None
+    gdf = gpd.read_file(geojson_path)
+    gdf.set_crs(epsg=4326, inplace=True)
+    return gdf.to_crs(epsg=3857).geometry
+
+
+def alpha_ramp(count, alpha_min=0.1, alpha_max=1.0):
+    """Return `count` alpha values rising evenly from alpha_min (oldest) to alpha_max (newest)."""
+    if count == 1:
+        return [alpha_max]
+    return [alpha_min + ((alpha_max - alpha_min) * idx / (count - 1)) for idx in range(count)]
+
+
+class TrailWindow:
+    """
+    The reprojected lines of the last `days` days, kept in a deque while the frames move forward.
+
+    Moving to the next day reads only the day that enters the window and drops the one that
+    leaves it, instead of reading all days of the window again for every frame.
+    """
+
+    def __init__(self, all_dir, days=10, start_date=None):
+        self.all_dir = all_dir
+        self.days = days
+        self.start_date = pd.to_datetime(start_date) if start_date is not None else None
+        self.entries = deque()  # (day, lines or None), oldest first, one entry per day
+
+    def advance(self, date_str):
+        """Move the window to end at date_str (YYYYMMDD) and return the line layers in it, oldest first."""
+        date = pd.to_datetime(date_str, format='%Y%m%d')
+        first_day = date - timedelta(days=self.days - 1)
+
+        # Start over when going back in time, otherwise drop the days that left the window
+        if self.entries and self.entries[-1][0] > date:
+            self.entries.clear()
+        while self.entries and self.entries[0][0] < first_day:
+            self.entries.popleft()
+
+        day = self.entries[-1][0] + timedelta(days=1) if self.entries else first_day
+        while day <= date:
+            if self.start_date is not None and day < self.start_date:
+                lines = None  # Skip days before the start date
+            else:
+                lines = read_day_lines(self.all_dir, day)
+            self.entries.append((day, lines))
+            day += timedelta(days=1)
+
+        return [lines for _, lines in self.entries if lines is not None]
+
+
+def plot_trail(ax, layers, color='blue', alpha_min=0.1, alpha_max=1.0):
+    """Plot the line layers of a trail with alpha values rising from the oldest to the newest day."""
+    if len(layers) < 2:
+        return
+    for lines, alpha_value in zip(layers, alpha_ramp(len(layers), alpha_min, alpha_max)):
+        lines.plot(ax=ax, color=color, alpha=alpha_value)
+
+
+def line_segments(geoms):
+    """Return the coordinate arrays of all LineString parts of the given geometries."""
+    parts = shapely.get_parts(np.asarray(geoms))
+    parts = parts[shapely.get_type_id(parts) == shapely.GeometryType.LINESTRING]
+    if not len(parts):
+        return []
+    coords, index = shapely.get_coordinates(parts, return_index=True)
+    splits = np.flatnonzero(np.diff(index)) + 1
+    return np.split(coords, splits)
+
+
+def fade_days(decay):
+    """Number of days after which a line multiplied by decay every day has faded below 1/255."""
+    if decay <= 0:
+        return 1
+    return max(1, math.ceil(math.log(1 / 255) / math.log(decay)))
+
+
+class TrailRaster:
+    """
+    A fading trail of track lines kept as a float raster at frame resolution.
+
+    For every day the raster is multiplied by `decay` and the lines of that day are rasterized
+    and composited over it, so a frame costs one day of lines however long the trail is. When
+    it jumps to a date (e.g. the first frame of a worker), it starts from the day where older
+    lines would have faded below one step of an 8 bit alpha channel, so any frame gets the
+    same trail as in a run that went through all days.
+    """
+
+    def __init__(self, all_dir, extent, width, height, decay=0.75, start_date=None, linewidth=1.5, dpi=100):
+        self.all_dir = all_dir
+        self.extent = extent
+        self.decay = decay
+        self.start_date = pd.to_datetime(start_date) if start_date is not None else None
+        self.buffer = np.zeros((height, width), dtype=np.float32)
+        self.day = None  # The last day added to the buffer
+
+        # Figure the lines of one day are rasterized in, covering exactly the extent of the frame
+        self.figure = Figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+        self.figure.patch.set_alpha(0)
+        self.canvas = FigureCanvasAgg(self.figure)
+        ax = self.figure.add_axes([0, 0, 1, 1])
+        ax.set_axis_off()
+        ax.set_xlim(extent[0], extent[1])
+        ax.set_ylim(extent[2], extent[3])
+        self.lines = LineCollection([], colors='black', linewidths=linewidth)
+        ax.add_collection(self.lines, autolim=False)
+
+    def warmup_days(self):
+        """Number of days after which a line has faded below 1/255."""
+        return fade_days(self.decay)
+
+    def rasterize(self, lines):
+        """Return the coverage (0..1) of the frame pixels by the given lines."""
+        self.lines.set_segments(line_segments(lines.values))
+        self.canvas.draw()
+        return np.asarray(self.canvas.buffer_rgba())[:, :, 3].astype(np.float32) / 255
+
+    def advance(self, date_str):
+        """Add all days up to date_str (YYYYMMDD) to the trail and return the raster."""
+        date = pd.to_datetime(date_str, format='%Y%m%d')
+        warmup = self.warmup_days()
+        if self.day is None or date < self.day or (date - self.day).days > warmup:
+            self.buffer[:] = 0
+            self.day = date - timedelta(days=warmup)
+
+        while self.day < date:
+            self.day += timedelta(days=1)
+            self.buffer *= self.decay
+            if self.start_date is not None and self.day < self.start_date:
+                continue
+            lines = read_day_lines(self.all_dir, self.day)
+            if lines is None or lines.empty:
+                continue
+            coverage = self.rasterize(lines)
+            # New lines over the faded ones, like drawing them with this alpha on top
+            self.buffer *= 1 - coverage
+            self.buffer += coverage
+        return self.buffer
+
+    def overlay(self, color='blue'):
+        """
+        Return (RGBA image, extent) of the trail in the given color, cropped to the pixels that
+        have lines in them, or None if there are none.
+        """
+        alpha = np.round(self.buffer * 255).astype(np.uint8)
+        rows = np.flatnonzero(alpha.any(axis=1))
+        columns = np.flatnonzero(alpha.any(axis=0))
+        if not len(rows):
+            return None
+        top, bottom = rows[0], rows[-1] + 1
+        left, right = columns[0], columns[-1] + 1
+        image = np.empty((bottom - top, right - left, 4), dtype=np.uint8)
+        image[:, :, :3] = np.round(np.array(to_rgb(color)) * 255).astype(np.uint8)
+        image[:, :, 3] = alpha[top:bottom, left:right]
+
+        xmin, xmax, ymin, ymax = self.extent
+        height, width = self.buffer.shape
+        x_step = (xmax - xmin) / width
+        y_step = (ymax - ymin) / height
+        # Row 0 is the top of the frame
+        extent = (xmin + left * x_step, xmin + right * x_step, ymax - bottom * y_step, ymax - top * y_step)
+        return image, extent
+
+
+def year_lines_path(base_dir, year):
+    """Path of the merged lines of one year (see update_year_lines)."""
+    return os.path.join(base_dir, build_cache.cache_dir, 'year_lines', f'{year}.npz')
+
+
+def merge_line_files(geojson_files, simplify_tolerance=None):
+    """
+    Read line files (in date order), reproject them to EPSG:3857 and merge them into one layer:
+    the coordinates of all lines in one array, the offsets where each line starts and the index
+    of the file every line came from. Lines are simplified by simplify_tolerance (in metres) if set.
+    """
+    segments = []
+    files = []
+    for file_index, geojson_path in enumerate(geojson_files):
+        gdf = gpd.read_file(geojson_path)
+        if gdf.empty:
+            continue
+        gdf.set_crs(epsg=4326, inplace=True)
+        geoms = gdf.to_crs(epsg=3857).geometry.values
+        if simplify_tolerance:
+            geoms = shapely.simplify(geoms, simplify_tolerance)
+        parts = line_segments(geoms)
+        segments.extend(parts)
+        files.extend([file_index] * len(parts))
+    return {
+        'coords': np.concatenate(segments) if segments else np.empty((0, 2)),
+        'offsets': np.cumsum([0] + [len(segment) for segment in segments]).astype(np.int64),
+        'files': np.asarray(files, dtype=np.int32),
+        'file_count': np.int32(len(geojson_files)),
+    }
+
+
+def save_merged_lines(path, layer):
+    """Write a merged line layer as compressed npz. Written to a temporary file first so readers never see half a file."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp.npz'
+    np.savez_compressed(tmp_path, **layer)
+    os.replace(tmp_path, path)
+
+
+def load_merged_lines(path):
+    """Load a merged line layer. Returns (list of line coordinate arrays, file index per line, number of files)."""
+    with np.load(path) as data:
+        coords, offsets = data['coords'], data['offsets']
+        segments = [coords[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        return segments, data['files'], int(data['file_count'])
+
+
+def update_year_lines(all_dir, base_dir='.', simplify_tolerance=None, overwrite=False):
+    """
+    Merge the daily line files in all_dir (YYYYMMDD_all.geojson) into one layer per year. A year
+    is only merged again when its daily files or the tolerance changed. Returns {year: path}.
+    """
+    files_by_year = {}
+    if os.path.exists(all_dir):
+        for filename in sorted(os.listdir(all_dir)):
+            if filename.endswith('_all.geojson'):
+                files_by_year.setdefault(filename[:4], []).append(os.path.join(all_dir, filename))
+
+    manifest_path = os.path.join(base_dir, build_cache.cache_dir, 'year_lines_manifest.json')
+    manifest = build_cache.load_manifest(manifest_path)
+    paths = {}
+    for year, geojson_files in sorted(files_by_year.items()):
+        path = year_lines_path(base_dir, year)
+        entry = {'files': build_cache.files_manifest(geojson_files), 'simplify_tolerance': simplify_tolerance}
+        paths[year] = path
+        if os.path.exists(path) and manifest.get(year) == entry and not overwrite:
+            continue
+        save_merged_lines(path, merge_line_files(geojson_files, simplify_tolerance))
+        manifest[year] = entry
+        build_cache.save_manifest(manifest_path, manifest)
+        print(f"Merged the lines of {len(geojson_files)} days into {path}")
+    return paths
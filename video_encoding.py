@@ -0,0 +1,371 @@
+import os
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from PIL import Image
+import build_cache
+import date_overlay
+import frame_formats
+
+# Frame rate of all videos
+framerate = 30
+
+# The three video formats: an optional crop of the frame (see create_cropped_images.py), where the
+# date goes, and the size the video is scaled to (None keeps the frame size)
+VIDEO_LAYOUTS = {
+    'landscape': {'date_position': 'bottom_left', 'scale': None},
+    'square': {'date_position': 'bottom_left', 'scale': (1080, 1080)},
+    'vertical': {'date_position': 'center', 'scale': (1080, 1920)},
+}
+
+
+def layout_geometry(layout, width, height):
+    """
+    Return (crop, pad) for a layout of frames of the given size, using the same integer math as
+    create_cropped_images.py. crop is (x, y, width, height) or None, pad is (width, height, x, y)
+    of a white canvas the crop is placed on, or None.
+    """
+    if layout == 'square':
+        # Centered square of the shorter side
+        min_dimension = min(width, height)
+        left, top = (width - min_dimension) // 2, (height - min_dimension) // 2
+        right, bottom = (width + min_dimension) // 2, (height + min_dimension) // 2
+        return (left, top, right - left, bottom - top), None
+    if layout == 'vertical':
+        # A slightly wider 9:16 area, placed in the middle of a white 9:16 canvas
+        vertical_width = int(height * 9 / 16 * 1.2)  # 20% wider
+        left, right = (width - vertical_width) // 2, (width + vertical_width) // 2
+        canvas_width = right - left
+        canvas_height = int(canvas_width * 16 / 9)
+        return (left, 0, right - left, height), (canvas_width, canvas_height, 0, (canvas_height - height) // 2)
+    return None, None
+
+
+def layout_size(layout, width, height):
+    """Return the size of a layout's frames before scaling, which is where the date is drawn."""
+    crop, pad = layout_geometry(layout, width, height)
+    if pad is not None:
+        return pad[0], pad[1]
+    if crop is not None:
+        return crop[2], crop[3]
+    return width, height
+
+
+def encoder_args(audio=False, threads=None):
+    """Output options shared by all videos: H.264 at 30 fps in yuv420p, cut to the video if there is music."""
+    args = ['-c:v', 'libx264', '-r', str(framerate), '-pix_fmt', 'yuv420p']
+    if threads is not None:
+        args += ['-threads', str(threads)]
+    if audio:
+        args.append('-shortest')
+    return args
+
+
+class FrameWriter:
+    """
+    Pipe raw RGB frames into an ffmpeg process that encodes them to a video.
+
+    Frames are passed as bytes or arrays of height x width x 3 uint8 values, so nothing is
+    written to or decoded from image files on the way.
+    """
+
+    def __init__(self, output_path, width, height, audio_path=None):
+        self.output_path = output_path
+        command = [
+            'ffmpeg', '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-framerate', str(framerate),
+            '-i', '-',
+        ]
+        audio = audio_path is not None and os.path.exists(audio_path)
+        if audio:
+            command += ['-i', audio_path]
+        command += encoder_args(audio) + [output_path]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        self.frame_count = 0
+
+    def write(self, frame):
+        """Append one frame."""
+        self.process.stdin.write(frame if isinstance(frame, bytes) else frame.tobytes())
+        self.frame_count += 1
+
+    def close(self):
+        """Finish the video. Raises if ffmpeg failed."""
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to write {self.output_path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not leave a half written video behind
+            self.process.stdin.close()
+            self.process.kill()
+            self.process.wait()
+
+
+def prepare_date_stamp(mode, image_names, width, height, position, work_dir):
+    """
+    Prepare writing the dates on a sequence of frames (of the given size) while encoding.
+
+    'sprites' writes a small transparent image with the date per frame, rendered like
+    date_overlay.draw_date, and returns ('overlay', glob pattern, top row). 'drawtext' writes an
+    ffmpeg command script that changes the text for every frame and returns ('filter', filter),
+    which needs an ffmpeg built with freetype. Either way the dates follow the frame order, so
+    gaps in the dates are no problem.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    if mode == 'sprites':
+        top = date_overlay.write_date_sprites(image_names, width, height, work_dir, position)
+        return ('overlay', os.path.join(work_dir, '*.png'), top)
+    if mode == 'drawtext':
+        commands_path = os.path.join(work_dir, 'dates.cmd')
+        with open(commands_path, 'w') as f:
+            for index, image_name in enumerate(image_names):
+                # Slightly before the frame's timestamp, so rounding cannot move it to the next frame
+                start = max(0.0, index / framerate - 0.001)
+                f.write(f"{start:.4f} drawtext@date reinit text={date_overlay.format_date(image_name.split('_')[0])};\n")
+        first_date = date_overlay.format_date(image_names[0].split('_')[0])
+        x = '(w-text_w)/2' if position == 'center' else '10'
+        y = f'h-{date_overlay.text_height}-10'
+        return ('filter', f"sendcmd=f='{commands_path}',drawtext@date=fontfile='{date_overlay.font_path}':fontsize={date_overlay.text_height}:fontcolor=black:text='{first_date}':x={x}:y={y}")
+    raise ValueError(f"Unknown date stamping mode {mode!r}")
+
+
+def date_chain(label, stage, input_index):
+    """Return the filter chain that writes the dates on the stream [label], ending in [label]_dated."""
+    if stage[0] == 'overlay':
+        return f"[{label}][{input_index}:v]overlay=0:{stage[2]}:format=rgb[{label}_dated]"
+    return f"[{label}]{stage[1]}[{label}_dated]"
+
+
+def encode_sequence(frame_pattern, output_path, audio_path=None, date_stage=None, scale=None, start_frame=None, frame_count=None, threads=None):
+    """
+    Encode one image sequence (glob pattern) into a video, with the dates written on it and scaled
+    if given. start_frame and frame_count select a part of the sequence, which is seeked to
+    without decoding the frames before it.
+    """
+    command = ['ffmpeg', '-y', '-pattern_type', 'glob', '-framerate', str(framerate)]
+    if start_frame:
+        command += ['-ss', f'{start_frame / framerate:.6f}']
+    command += ['-i', frame_pattern]
+    if date_stage is not None and date_stage[0] == 'overlay':
+        command += ['-pattern_type', 'glob', '-framerate', str(framerate), '-i', date_stage[1]]
+    audio = audio_path is not None and os.path.exists(audio_path)
+    if audio:
+        audio_index = 2 if date_stage is not None and date_stage[0] == 'overlay' else 1
+        command += ['-i', audio_path]
+    chains = ['[0:v]null[frames]']
+    label = 'frames'
+    if date_stage is not None:
+        chains.append(date_chain(label, date_stage, 1))
+        label = f'{label}_dated'
+    if scale is not None:
+        chains.append(f"[{label}]scale={scale[0]}:{scale[1]},setsar=1:1[{label}_scaled]")
+        label = f'{label}_scaled'
+    command += ['-filter_complex', ';'.join(chains), '-map', f'[{label}]']
+    if frame_count is not None:
+        command += ['-frames:v', str(frame_count)]
+    if audio:
+        command += ['-map', f'{audio_index}:a']
+    command += encoder_args(audio, threads) + [output_path]
+    subprocess.run(command, check=True)
+
+
+def fanout_filter_graph(width, height, layouts, date_stages=None):
+    """
+    Return a filter_complex graph that splits input 0 into the given layouts, labeled [<layout>].
+
+    date_stages maps a layout to (stage, input index) from prepare_date_stamp. The dates are
+    written on the cropped frame before it is scaled, like the dates drawn on the cropped images.
+    """
+    date_stages = date_stages or {}
+    chains = [f"[0:v]split={len(layouts)}" + ''.join(f'[{layout}_in]' for layout in layouts)]
+    for layout in layouts:
+        filters = []
+        crop, pad = layout_geometry(layout, width, height)
+        if crop is not None:
+            filters.append('crop={2}:{3}:{0}:{1}'.format(*crop))
+        if pad is not None:
+            filters.append('pad={0}:{1}:{2}:{3}:color=white'.format(*pad))
+        chains.append(f"[{layout}_in]" + (','.join(filters) if filters else 'null') + f"[{layout}_frame]")
+        label = f'{layout}_frame'
+        if layout in date_stages:
+            stage, input_index = date_stages[layout]
+            chains.append(date_chain(label, stage, input_index))
+            label = f'{label}_dated'
+        scale = VIDEO_LAYOUTS[layout]['scale']
+        if scale is not None:
+            chains.append(f"[{label}]scale={scale[0]}:{scale[1]},setsar=1:1[{layout}]")
+        else:
+            chains.append(f"[{label}]null[{layout}]")
+    return ';'.join(chains)
+
+
+def encode_fanout(frame_pattern, width, height, outputs, date_stages=None, audio_path=None):
+    """
+    Encode one image sequence (glob pattern) into several layouts with a single ffmpeg process.
+
+    The frames are decoded once and split inside ffmpeg. outputs maps a layout name to its video
+    path, date_stages optionally maps a layout to its stage from prepare_date_stamp.
+    """
+    layouts = list(outputs)
+    command = ['ffmpeg', '-y', '-pattern_type', 'glob', '-framerate', str(framerate), '-i', frame_pattern]
+    indexed_stages = {}
+    input_count = 1
+    for layout, stage in (date_stages or {}).items():
+        indexed_stages[layout] = (stage, input_count)
+        if stage[0] == 'overlay':
+            command += ['-pattern_type', 'glob', '-framerate', str(framerate), '-i', stage[1]]
+            input_count += 1
+    audio = audio_path is not None and os.path.exists(audio_path)
+    if audio:
+        command += ['-i', audio_path]
+    command += ['-filter_complex', fanout_filter_graph(width, height, layouts, indexed_stages)]
+    for layout in layouts:
+        command += ['-map', f'[{layout}]']
+        if audio:
+            command += ['-map', f'{input_count}:a']
+        command += encoder_args(audio) + [outputs[layout]]
+    subprocess.run(command, check=True)
+
+
+def segment_threads(workers):
+    """Threads per encoder when `workers` encoders run at the same time, so they share the CPUs instead of competing for them."""
+    if workers <= 1:
+        return None
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def encode_segment(image_dir, image_names, segment_path, frame_pattern, start_frame=None, date_mode=None, date_position=None, scale=None, threads=None):
+    """
+    Encode the frames image_names of image_dir into a video without audio, as part of a longer
+    video. frame_pattern selects them (with start_frame, the index of the first one in it).
+    """
+    with tempfile.TemporaryDirectory() as stamp_dir:
+        date_stage = None
+        if date_mode is not None:
+            with Image.open(os.path.join(image_dir, image_names[0])) as img:
+                width, height = img.size
+            date_stage = prepare_date_stamp(date_mode, image_names, width, height, date_position, stamp_dir)
+        encode_sequence(frame_pattern, segment_path, None, date_stage, scale, start_frame, len(image_names), threads)
+
+
+def split_frames(image_names, chunks):
+    """Split a sorted list of frames into at most `chunks` contiguous parts of almost equal length, as (start index, names)."""
+    chunks = max(1, min(chunks, len(image_names)))
+    size, extra = divmod(len(image_names), chunks)
+    parts = []
+    start = 0
+    for index in range(chunks):
+        end = start + size + (1 if index < extra else 0)
+        parts.append((start, image_names[start:end]))
+        start = end
+    return parts
+
+
+def encode_parallel(image_dir, image_names, output_path, chunks, audio_path=None, date_mode=None, date_position=None, scale=None):
+    """
+    Encode an image sequence as `chunks` contiguous parts at the same time and join them into
+    output_path without re-encoding.
+
+    All parts use the same encoder settings and each starts with a keyframe, so they can be joined
+    by stream copy. The music is added when joining.
+    """
+    image_names = sorted(image_names)
+    frame_pattern = frame_formats.frame_pattern(image_dir)
+    parts = split_frames(image_names, chunks)
+    threads = segment_threads(len(parts))
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as part_dir:
+        part_paths = [os.path.join(part_dir, f'part_{index:04d}.mp4') for index in range(len(parts))]
+        with ThreadPoolExecutor(max_workers=len(parts)) as executor:
+            futures = [
+                executor.submit(encode_segment, image_dir, names, part_path, frame_pattern, start, date_mode, date_position, scale, threads)
+                for (start, names), part_path in zip(parts, part_paths)
+            ]
+            for future in futures:
+                future.result()
+        concat_segments(part_paths, output_path, audio_path)
+
+
+def concat_segments(segment_paths, output_path, audio_path=None):
+    """
+    Join video segments with the same encoder settings into one video without re-encoding them,
+    and add the music (cut to the video) at the end.
+    """
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+        for segment_path in segment_paths:
+            escaped = os.path.abspath(segment_path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+        list_path = f.name
+    try:
+        command = ['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', list_path]
+        audio = audio_path is not None and os.path.exists(audio_path)
+        if audio:
+            command += ['-i', audio_path, '-map', '0:v', '-map', '1:a', '-c:v', 'copy', '-shortest']
+        else:
+            command += ['-c', 'copy']
+        command.append(output_path)
+        subprocess.run(command, check=True)
+    finally:
+        os.remove(list_path)
+
+
+def encode_incremental(image_dir, image_names, output_path, segment_dir, audio_path=None, date_mode=None, date_position=None, scale=None, workers=1):
+    """
+    Encode an image sequence as one segment per month, kept in segment_dir, and join them into
+    output_path. Returns the number of segments that had to be encoded.
+
+    A segment is only encoded again when its frames (names, sizes and modification times) or the
+    settings changed, so adding a few days re-encodes only the last month. Every segment is its
+    own file and starts with a keyframe, so the segments can be joined by stream copy. Up to
+    `workers` segments are encoded at the same time.
+    """
+    months = {}
+    for image_name in sorted(image_names):
+        months.setdefault(image_name[:6], []).append(image_name)
+
+    manifest_path = os.path.join(segment_dir, 'manifest.json')
+    manifest = build_cache.load_manifest(manifest_path)
+    settings = {
+        'date_mode': date_mode, 'date_position': date_position,
+        'scale': list(scale) if scale is not None else None,
+        'framerate': framerate, 'encoder': encoder_args(),
+    }
+
+    # Segments of months that have no frames anymore
+    for month in sorted(set(manifest) - set(months)):
+        segment_path = os.path.join(segment_dir, f'{month}.mp4')
+        if os.path.exists(segment_path):
+            os.remove(segment_path)
+        del manifest[month]
+
+    segment_paths = []
+    stale = []
+    for month, names in sorted(months.items()):
+        segment_path = os.path.join(segment_dir, f'{month}.mp4')
+        entry = {'frames': build_cache.files_manifest(os.path.join(image_dir, name) for name in names), 'settings': settings}
+        if manifest.get(month) != entry or not os.path.exists(segment_path):
+            stale.append((month, names, segment_path, entry))
+        segment_paths.append(segment_path)
+
+    # Encode the stale months, `workers` at a time
+    os.makedirs(segment_dir, exist_ok=True)
+    threads = segment_threads(workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for month, names, segment_path, entry in stale:
+            print(f"Encoding segment {month} ({len(names)} frames)")
+            futures[executor.submit(encode_segment, image_dir, names, segment_path, frame_formats.frame_pattern(image_dir, month), None, date_mode, date_position, scale, threads)] = (month, entry)
+        for future in as_completed(futures):
+            future.result()
+            month, entry = futures[future]
+            manifest[month] = entry
+            build_cache.save_manifest(manifest_path, manifest)
+    build_cache.save_manifest(manifest_path, manifest)
+
+    concat_segments(segment_paths, output_path, audio_path)
+    return len(stale)
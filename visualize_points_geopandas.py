@@ -1,18 +1,73 @@
 import os
+import io
+import math
+from concurrent.futures import wait, FIRST_COMPLETED
 import matplotlib.pyplot as plt
 import geopandas as gpd
 import contextily as ctx
 import fiona
-from matplotlib.colors import LinearSegmentedColormap, ListedColormap, BoundaryNorm
+from matplotlib.colors import LinearSegmentedColormap, BoundaryNorm
 import matplotlib as mpl
 import pandas as pd
-from datetime import timedelta
+from datetime import timedelta, datetime
+import numpy as np
+from PIL import Image
+import region_cache
+import basemap_cache
+import choropleth
+import track_layers
+import date_overlay
+import frame_formats
+import video_encoding
+import build_engine
+import pipeline_context
+import instrumentation
 
-# Set your start date here!
+# Set your start date here! (run_all_scripts.py sets it to the start date of cumulative_points.py,
+# as 'YYYYMMDD' or 'YYYY-MM-DD')
 startdate = '2020-01-01'
 
 overwrite = False
 
+# Draw the static basemap layers from a raster rendered once (see basemap_cache.py) instead of
+# plotting all their polygons again for every frame
+cached_background = True
+
+# Number of processes rendering frames in parallel, 1 renders everything in this process
+render_workers = os.cpu_count() or 1
+# Upper limit for the memory of all render processes together in MB (None for no limit). Every
+# worker holds a full-size frame plus the background rasters and region layers. Until the first
+# frames are back, a worker is assumed to need the estimate below; after that the largest peak RSS
+# measured in a worker is used, and fewer frames are rendered at the same time if they would not fit.
+render_memory_limit_mb = 8000
+render_worker_memory_estimate_mb = 1500
+
+# Days per run handed to a render process while the counts are still being written by a stage
+# running at the same time (see stage_scheduler.py), so rendering follows the counts closely
+stream_chunk_days = 10
+
+# The track lines of the last trail_days days are drawn, fading in from trail_alpha_min (oldest
+# day) to trail_alpha_max (newest day). Each day is read once and kept while it is in the window.
+trail_days = 10
+trail_alpha_min = 0.1
+trail_alpha_max = 1.0
+# 'vector' plots the lines of each day in the window as above. 'raster' keeps a fading raster of
+# the lines instead: every day it is multiplied by trail_decay and the lines of the new day are
+# drawn into it, so a frame only costs one day of lines and the fade is smooth.
+trail_mode = 'vector'
+trail_decay = 0.75
+
+# Encode the frames straight into a video instead of writing PNG files: every frame is piped to
+# ffmpeg as raw pixels with the date written on it in memory (see video_encoding.py). All frames
+# are rendered in this process, in order. With export_png the PNGs are written as well.
+stream_video = False
+export_png = False
+background_music_path = os.path.join('static', 'timecode.mp3')
+
+# Keep one figure per process for all frames: the basemap and the region polygons are added once
+# and only the colors of the regions and the track lines change from frame to frame
+persistent_figure = True
+
 def setup_directories(base_dir):
     """Set up required directories."""
     shapefile_dir = os.path.join(base_dir, 'shapefile_cumulative')
@@ -28,61 +83,59 @@ def get_dates_to_process(start_date):
     return [d.strftime('%Y%m%d') for d in pd.date_range(start=start_date, end=pd.Timestamp.today())]
 
 
-def get_last_10_days_geojson(date_str, all_dir):
-    """Retrieve GeoJSON files for the last 10 days from the specified directory."""
-    date = pd.to_datetime(date_str, format='%Y%m%d')
-    geojson_files = []
-    for i in range(10):
-        day = date - timedelta(days=9-i)
-        if day < pd.to_datetime(startdate):
-            continue  # Skip days before the start date
-        geojson_path = os.path.join(all_dir, f'{day.strftime("%Y%m%d")}_all.geojson')
-        if os.path.exists(geojson_path):
-            geojson_files.append(geojson_path)
-    return geojson_files
+def trail_inputs(date):
+    """Paths (relative to base_dir) of the line files that can show up in the trail of a frame."""
+    end = pd.to_datetime(date, format='%Y%m%d')
+    # A raster trail keeps every day until it has faded out
+    days = track_layers.fade_days(trail_decay) if trail_mode == 'raster' else trail_days
+    first_day = max(end - timedelta(days=days - 1), pd.to_datetime(startdate))
+    return [os.path.join('all', f'{day.strftime("%Y%m%d")}_all.geojson') for day in pd.date_range(first_day, end)]
+
+
+def frame_settings():
+    """Everything a frame depends on besides its count shapefile and track lines."""
+    return {
+        'trail_mode': trail_mode, 'trail_days': trail_days, 'trail_alpha_min': trail_alpha_min, 'trail_alpha_max': trail_alpha_max,
+        'trail_decay': trail_decay, 'cached_background': cached_background, 'persistent_figure': persistent_figure,
+        'figsize': basemap_cache.frame_figsize, 'dpi': basemap_cache.frame_dpi,
+    }
 
 
-def plot_geojson_files(ax, geojson_files):
-    """Plot GeoJSON files with varying alpha values."""
-    if len(geojson_files) >= 2:
-        for idx, geojson_file in enumerate(geojson_files):
-            gdf = gpd.read_file(geojson_file)
-            gdf.set_crs(epsg=4326, inplace=True)
-            gdf = gdf.to_crs(epsg=3857)
-            alpha_value = 0.1 + (0.9 * idx / (len(geojson_files) - 1))  # Gradually increase alpha
-            gdf.plot(ax=ax, color='blue', alpha=alpha_value)
+# The lines of the last days, kept between frames (see track_layers.TrailWindow and TrailRaster)
+_trail_window = None
+_trail_raster = None
+
+
+def plot_trail(ax, date, base_dir, all_dir):
+    """Plot the track lines of the last days up to date, fading out with their age."""
+    global _trail_window, _trail_raster
+    if trail_mode == 'raster':
+        if _trail_raster is None or _trail_raster.all_dir != all_dir or _trail_raster.start_date != pd.to_datetime(startdate):
+            xlim, ylim = basemap_cache.frame_limits(basemap_cache.frame_figsize, base_dir)
+            width = int(round(basemap_cache.frame_figsize[0] * basemap_cache.frame_dpi))
+            height = int(round(basemap_cache.frame_figsize[1] * basemap_cache.frame_dpi))
+            _trail_raster = track_layers.TrailRaster(all_dir, (xlim[0], xlim[1], ylim[0], ylim[1]), width, height, trail_decay, startdate, dpi=basemap_cache.frame_dpi)
+        _trail_raster.advance(date)
+        overlay = _trail_raster.overlay('blue')
+        if overlay is not None:
+            image, extent = overlay
+            # Same zorder as plotted lines: above the regions and the lakes
+            ax.imshow(image, extent=extent, interpolation='nearest', zorder=2)
+        return
+
+    if _trail_window is None or _trail_window.all_dir != all_dir or _trail_window.start_date != pd.to_datetime(startdate):
+        _trail_window = track_layers.TrailWindow(all_dir, trail_days, startdate)
+    layers = _trail_window.advance(date)
+    track_layers.plot_trail(ax, layers, 'blue', trail_alpha_min, trail_alpha_max)
 
 
 def plot_shapefile(ax, shapefile_path, country_gdf):
     """Plot the shapefile with a defined colormap and set map limits based on country_gdf."""
-    shapefile_gdf = gpd.read_file(shapefile_path)
-    shapefile_gdf.set_crs(epsg=3857, inplace=True, allow_override=True)
-    shapefile_gdf = shapefile_gdf.to_crs(epsg=3857)
+    shapefile_gdf = region_cache.read_count_shapefile(shapefile_path)
     # Removed initial base plot: shapefile_gdf.plot(ax=ax, color='#e9e6be', edgecolor='none')
 
-    # Define a new colormap for NUMPOINTS >= 5
-    colors = ['#caaea8']  # First color in the colormap list
-    steps = 60
-
-    # Define start and end RGB for the ramp
-    r_start, g_start, b_start = 202, 174, 168  # RGB for #caaea8
-    r_end, g_end, b_end = 134, 22, 226          # RGB for #8616e2
-
-    # Generate `steps` colors for the ramp, these will be appended to the initial '#caaea8'
-    for i in range(1, steps + 1):
-        fraction = i / steps
-        r = int(r_start + (r_end - r_start) * fraction)
-        g = int(g_start + (g_end - g_start) * fraction)
-        b = int(b_start + (b_end - b_start) * fraction)
-        
-        # Clamp values to 0-255 range to be safe
-        r = max(0, min(255, r))
-        g = max(0, min(255, g))
-        b = max(0, min(255, b))
-        
-        colors.append(f"#{r:02x}{g:02x}{b:02x}")
-    colors.extend(['#8616e2' for _ in range(7501, 10001)])  # Extend to cover potential higher values
-    defined_cmap = ListedColormap(colors)
+    # Colormap for NUMPOINTS >= 3: #caaea8 followed by a ramp to #8616e2
+    defined_cmap = choropleth.build_colormap()
 
     # Filter data to plot only areas with NUMPOINTS >= 3
     shapefile_gdf_to_plot = shapefile_gdf[shapefile_gdf['NUMPOINTS'] >= 3]
@@ -102,69 +155,302 @@ def plot_shapefile(ax, shapefile_path, country_gdf):
     ax.set_xlim(x_center - x_range, x_center + x_range)
     ax.set_ylim(y_center - y_range, y_center + y_range)
 
-# Main execution
-base_dir = '.'
-shapefile_dir, visualizations_dir, all_dir, fast_dir = setup_directories(base_dir)
-dates_to_process = get_dates_to_process(startdate)
-
-for date in dates_to_process:
-    shapefile_path = os.path.join(shapefile_dir, f'{date}_VG5000_GEM_with_counts.shp')
-    if not os.path.exists(shapefile_path):
-        print(f'Shapefile for {date} not found, skipping.')
-        continue
+def render_frame(date, shapefile_path, output_png_path, base_dir, all_dir):
+    """Render the map for one day and save it as a PNG."""
+    if persistent_figure:
+        render_frame_persistent(date, shapefile_path, output_png_path, base_dir, all_dir)
+        return
 
-    output_png_path = os.path.join(visualizations_dir, f'{date}_visualization.png')
+    # The basemap layers never change: loaded once per process (reprojected to EPSG:3857, cached in /cache)
+    germany_gdf = basemap_cache.load_layer('germanyshape', base_dir)
 
-    # Check if the output PNG file exists and overwrite is False
-    if os.path.exists(output_png_path) and not overwrite:
-        print(f'Visualization for {date} already exists, skipping.')
-        continue
-
-    fig, ax = plt.subplots(figsize=(38.4, 21.6))
+    fig, ax = plt.subplots(figsize=basemap_cache.frame_figsize)
     fig.patch.set_facecolor('#4a79a5')
     ax.set_facecolor('#4a79a5')
 
-    # Load and plot additional layers
-    europecoastline_path = os.path.join(base_dir, 'basisdaten', 'europecoastline.shp')
-    secondbackground_path = os.path.join(base_dir, 'basisdaten', 'secondbackground.shp')
-    germany_path = os.path.join(base_dir, 'basisdaten', 'germanyshape.shp')
-    lakes_path = os.path.join(base_dir, 'basisdaten', 'lakes.shp')
-
-    europecoastline_gdf = gpd.read_file(europecoastline_path)
-    secondbackground_gdf = gpd.read_file(secondbackground_path)
-    germany_gdf = gpd.read_file(germany_path)
-    lakes_gdf = gpd.read_file(lakes_path)
-
-    europecoastline_gdf.set_crs(epsg=25832, inplace=True, allow_override=True)
-    europecoastline_gdf = europecoastline_gdf.to_crs(epsg=3857)
-
-    secondbackground_gdf.set_crs(epsg=25832, inplace=True, allow_override=True)
-    secondbackground_gdf = secondbackground_gdf.to_crs(epsg=3857)
-
-    germany_gdf.set_crs(epsg=25832, inplace=True, allow_override=True)
-    germany_gdf = germany_gdf.to_crs(epsg=3857)
-    
-    lakes_gdf.set_crs(epsg=4326, inplace=True, allow_override=True)
-    lakes_gdf = lakes_gdf.to_crs(epsg=3857)
-
-    europecoastline_gdf.plot(ax=ax, color='#e9e6be', edgecolor='none') #light background europe
-    secondbackground_gdf.plot(ax=ax, color='#4a79a5', edgecolor='none') #water
-    germany_gdf.plot(ax=ax, color='#dcd798', edgecolor='none') #darker background for germany shape
-
-    # Plot GeoJSON files and shapefile (passing germany_gdf to set extents)
-    geojson_files = get_last_10_days_geojson(date, all_dir)
-    plot_geojson_files(ax, geojson_files)
-    # germany_gdf is already loaded and in EPSG:3857 at this point in the main loop
+    # Static layers below the data
+    if not cached_background:
+        for layer_name in basemap_cache.BACKGROUND_LAYERS:
+            basemap_cache.plot_layer(ax, layer_name, base_dir)
+
+    # Plot the track lines and shapefile (passing germany_gdf to set extents)
+    plot_trail(ax, date, base_dir, all_dir)
     plot_shapefile(ax, shapefile_path, germany_gdf)
 
-    lakes_gdf.plot(ax=ax, color='#4a79a5', edgecolor='none') #lakes
+    if cached_background:
+        # Background below and lakes above the data, by zorder. Added last, as every geopandas
+        # plot call redraws the whole figure and would resample the rasters each time.
+        basemap_cache.draw_background(ax, base_dir)
+        basemap_cache.draw_lakes(ax, base_dir)
+        basemap_cache.set_frame_limits(ax, base_dir)
+    else:
+        # Lakes above the data
+        basemap_cache.plot_layer(ax, 'lakes', base_dir)
+
     # Remove axis labels and ticks
     ax.set_axis_off()
     ax.set_aspect('equal', adjustable='datalim') # Ensure aspect ratio is equal, adjust data limits to fit figure
     plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
 
     # Save the figure
-    plt.savefig(output_png_path, bbox_inches='tight', pad_inches=0.1)
+    frame_formats.save_figure(fig, output_png_path, bbox_inches='tight', pad_inches=0.1)
     plt.close(fig)
 
-    print(f'Visualization for {date} saved to {output_png_path}')
+
+# The figure reused for all frames of this process (see persistent_figure)
+_persistent_frame = None
+
+
+def get_persistent_frame(base_dir):
+    """Return this process's frame figure, created with the static layers on first use."""
+    global _persistent_frame
+    if _persistent_frame is None:
+        fig, ax, bbox_inches = basemap_cache.frame_figure(base_dir, cached_background)
+        # Region collections by layer name, created when a count shapefile of that layer first shows up
+        _persistent_frame = {'fig': fig, 'ax': ax, 'bbox_inches': bbox_inches, 'regions': {}}
+    return _persistent_frame
+
+
+def render_frame_persistent(date, shapefile_path, output, base_dir, all_dir, **savefig_kwargs):
+    """Render the map for one day into the persistent figure and save it as a frame (or as savefig_kwargs say)."""
+    frame = get_persistent_frame(base_dir)
+    fig, ax = frame['fig'], frame['ax']
+
+    # Only the counts are read, the polygons are already in the figure
+    attributes = gpd.read_file(shapefile_path, ignore_geometry=True)
+    layer_name = region_cache.match_region_layer(attributes, base_dir)
+    for name, regions in frame['regions'].items():
+        if name != layer_name:
+            regions.hide()
+    if layer_name is not None:
+        if layer_name not in frame['regions']:
+            region_gdf, _ = region_cache.load_region_layer(layer_name, base_dir)
+            frame['regions'][layer_name] = choropleth.RegionCollection(ax, region_gdf.geometry.values)
+        frame['regions'][layer_name].update(attributes['NUMPOINTS'].values)
+
+    # Everything added from here on belongs to this frame only
+    static_artists = list(ax.collections) + list(ax.images)
+
+    plot_trail(ax, date, base_dir, all_dir)
+
+    if layer_name is None:
+        # Grid cells or other polygons that differ from day to day are plotted for this frame only
+        plot_shapefile(ax, shapefile_path, basemap_cache.load_layer('germanyshape', base_dir))
+
+    basemap_cache.set_frame_limits(ax, base_dir)
+    ax.set_aspect('equal', adjustable='datalim')
+    if savefig_kwargs:
+        fig.savefig(output, bbox_inches=frame['bbox_inches'], **savefig_kwargs)
+    else:
+        frame_formats.save_figure(fig, output, bbox_inches=frame['bbox_inches'])
+
+    # Remove the collections and images that belong to this frame only
+    for artist in list(ax.collections) + list(ax.images):
+        if not any(artist is static for static in static_artists):
+            artist.remove()
+
+
+def frame_size(base_dir):
+    """Return the (width, height) in pixels of the saved frames, the size Agg gives a figure cropped to the bounding box."""
+    frame = get_persistent_frame(base_dir)
+    return int(frame['bbox_inches'].width * frame['fig'].dpi), int(frame['bbox_inches'].height * frame['fig'].dpi)
+
+
+def render_frame_image(date, shapefile_path, base_dir, all_dir):
+    """Render the map for one day and return it as an RGBA array, the same pixels a PNG would get."""
+    buffer = io.BytesIO()
+    render_frame_persistent(date, shapefile_path, buffer, base_dir, all_dir, format='rgba')
+    width, height = frame_size(base_dir)
+    return np.frombuffer(buffer.getbuffer(), dtype=np.uint8).reshape(height, width, 4)
+
+
+def stream_frames_to_video(frames, base_dir, all_dir, video_output_path, build, units):
+    """
+    Pipe the frames in order, with the date written on them, into one video. A frame whose exported
+    PNG is up to date is read back instead of rendered again; with export_png every rendered frame
+    is written and recorded in build.
+    """
+    width, height = frame_size(base_dir)
+    with video_encoding.FrameWriter(video_output_path, width, height, background_music_path) as writer:
+        for date, shapefile_path, output_png_path in frames:
+            if build.stale_reason(units[date]) is None:
+                with instrumentation.measure_unit('visualize_points_geopandas', date, [output_png_path]):
+                    frame_image = Image.open(output_png_path).convert('RGB')
+            else:
+                with instrumentation.measure_unit('visualize_points_geopandas', date, [shapefile_path], [output_png_path] if export_png else []):
+                    image = render_frame_image(date, shapefile_path, base_dir, all_dir)
+                    if export_png:
+                        frame_formats.save_frame(Image.fromarray(image), output_png_path)
+                        build.record(units[date])
+                    frame_image = Image.fromarray(image[:, :, :3])
+            date_overlay.draw_date(frame_image, date)
+            writer.write(frame_image.tobytes())
+            print(f'Frame for {date} added to {video_output_path}')
+    print(f'Video created at {video_output_path} ({writer.frame_count} frames)')
+
+
+def init_render_worker(base_dir, start_date=None):
+    """Prepare a render process: headless backend, the start date of the trails and the shared map state, loaded once per process."""
+    global startdate
+    if start_date is not None:
+        startdate = start_date
+    mpl.use('Agg')
+    basemap_cache.load_layer('germanyshape', base_dir)
+    if cached_background:
+        basemap_cache.basemap_rasters(basemap_cache.frame_figsize, basemap_cache.frame_dpi, base_dir)
+    else:
+        for layer_name in basemap_cache.BASEMAP_LAYERS:
+            basemap_cache.load_layer(layer_name, base_dir)
+
+
+def render_frames(frames, base_dir, all_dir):
+    """Render a list of (date, shapefile_path, output_png_path) in order. Returns the rendered outputs and their unit records."""
+    for date, shapefile_path, output_png_path in frames:
+        # The track lines are read once per process and kept for the trail, so only the counts count as read per frame
+        with instrumentation.measure_unit('visualize_points_geopandas', date, [shapefile_path], [output_png_path]):
+            render_frame(date, shapefile_path, output_png_path, base_dir, all_dir)
+    return [(date, output_png_path) for date, _, output_png_path in frames], instrumentation.collect_units()
+
+
+def worker_count(frame_count, workers=None):
+    """Number of render processes: render_workers (or workers), limited by the number of frames."""
+    workers = max(1, render_workers if workers is None else workers)
+    return min(workers, max(1, frame_count))
+
+
+def memory_limited_workers(workers, worker_memory_mb, current=None, source='estimated'):
+    """
+    Number of the workers that fit into render_memory_limit_mb with worker_memory_mb each (at least
+    one). Prints the new number when it differs from the current one (at first, from workers).
+    """
+    if render_memory_limit_mb is None or not worker_memory_mb:
+        return workers
+    fitting = min(workers, max(1, int(render_memory_limit_mb // worker_memory_mb)))
+    if worker_memory_mb > render_memory_limit_mb and current != 1:
+        print(f'Warning: a render process needs {worker_memory_mb:.0f} MB ({source}), more than render_memory_limit_mb ({render_memory_limit_mb} MB).')
+    elif fitting != (workers if current is None else current):
+        print(f'Rendering with {fitting} of {workers} processes at a time, {worker_memory_mb:.0f} MB ({source}) '
+              f'each for render_memory_limit_mb ({render_memory_limit_mb} MB).')
+    return fitting
+
+
+def split_into_chunks(frames, chunk_size):
+    """Split the frames (a list, or frames still coming in) into runs of chunk_size consecutive days."""
+    chunk = []
+    for frame in frames:
+        chunk.append(frame)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def pending_frames(dates, build, units, shapefile_dir, visualizations_dir, context=None):
+    """
+    Yield the (date, shapefile_path, output_png_path) of every frame to render (with stream_video of
+    every frame, the video needs them all). While the counts are still being written by a stage
+    running at the same time, every day is waited for first.
+    """
+    for date in dates:
+        # The counts are written day by day in date order, so a day before the first counted one is not waited for
+        pipeline_context.wait_for_unit(context, 'visualize_cumulative_points_with_counts', date, ordered=True)
+        shapefile_path = os.path.join(shapefile_dir, f'{date}_VG5000_GEM_with_counts.shp')
+        if not os.path.exists(shapefile_path):
+            print(f'Shapefile for {date} not found, skipping.')
+            continue
+
+        output_png_path = os.path.join(visualizations_dir, f'{date}_visualization{frame_formats.frame_extension()}')
+
+        # Skip the frame if it was rendered from the current counts and lines (a video reads it back, see stream_frames_to_video)
+        units[date] = build.unit(date, settings=frame_settings(), extra_inputs=trail_inputs(date), day=date, frame_extension=frame_formats.frame_extension())
+        if not stream_video and build.stale_reason(units[date]) is None:
+            print(f'Visualization for {date} is up to date, skipping.')
+            continue
+
+        yield (date, shapefile_path, output_png_path)
+
+
+def main(context=None):
+    global startdate
+    settings = pipeline_context.stage_settings(context, 'visualize_points_geopandas', overwrite=overwrite, render_workers=render_workers, start_date=startdate)
+    # The trails and their inputs start at the same day as the frames (in this and the render processes)
+    start_date = startdate = pd.to_datetime(settings['start_date']).strftime('%Y-%m-%d')
+    base_dir = '.'
+    shapefile_dir, visualizations_dir, all_dir, fast_dir = setup_directories(base_dir)
+    dates_to_process = get_dates_to_process(start_date)
+
+    # Fingerprints of the count shapefile, track lines and settings every frame was rendered from
+    build = build_engine.StageBuild('visualize_points_geopandas', base_dir, settings['overwrite'])
+    units = {}
+    frames = pending_frames(dates_to_process, build, units, shapefile_dir, visualizations_dir, context)
+
+    # While the counts are still being written, every frame is rendered as soon as its day is
+    # counted. Otherwise all frames to render are known up front.
+    streaming = pipeline_context.is_streaming(context, 'visualize_cumulative_points_with_counts')
+    if not streaming:
+        frames = list(frames)
+        if not frames:
+            build.save()
+            return
+
+    if stream_video:
+        video_output_path = os.path.join(base_dir, f'visualization_video_{datetime.now().strftime("%Y%m%d")}.mp4')
+        stream_frames_to_video(frames, base_dir, all_dir, video_output_path, build, units)
+        build.save()
+        return
+
+    frame_count = len(dates_to_process) if streaming else len(frames)
+    pool_workers = worker_count(frame_count, pipeline_context.stage_workers(context, settings['render_workers']))
+    workers = memory_limited_workers(pool_workers, render_worker_memory_estimate_mb)
+    if workers == 1:
+        for frame in frames:
+            _, unit_records = render_frames([frame], base_dir, all_dir)
+            instrumentation.add_units(unit_records)
+            build.record(units[frame[0]])
+            print(f'Visualization for {frame[0]} saved to {frame[2]}')
+        build.save()
+        return
+
+    # Build the cached layers and rasters once here, so the workers only have to load them
+    init_render_worker(base_dir)
+
+    # Several runs of consecutive days per worker, so a slow part of the date range does not hold up the rest
+    chunk_size = math.ceil(frame_count / (workers * 4))
+    if streaming:
+        chunk_size = min(chunk_size, stream_chunk_days)
+        print(f'Rendering frames with {workers} processes as their days are counted...')
+    else:
+        print(f'Rendering {len(frames)} frames with {workers} processes...')
+    chunks = split_into_chunks(frames, chunk_size)
+    # Fresh processes instead of forks of this one, every worker sets up its own matplotlib state.
+    # The pool has room for all configured workers, but only as many chunks as fit into the memory
+    # ceiling are rendered at a time (new processes are only started for them).
+    worker_memory_mb = None
+    futures = set()
+    with pipeline_context.process_pool(context, pool_workers, init_render_worker, (base_dir, start_date)) as executor:
+        while True:
+            while len(futures) < workers:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                futures.add(executor.submit(render_frames, chunk, base_dir, all_dir))
+            if not futures:
+                break
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                rendered, unit_records = future.result()
+                instrumentation.add_units(unit_records)
+                for date, output_png_path in rendered:
+                    build.record(units[date])
+                    print(f'Visualization for {date} saved to {output_png_path}')
+                # The largest peak RSS of a worker so far replaces the estimate
+                peaks = [record['peak_rss_mb'] for record in unit_records if record.get('peak_rss_mb') is not None]
+                if peaks and (worker_memory_mb is None or max(peaks) > worker_memory_mb):
+                    worker_memory_mb = max(peaks)
+                    workers = memory_limited_workers(pool_workers, worker_memory_mb, workers, 'measured')
+    build.save()
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@ import pandas as pd
 from datetime import timedelta
 from matplotlib.colors import ListedColormap
 from PIL import Image, ImageDraw, ImageFont
+import region_cache
 
 # Introduce the overwrite variable
 overwrite = True
@@ -37,9 +38,7 @@ def plot_geojson_files(ax, geojson_files):
 
 def plot_shapefile(ax, shapefile_path, country_gdf):
     """Plot the shapefile with a defined colormap and set map limits based on country_gdf."""
-    shapefile_gdf = gpd.read_file(shapefile_path)
-    shapefile_gdf.set_crs(epsg=3857, inplace=True, allow_override=True)
-    shapefile_gdf = shapefile_gdf.to_crs(epsg=3857)
+    shapefile_gdf = region_cache.read_count_shapefile(shapefile_path)
     # Removed initial base plot: shapefile_gdf.plot(ax=ax, color='#e9e6be', edgecolor='none')
 
     # Define a new colormap for NUMPOINTS >= 5
@@ -1,157 +1,73 @@
 import os
-import matplotlib.pyplot as plt
+import math
+import numpy as np
+from functools import lru_cache
+from concurrent.futures import as_completed
+import matplotlib as mpl
 import geopandas as gpd
-import pandas as pd
-from matplotlib.colors import ListedColormap
-from PIL import Image, ImageDraw, ImageFont
+from matplotlib.collections import LineCollection
+from PIL import Image, ImageDraw
+import region_cache
+import basemap_cache
+import choropleth
+import date_overlay
+import track_layers
+import build_engine
+import pipeline_context
+import instrumentation
 
 # Set overwrite flag
 overwrite = False
 
+# Number of processes rendering years in parallel (1 renders everything in this process). Each
+# process renders a run of consecutive years, with all four variants of a year from one figure.
+render_workers = os.cpu_count() or 1
+
+# The track lines of every year are merged into one layer (cache/year_lines) before rendering and
+# only merged again when days of that year change. Tolerance in metres to simplify the lines by
+# when merging (None keeps them exact; around 50 is invisible at the frame resolution).
+year_lines_simplify = None
+
+# The four images of every year: (key, output directory, file name suffix, year-labeled directory)
+VARIANTS = [
+    ('yearly', 'visualizations_yearly_geopandas', '_visualization', 'visualizations_with_years'),
+    ('yearly_nolines', 'visualizations_yearly_geopandas_nolines', '_visualization_nolines', 'visualizations_with_years_nolines'),
+    ('cumulative', 'visualizations_cumulative_geopandas', '_cumulative_visualization', 'visualizations_cumulative_with_years'),
+    ('cumulative_nolines', 'visualizations_cumulative_geopandas_nolines', '_cumulative_visualization_nolines', 'visualizations_cumulative_with_years_nolines'),
+]
+
+
 def setup_directories(base_dir):
     """Set up required directories."""
     shapefile_dir = os.path.join(base_dir, 'shapefile_yearly')
-    visualizations_dir = os.path.join(base_dir, 'visualizations_yearly_geopandas')
-    visualizations_nolines_dir = os.path.join(base_dir, 'visualizations_yearly_geopandas_nolines')
-    cumulative_visualizations_dir = os.path.join(base_dir, 'visualizations_cumulative_geopandas')
-    cumulative_visualizations_nolines_dir = os.path.join(base_dir, 'visualizations_cumulative_geopandas_nolines')
     all_dir = os.path.join(base_dir, 'all')
-    os.makedirs(visualizations_dir, exist_ok=True)
-    os.makedirs(visualizations_nolines_dir, exist_ok=True)
-    os.makedirs(cumulative_visualizations_dir, exist_ok=True)
-    os.makedirs(cumulative_visualizations_nolines_dir, exist_ok=True)
-    return shapefile_dir, visualizations_dir, visualizations_nolines_dir, cumulative_visualizations_dir, cumulative_visualizations_nolines_dir, all_dir
-
-
-def get_year_geojson_files(year, all_dir):
-    """Retrieve all GeoJSON files for a specific year from the all directory."""
-    geojson_files = []
-    for filename in sorted(os.listdir(all_dir)):
-        if filename.startswith(year) and filename.endswith('_all.geojson'):
-            geojson_path = os.path.join(all_dir, filename)
-            if os.path.exists(geojson_path):
-                geojson_files.append(geojson_path)
-    return geojson_files
-
-
-def get_cumulative_geojson_files(year, all_dir):
-    """Retrieve all GeoJSON files from the beginning up to and including the specified year."""
-    geojson_files = []
-    target_year = int(year)
-    for filename in sorted(os.listdir(all_dir)):
-        if filename.endswith('_all.geojson'):
-            # Extract year from filename (format: YYYY-MM-DD_all.geojson)
-            file_year = int(filename[:4])
-            if file_year <= target_year:
-                geojson_path = os.path.join(all_dir, filename)
-                if os.path.exists(geojson_path):
-                    geojson_files.append(geojson_path)
-    return geojson_files
-
-
-def get_cumulative_shapefile_data(year, shapefile_dir, first_year):
-    """Load and combine NUMPOINTS from all shapefiles up to and including the specified year."""
-    target_year = int(year)
-    start_year = int(first_year)
-    
-    # Load the first shapefile to get the base structure
-    first_shapefile = os.path.join(shapefile_dir, f'{first_year}_VG5000_GEM_with_counts.shp')
-    cumulative_gdf = gpd.read_file(first_shapefile)
-    cumulative_gdf.set_crs(epsg=3857, inplace=True, allow_override=True)
-    cumulative_gdf = cumulative_gdf.to_crs(epsg=3857)
-    
-    # Initialize cumulative NUMPOINTS
-    cumulative_gdf['NUMPOINTS'] = cumulative_gdf['NUMPOINTS'].fillna(0)
-    
-    # Add NUMPOINTS from subsequent years
-    for year_val in range(start_year + 1, target_year + 1):
-        year_str = str(year_val)
-        shapefile_path = os.path.join(shapefile_dir, f'{year_str}_VG5000_GEM_with_counts.shp')
-        if os.path.exists(shapefile_path):
-            year_gdf = gpd.read_file(shapefile_path)
-            year_gdf.set_crs(epsg=3857, inplace=True, allow_override=True)
-            year_gdf = year_gdf.to_crs(epsg=3857)
-            year_gdf['NUMPOINTS'] = year_gdf['NUMPOINTS'].fillna(0)
-            
-            # Add the NUMPOINTS from this year to the cumulative total
-            cumulative_gdf['NUMPOINTS'] = cumulative_gdf['NUMPOINTS'] + year_gdf['NUMPOINTS']
-    
-    return cumulative_gdf
-
-
-def plot_geojson_files(ax, geojson_files, skip_plot=False):
-    """Plot GeoJSON files with varying alpha values."""
-    if skip_plot:
-        return  # Skip plotting if requested
-    
-    if len(geojson_files) >= 2:
-        for idx, geojson_file in enumerate(geojson_files):
-            gdf = gpd.read_file(geojson_file)
-            if gdf.empty:
-                continue  # Skip empty GeoDataFrames
-            gdf.set_crs(epsg=4326, inplace=True)
-            gdf = gdf.to_crs(epsg=3857)
-            alpha_value = 0.1 + (0.9 * idx / (len(geojson_files) - 1))  # Gradually increase alpha
-            alpha_value = min(alpha_value, 1.0)  # Clamp to 1.0 to avoid floating-point precision issues
-            gdf.plot(ax=ax, color='blue', alpha=alpha_value)
-    elif len(geojson_files) == 1:
-        # If only one file, plot with full opacity
-        gdf = gpd.read_file(geojson_files[0])
-        if not gdf.empty:  # Only plot if not empty
-            gdf.set_crs(epsg=4326, inplace=True)
-            gdf = gdf.to_crs(epsg=3857)
-            gdf.plot(ax=ax, color='blue', alpha=1.0)
-
-
-def plot_shapefile(ax, shapefile_path, country_gdf, cumulative_gdf=None):
-    """Plot the shapefile with a defined colormap and set map limits based on country_gdf."""
-    if cumulative_gdf is not None:
-        # Use the provided cumulative data
-        shapefile_gdf = cumulative_gdf
-    else:
-        # Load the shapefile normally
-        shapefile_gdf = gpd.read_file(shapefile_path)
-        shapefile_gdf.set_crs(epsg=3857, inplace=True, allow_override=True)
-        shapefile_gdf = shapefile_gdf.to_crs(epsg=3857)
-
-    # Define a new colormap for NUMPOINTS >= 3
-    colors = ['#caaea8']  # First color in the colormap list
-    steps = 60
-
-    # Define start and end RGB for the ramp
-    r_start, g_start, b_start = 202, 174, 168  # RGB for #caaea8
-    r_end, g_end, b_end = 134, 22, 226          # RGB for #8616e2
-
-    # Generate `steps` colors for the ramp, these will be appended to the initial '#caaea8'
-    for i in range(1, steps + 1):
-        fraction = i / steps
-        r = int(r_start + (r_end - r_start) * fraction)
-        g = int(g_start + (g_end - g_start) * fraction)
-        b = int(b_start + (b_end - b_start) * fraction)
-        
-        # Clamp values to 0-255 range to be safe
-        r = max(0, min(255, r))
-        g = max(0, min(255, g))
-        b = max(0, min(255, b))
-        
-        colors.append(f"#{r:02x}{g:02x}{b:02x}")
-    colors.extend(['#8616e2' for _ in range(7501, 10001)])  # Extend to cover potential higher values
-    defined_cmap = ListedColormap(colors)
-
-    # Filter data to plot only areas with NUMPOINTS >= 3
-    shapefile_gdf_to_plot = shapefile_gdf[shapefile_gdf['NUMPOINTS'] >= 3]
-    if not shapefile_gdf_to_plot.empty:
-        shapefile_gdf_to_plot.plot(ax=ax, column='NUMPOINTS', cmap=defined_cmap, legend=False)
+    for _, output_dir, _, labeled_dir in VARIANTS:
+        os.makedirs(os.path.join(base_dir, output_dir), exist_ok=True)
+        os.makedirs(os.path.join(base_dir, labeled_dir), exist_ok=True)
+    return shapefile_dir, all_dir
+
+
+def get_line_years(year, all_dir):
+    """Return the years up to and including year that have GeoJSON files in the all directory, oldest first."""
+    years = {filename[:4] for filename in os.listdir(all_dir) if filename.endswith('_all.geojson')} if os.path.exists(all_dir) else set()
+    return sorted(line_year for line_year in years if int(line_year) <= int(year))
 
-    # Calculate and set fixed map bounds from the country_gdf (ensure it's in EPSG:3857)
-    bounds = country_gdf.total_bounds
-    zoom_out_factor = 1.2
-    x_center = (bounds[0] + bounds[2]) / 2
-    y_center = (bounds[1] + bounds[3]) / 2
-    x_range = (bounds[2] - bounds[0]) * zoom_out_factor / 2
-    y_range = (bounds[3] - bounds[1]) * zoom_out_factor / 2
-    ax.set_xlim(x_center - x_range, x_center + x_range)
-    ax.set_ylim(y_center - y_range, y_center + y_range)
+
+def line_alphas(count):
+    """Alpha values of `count` line files, oldest first: rising from 0.1 to 1.0, a single file gets full opacity."""
+    if count == 1:
+        return [1.0]
+    # Clamp to 1.0 to avoid floating-point precision issues
+    return [min(0.1 + (0.9 * idx / (count - 1)), 1.0) for idx in range(count)]
+
+
+def plot_shapefile(ax, shapefile_gdf):
+    """Plot the areas with at least 3 points with the count colormap. Returns the collections added."""
+    before = list(ax.collections)
+    shapefile_gdf_to_plot = shapefile_gdf[shapefile_gdf['NUMPOINTS'] >= choropleth.min_points]
+    if not shapefile_gdf_to_plot.empty:
+        shapefile_gdf_to_plot.plot(ax=ax, column='NUMPOINTS', cmap=choropleth.build_colormap(), legend=False)
+    return [artist for artist in ax.collections if not any(artist is old for old in before)]
 
 
 def add_year_to_image(image_path, year_text, output_dir, is_cumulative=False, first_year=None):
@@ -160,11 +76,7 @@ def add_year_to_image(image_path, year_text, output_dir, is_cumulative=False, fi
         draw = ImageDraw.Draw(img)
         # Calculate font size based on desired text height
         text_height = 150
-        # Use a truetype font if available
-        try:
-            font = ImageFont.truetype("static/black.ttf", text_height)
-        except IOError:
-            font = ImageFont.load_default()
+        font = date_overlay.load_font(os.path.join('static', 'black.ttf'), text_height)
 
         # Create year range text for cumulative visualizations
         if is_cumulative and first_year:
@@ -185,299 +97,251 @@ def add_year_to_image(image_path, year_text, output_dir, is_cumulative=False, fi
         img.save(output_path)
 
 
-# Main execution
-base_dir = '.'
-shapefile_dir, visualizations_dir, visualizations_nolines_dir, cumulative_visualizations_dir, cumulative_visualizations_nolines_dir, all_dir = setup_directories(base_dir)
-
-# Directory for images with year text
-dated_images_dir = os.path.join(base_dir, 'visualizations_with_years')
-dated_images_nolines_dir = os.path.join(base_dir, 'visualizations_with_years_nolines')
-dated_cumulative_images_dir = os.path.join(base_dir, 'visualizations_cumulative_with_years')
-dated_cumulative_images_nolines_dir = os.path.join(base_dir, 'visualizations_cumulative_with_years_nolines')
-os.makedirs(dated_images_dir, exist_ok=True)
-os.makedirs(dated_images_nolines_dir, exist_ok=True)
-os.makedirs(dated_cumulative_images_dir, exist_ok=True)
-os.makedirs(dated_cumulative_images_nolines_dir, exist_ok=True)
-
-# Iterate over each shapefile in shapefile_yearly
-shapefile_files = [f for f in os.listdir(shapefile_dir) if f.endswith('_VG5000_GEM_with_counts.shp')]
-
-# Determine the first year for cumulative visualizations
-first_year = None
-if shapefile_files:
-    first_year = sorted(shapefile_files)[0].split('_')[0]
-
-for shapefile_file in sorted(shapefile_files):
-    year = shapefile_file.split('_')[0]
-    shapefile_path = os.path.join(shapefile_dir, shapefile_file)
-
-    output_png_path = os.path.join(visualizations_dir, f'{year}_visualization.png')
-
-    # Check if the output PNG file exists and overwrite is False
-    if os.path.exists(output_png_path) and not overwrite:
-        print(f'Visualization for {year} already exists, skipping.')
-        continue
-
-    fig, ax = plt.subplots(figsize=(38.4, 21.6))
-    fig.patch.set_facecolor('#4a79a5')
-    ax.set_facecolor('#4a79a5')
-
-    # Load and plot additional layers
-    europecoastline_path = os.path.join(base_dir, 'basisdaten', 'europecoastline.shp')
-    secondbackground_path = os.path.join(base_dir, 'basisdaten', 'secondbackground.shp')
-    germany_path = os.path.join(base_dir, 'basisdaten', 'germanyshape.shp')
-    lakes_path = os.path.join(base_dir, 'basisdaten', 'lakes.shp')
-
-    europecoastline_gdf = gpd.read_file(europecoastline_path)
-    secondbackground_gdf = gpd.read_file(secondbackground_path)
-    germany_gdf = gpd.read_file(germany_path)
-    lakes_gdf = gpd.read_file(lakes_path)
-
-    europecoastline_gdf.set_crs(epsg=25832, inplace=True, allow_override=True)
-    europecoastline_gdf = europecoastline_gdf.to_crs(epsg=3857)
-
-    secondbackground_gdf.set_crs(epsg=25832, inplace=True, allow_override=True)
-    secondbackground_gdf = secondbackground_gdf.to_crs(epsg=3857)
-
-    germany_gdf.set_crs(epsg=25832, inplace=True, allow_override=True)
-    germany_gdf = germany_gdf.to_crs(epsg=3857)
-    
-    lakes_gdf.set_crs(epsg=4326, inplace=True, allow_override=True)
-    lakes_gdf = lakes_gdf.to_crs(epsg=3857)
-
-    europecoastline_gdf.plot(ax=ax, color='#e9e6be', edgecolor='none') #light background europe
-    secondbackground_gdf.plot(ax=ax, color='#4a79a5', edgecolor='none') #water
-    germany_gdf.plot(ax=ax, color='#dcd798', edgecolor='none') #darker background for germany shape
-
-    # Plot GeoJSON files and shapefile (passing germany_gdf to set extents)
-    geojson_files = get_year_geojson_files(year, all_dir)
-    print(f'Processing {year}: found {len(geojson_files)} GeoJSON files')
-    plot_geojson_files(ax, geojson_files)
-    plot_shapefile(ax, shapefile_path, germany_gdf)
-
-    lakes_gdf.plot(ax=ax, color='#4a79a5', edgecolor='none') #lakes
-    
-    # Remove axis labels and ticks
-    ax.set_axis_off()
-    ax.set_aspect('equal', adjustable='datalim') # Ensure aspect ratio is equal, adjust data limits to fit figure
-    plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-
-    # Save the figure
-    plt.savefig(output_png_path, bbox_inches='tight', pad_inches=0.1)
-    plt.close(fig)
-
-    print(f'Visualization for {year} saved to {output_png_path}')
-
-    # Add year to each generated image
-    add_year_to_image(output_png_path, year, dated_images_dir)
-    print(f'Year-labeled visualization saved to {dated_images_dir}')
-
-print('\n--- Starting yearly visualizations (no lines) ---\n')
-
-# Create yearly visualizations without blue lines
-for shapefile_file in sorted(shapefile_files):
-    year = shapefile_file.split('_')[0]
-    shapefile_path = os.path.join(shapefile_dir, shapefile_file)
-
-    output_png_path = os.path.join(visualizations_nolines_dir, f'{year}_visualization_nolines.png')
-
-    # Check if the output PNG file exists and overwrite is False
-    if os.path.exists(output_png_path) and not overwrite:
-        print(f'Visualization (no lines) for {year} already exists, skipping.')
-        continue
-
-    fig, ax = plt.subplots(figsize=(38.4, 21.6))
-    fig.patch.set_facecolor('#4a79a5')
-    ax.set_facecolor('#4a79a5')
-
-    # Load and plot additional layers
-    europecoastline_path = os.path.join(base_dir, 'basisdaten', 'europecoastline.shp')
-    secondbackground_path = os.path.join(base_dir, 'basisdaten', 'secondbackground.shp')
-    germany_path = os.path.join(base_dir, 'basisdaten', 'germanyshape.shp')
-    lakes_path = os.path.join(base_dir, 'basisdaten', 'lakes.shp')
-
-    europecoastline_gdf = gpd.read_file(europecoastline_path)
-    secondbackground_gdf = gpd.read_file(secondbackground_path)
-    germany_gdf = gpd.read_file(germany_path)
-    lakes_gdf = gpd.read_file(lakes_path)
-
-    europecoastline_gdf.set_crs(epsg=25832, inplace=True, allow_override=True)
-    europecoastline_gdf = europecoastline_gdf.to_crs(epsg=3857)
-
-    secondbackground_gdf.set_crs(epsg=25832, inplace=True, allow_override=True)
-    secondbackground_gdf = secondbackground_gdf.to_crs(epsg=3857)
-
-    germany_gdf.set_crs(epsg=25832, inplace=True, allow_override=True)
-    germany_gdf = germany_gdf.to_crs(epsg=3857)
-    
-    lakes_gdf.set_crs(epsg=4326, inplace=True, allow_override=True)
-    lakes_gdf = lakes_gdf.to_crs(epsg=3857)
-
-    europecoastline_gdf.plot(ax=ax, color='#e9e6be', edgecolor='none') #light background europe
-    secondbackground_gdf.plot(ax=ax, color='#4a79a5', edgecolor='none') #water
-    germany_gdf.plot(ax=ax, color='#dcd798', edgecolor='none') #darker background for germany shape
-
-    # Skip plotting GeoJSON files (no blue lines)
-    geojson_files = get_year_geojson_files(year, all_dir)
-    print(f'Processing {year} (no lines): found {len(geojson_files)} GeoJSON files (not plotted)')
-    plot_geojson_files(ax, geojson_files, skip_plot=True)
-    plot_shapefile(ax, shapefile_path, germany_gdf)
-
-    lakes_gdf.plot(ax=ax, color='#4a79a5', edgecolor='none') #lakes
-    
-    # Remove axis labels and ticks
-    ax.set_axis_off()
-    ax.set_aspect('equal', adjustable='datalim') # Ensure aspect ratio is equal, adjust data limits to fit figure
-    plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-
-    # Save the figure
-    plt.savefig(output_png_path, bbox_inches='tight', pad_inches=0.1)
-    plt.close(fig)
-
-    print(f'Visualization (no lines) for {year} saved to {output_png_path}')
-
-    # Add year to each generated image
-    add_year_to_image(output_png_path, year, dated_images_nolines_dir)
-    print(f'Year-labeled visualization (no lines) saved to {dated_images_nolines_dir}')
-
-print('\n--- Starting cumulative visualizations ---\n')
-
-# Create cumulative visualizations
-for shapefile_file in sorted(shapefile_files):
-    year = shapefile_file.split('_')[0]
-    shapefile_path = os.path.join(shapefile_dir, shapefile_file)
-
-    output_png_path = os.path.join(cumulative_visualizations_dir, f'{year}_cumulative_visualization.png')
-
-    # Check if the output PNG file exists and overwrite is False
-    if os.path.exists(output_png_path) and not overwrite:
-        print(f'Cumulative visualization for {year} already exists, skipping.')
-        continue
-
-    fig, ax = plt.subplots(figsize=(38.4, 21.6))
-    fig.patch.set_facecolor('#4a79a5')
-    ax.set_facecolor('#4a79a5')
-
-    # Load and plot additional layers
-    europecoastline_path = os.path.join(base_dir, 'basisdaten', 'europecoastline.shp')
-    secondbackground_path = os.path.join(base_dir, 'basisdaten', 'secondbackground.shp')
-    germany_path = os.path.join(base_dir, 'basisdaten', 'germanyshape.shp')
-    lakes_path = os.path.join(base_dir, 'basisdaten', 'lakes.shp')
-
-    europecoastline_gdf = gpd.read_file(europecoastline_path)
-    secondbackground_gdf = gpd.read_file(secondbackground_path)
-    germany_gdf = gpd.read_file(germany_path)
-    lakes_gdf = gpd.read_file(lakes_path)
-
-    europecoastline_gdf.set_crs(epsg=25832, inplace=True, allow_override=True)
-    europecoastline_gdf = europecoastline_gdf.to_crs(epsg=3857)
-
-    secondbackground_gdf.set_crs(epsg=25832, inplace=True, allow_override=True)
-    secondbackground_gdf = secondbackground_gdf.to_crs(epsg=3857)
-
-    germany_gdf.set_crs(epsg=25832, inplace=True, allow_override=True)
-    germany_gdf = germany_gdf.to_crs(epsg=3857)
-    
-    lakes_gdf.set_crs(epsg=4326, inplace=True, allow_override=True)
-    lakes_gdf = lakes_gdf.to_crs(epsg=3857)
-
-    europecoastline_gdf.plot(ax=ax, color='#e9e6be', edgecolor='none') #light background europe
-    secondbackground_gdf.plot(ax=ax, color='#4a79a5', edgecolor='none') #water
-    germany_gdf.plot(ax=ax, color='#dcd798', edgecolor='none') #darker background for germany shape
-
-    # Plot cumulative GeoJSON files and shapefile (passing germany_gdf to set extents)
-    cumulative_geojson_files = get_cumulative_geojson_files(year, all_dir)
-    print(f'Processing cumulative {year}: found {len(cumulative_geojson_files)} GeoJSON files')
-    plot_geojson_files(ax, cumulative_geojson_files)
-    
-    # Get cumulative shapefile data
-    cumulative_shapefile_gdf = get_cumulative_shapefile_data(year, shapefile_dir, first_year)
-    plot_shapefile(ax, shapefile_path, germany_gdf, cumulative_gdf=cumulative_shapefile_gdf)
-
-    lakes_gdf.plot(ax=ax, color='#4a79a5', edgecolor='none') #lakes
-    
-    # Remove axis labels and ticks
-    ax.set_axis_off()
-    ax.set_aspect('equal', adjustable='datalim') # Ensure aspect ratio is equal, adjust data limits to fit figure
-    plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-
-    # Save the figure
-    plt.savefig(output_png_path, bbox_inches='tight', pad_inches=0.1)
-    plt.close(fig)
-
-    print(f'Cumulative visualization for {year} saved to {output_png_path}')
-
-    # Add year range to each generated image
-    add_year_to_image(output_png_path, year, dated_cumulative_images_dir, is_cumulative=True, first_year=first_year)
-    print(f'Year-labeled cumulative visualization saved to {dated_cumulative_images_dir}')
-
-print('\n--- Starting cumulative visualizations (no lines) ---\n')
-
-# Create cumulative visualizations without blue lines
-for shapefile_file in sorted(shapefile_files):
-    year = shapefile_file.split('_')[0]
-    shapefile_path = os.path.join(shapefile_dir, shapefile_file)
-
-    output_png_path = os.path.join(cumulative_visualizations_nolines_dir, f'{year}_cumulative_visualization_nolines.png')
-
-    # Check if the output PNG file exists and overwrite is False
-    if os.path.exists(output_png_path) and not overwrite:
-        print(f'Cumulative visualization (no lines) for {year} already exists, skipping.')
-        continue
-
-    fig, ax = plt.subplots(figsize=(38.4, 21.6))
-    fig.patch.set_facecolor('#4a79a5')
-    ax.set_facecolor('#4a79a5')
-
-    # Load and plot additional layers
-    europecoastline_path = os.path.join(base_dir, 'basisdaten', 'europecoastline.shp')
-    secondbackground_path = os.path.join(base_dir, 'basisdaten', 'secondbackground.shp')
-    germany_path = os.path.join(base_dir, 'basisdaten', 'germanyshape.shp')
-    lakes_path = os.path.join(base_dir, 'basisdaten', 'lakes.shp')
-
-    europecoastline_gdf = gpd.read_file(europecoastline_path)
-    secondbackground_gdf = gpd.read_file(secondbackground_path)
-    germany_gdf = gpd.read_file(germany_path)
-    lakes_gdf = gpd.read_file(lakes_path)
-
-    europecoastline_gdf.set_crs(epsg=25832, inplace=True, allow_override=True)
-    europecoastline_gdf = europecoastline_gdf.to_crs(epsg=3857)
-
-    secondbackground_gdf.set_crs(epsg=25832, inplace=True, allow_override=True)
-    secondbackground_gdf = secondbackground_gdf.to_crs(epsg=3857)
-
-    germany_gdf.set_crs(epsg=25832, inplace=True, allow_override=True)
-    germany_gdf = germany_gdf.to_crs(epsg=3857)
-    
-    lakes_gdf.set_crs(epsg=4326, inplace=True, allow_override=True)
-    lakes_gdf = lakes_gdf.to_crs(epsg=3857)
-
-    europecoastline_gdf.plot(ax=ax, color='#e9e6be', edgecolor='none') #light background europe
-    secondbackground_gdf.plot(ax=ax, color='#4a79a5', edgecolor='none') #water
-    germany_gdf.plot(ax=ax, color='#dcd798', edgecolor='none') #darker background for germany shape
-
-    # Skip plotting cumulative GeoJSON files (no blue lines)
-    cumulative_geojson_files = get_cumulative_geojson_files(year, all_dir)
-    print(f'Processing cumulative {year} (no lines): found {len(cumulative_geojson_files)} GeoJSON files (not plotted)')
-    plot_geojson_files(ax, cumulative_geojson_files, skip_plot=True)
-    
-    # Get cumulative shapefile data
-    cumulative_shapefile_gdf = get_cumulative_shapefile_data(year, shapefile_dir, first_year)
-    plot_shapefile(ax, shapefile_path, germany_gdf, cumulative_gdf=cumulative_shapefile_gdf)
-
-    lakes_gdf.plot(ax=ax, color='#4a79a5', edgecolor='none') #lakes
-    
-    # Remove axis labels and ticks
-    ax.set_axis_off()
-    ax.set_aspect('equal', adjustable='datalim') # Ensure aspect ratio is equal, adjust data limits to fit figure
-    plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-
-    # Save the figure
-    plt.savefig(output_png_path, bbox_inches='tight', pad_inches=0.1)
-    plt.close(fig)
-
-    print(f'Cumulative visualization (no lines) for {year} saved to {output_png_path}')
-
-    # Add year range to each generated image
-    add_year_to_image(output_png_path, year, dated_cumulative_images_nolines_dir, is_cumulative=True, first_year=first_year)
-    print(f'Year-labeled cumulative visualization (no lines) saved to {dated_cumulative_images_nolines_dir}')
+# The figure reused for all years of this process
+_year_frame = None
+
+
+def get_year_frame(base_dir):
+    """Return this process's figure with the basemap, created on first use."""
+    global _year_frame
+    if _year_frame is None:
+        fig, ax, bbox_inches = basemap_cache.frame_figure(base_dir, cached=False)
+        # Region collections by layer name, and the line collections of every GeoJSON file drawn so far
+        _year_frame = {'fig': fig, 'ax': ax, 'bbox_inches': bbox_inches, 'regions': {}, 'lines': {}}
+    return _year_frame
+
+
+def add_lines(frame, years, base_dir='.'):
+    """
+    Add the merged track lines of the given years (oldest first) to the figure as one hidden
+    collection per year, unless they already are. They are kept for the later years of this process.
+    """
+    ax = frame['ax']
+    for year in years:
+        if year in frame['lines']:
+            continue
+        path = track_layers.year_lines_path(base_dir, year)
+        if not os.path.exists(path):
+            frame['lines'][year] = (None, None, 0)
+            continue
+        segments, files, file_count = track_layers.load_merged_lines(path)
+        collection = LineCollection(segments, colors='blue', visible=False)
+        ax.add_collection(collection)
+        frame['lines'][year] = (collection, files, file_count)
+
+
+def show_lines(frame, years):
+    """
+    Show the track lines of the given years (oldest first) and hide all others. The lines of
+    every day get an alpha rising from the oldest to the newest day of these years.
+    """
+    alphas = np.asarray(line_alphas(sum(frame['lines'][year][2] for year in years)) if years else [])
+    first_day = 0
+    for year in years:
+        collection, files, file_count = frame['lines'][year]
+        if collection is not None:
+            colors = np.tile(mpl.colors.to_rgba('blue'), (len(files), 1))
+            colors[:, 3] = alphas[first_day + files]
+            collection.set_color(colors)
+        first_day += file_count
+    for year, (collection, _, _) in frame['lines'].items():
+        if collection is not None:
+            collection.set_visible(year in years)
+
+
+def count_shapefile_path(shapefile_dir, year):
+    return os.path.join(shapefile_dir, f'{year}_VG5000_GEM_with_counts.shp')
+
+
+@lru_cache(maxsize=None)
+def read_counts(shapefile_dir, year):
+    """Return the attribute table of a year's count shapefile and its region layer name. Read once per process."""
+    attributes = gpd.read_file(count_shapefile_path(shapefile_dir, year), ignore_geometry=True)
+    return attributes, region_cache.match_region_layer(attributes)
+
+
+# Counts of all years up to _cumulative['year'], added up year by year in this process
+_cumulative = {'year': None, 'counts': None}
+
+
+def cumulative_counts(shapefile_dir, year, first_year):
+    """
+    Return the region_cache.CumulativeCounts of all years from first_year up to year. Only the
+    years since the last call are added, so consecutive years cost one count table each.
+    """
+    if _cumulative['year'] is None or int(year) < int(_cumulative['year']):
+        _cumulative['counts'] = region_cache.CumulativeCounts()
+        start_year = int(first_year)
+    else:
+        start_year = int(_cumulative['year']) + 1
+    for year_val in range(start_year, int(year) + 1):
+        shapefile_path = count_shapefile_path(shapefile_dir, year_val)
+        if not os.path.exists(shapefile_path):
+            continue
+        attributes, layer_name = read_counts(shapefile_dir, str(year_val))
+        # Regions that are not part of a cached layer (e.g. grid cells) need their geometry to be drawn
+        geometries = region_cache.read_count_shapefile(shapefile_path).geometry.values if layer_name is None else None
+        _cumulative['counts'].add(region_cache.count_ids(attributes, layer_name), attributes['NUMPOINTS'].to_numpy(), geometries)
+    _cumulative['year'] = year
+    return _cumulative['counts']
+
+
+def year_outputs(year):
+    """Paths (relative to base_dir) of all images of a year."""
+    return [os.path.join(directory, f'{year}{suffix}.png') for _, output_dir, suffix, labeled_dir in VARIANTS for directory in (output_dir, labeled_dir)]
+
+
+def year_inputs(year, years, all_dir):
+    """Paths (relative to base_dir) of the count shapefiles and line files the images of a year are drawn from, this and all earlier years."""
+    inputs = [os.path.join('shapefile_yearly', f'{earlier}_VG5000_GEM_with_counts.shp') for earlier in years if int(earlier) <= int(year)]
+    for line_year in get_line_years(year, all_dir):
+        inputs.append(os.path.join('all', f'{line_year}*_all.geojson'))
+    return inputs
+
+
+def render_year(year, shapefile_dir, all_dir, first_year, base_dir='.', overwrite=False):
+    """Render the variants of one year that do not exist yet (or all with overwrite) from one figure."""
+    todo = []
+    for key, output_dir, suffix, labeled_dir in VARIANTS:
+        output_png_path = os.path.join(base_dir, output_dir, f'{year}{suffix}.png')
+        if os.path.exists(output_png_path) and not overwrite:
+            print(f'Visualization ({key}) for {year} already exists, skipping.')
+            continue
+        todo.append((key, output_png_path, os.path.join(base_dir, labeled_dir)))
+    if not todo:
+        return []
+
+    frame = get_year_frame(base_dir)
+    fig, ax = frame['fig'], frame['ax']
+    shapefile_path = count_shapefile_path(shapefile_dir, year)
+    attributes, layer_name = read_counts(shapefile_dir, year)
+    totals = None
+    if any(key.startswith('cumulative') for key, _, _ in todo):
+        totals = cumulative_counts(shapefile_dir, year, first_year)
+
+    line_years = get_line_years(year, all_dir)
+    print(f'Processing {year}: track lines of {len(line_years)} years up to {year}')
+    year_lines = [year] if year in line_years else []
+    if any(not key.endswith('nolines') for key, _, _ in todo):
+        # All years up to this one, so the lines are always added to the figure oldest first
+        add_lines(frame, line_years, base_dir)
+
+    for name, regions in frame['regions'].items():
+        if name != layer_name:
+            regions.hide()
+    if layer_name is not None:
+        region_gdf, _ = region_cache.load_region_layer(layer_name, base_dir)
+        if layer_name not in frame['regions']:
+            frame['regions'][layer_name] = choropleth.RegionCollection(ax, region_gdf.geometry.values)
+
+    written = []
+    for key, output_png_path, labeled_dir in todo:
+        is_cumulative = key.startswith('cumulative')
+        if key.endswith('nolines'):
+            show_lines(frame, [])
+        else:
+            show_lines(frame, line_years if is_cumulative else year_lines)
+
+        per_frame = []
+        if layer_name is not None:
+            if is_cumulative:
+                counts = totals.counts_for(region_cache.count_ids(region_gdf, layer_name))
+            else:
+                counts = attributes['NUMPOINTS'].fillna(0).to_numpy()
+            frame['regions'][layer_name].update(counts)
+        else:
+            # Grid cells or other polygons that are not a cached region layer are plotted for this image only
+            if is_cumulative:
+                shapefile_gdf = totals.to_geodataframe()
+            else:
+                shapefile_gdf = region_cache.read_count_shapefile(shapefile_path)
+            per_frame = plot_shapefile(ax, shapefile_gdf)
+
+        basemap_cache.set_frame_limits(ax, base_dir)
+        ax.set_aspect('equal', adjustable='datalim')
+        fig.savefig(output_png_path, bbox_inches=frame['bbox_inches'])
+        for artist in per_frame:
+            artist.remove()
+        print(f'Visualization ({key}) for {year} saved to {output_png_path}')
+
+        # Add year (or year range) to each generated image
+        add_year_to_image(output_png_path, year, labeled_dir, is_cumulative=is_cumulative, first_year=first_year)
+        print(f'Year-labeled visualization ({key}) saved to {labeled_dir}')
+        written.append(output_png_path)
+    return written
+
+
+def render_years(years, shapefile_dir, all_dir, first_year, base_dir='.', overwrite=False):
+    """Render a run of consecutive years in order. Returns the years rendered and their unit records."""
+    for year in years:
+        inputs = [count_shapefile_path(shapefile_dir, year), track_layers.year_lines_path(base_dir, year)]
+        with instrumentation.measure_unit('visualize_points_geopandas_yearly_new', year, inputs, year_outputs(year), base_dir=base_dir) as record:
+            record['items'] = len(render_year(year, shapefile_dir, all_dir, first_year, base_dir, overwrite))
+    return years, instrumentation.collect_units()
+
+
+def init_render_worker():
+    """Prepare a render process: headless backend."""
+    mpl.use('Agg')
+
+
+def main(context=None):
+    settings = pipeline_context.stage_settings(context, 'visualize_points_geopandas_yearly_new', overwrite=overwrite,
+                                               render_workers=render_workers, year_lines_simplify=year_lines_simplify)
+    base_dir = '.'
+    shapefile_dir, all_dir = setup_directories(base_dir)
+
+    # Iterate over each shapefile in shapefile_yearly
+    shapefile_files = [f for f in os.listdir(shapefile_dir) if f.endswith('_VG5000_GEM_with_counts.shp')]
+    years = sorted(f.split('_')[0] for f in shapefile_files)
+    if not years:
+        return
+
+    # Determine the first year for cumulative visualizations
+    first_year = years[0]
+
+    # Merge the track lines of every year whose days changed, before any process draws them
+    track_layers.update_year_lines(all_dir, base_dir, settings['year_lines_simplify'], settings['overwrite'])
+
+    # Render the years whose counts or lines (of that year or, for the cumulative images, any
+    # earlier year) changed since their images were rendered, see build_engine.py
+    build = build_engine.StageBuild('visualize_points_geopandas_yearly_new', base_dir, settings['overwrite'])
+    unit_settings = {'first_year': first_year, 'year_lines_simplify': settings['year_lines_simplify']}
+    units = {year: build.unit(year, settings=unit_settings, extra_inputs=year_inputs(year, years, all_dir), extra_outputs=year_outputs(year), year=year) for year in years}
+    stale_years = []
+    for year in years:
+        reason = build.stale_reason(units[year])
+        if reason is None:
+            print(f'Visualizations for {year} are up to date, skipping.')
+        else:
+            print(f'Rendering {year}: {reason}')
+            stale_years.append(year)
+    if not stale_years:
+        build.save()
+        return
+
+    workers = min(pipeline_context.stage_workers(context, settings['render_workers']), len(stale_years))
+    if workers == 1:
+        mpl.use('Agg')
+        _, unit_records = render_years(stale_years, shapefile_dir, all_dir, first_year, base_dir, overwrite=True)
+        instrumentation.add_units(unit_records)
+        for year in stale_years:
+            build.record(units[year])
+        build.save()
+        return
+
+    # Consecutive years per process, so every process adds the lines of the days in order
+    chunk_size = math.ceil(len(stale_years) / workers)
+    chunks = [stale_years[i:i + chunk_size] for i in range(0, len(stale_years), chunk_size)]
+    with pipeline_context.process_pool(context, workers, init_render_worker) as executor:
+        futures = [executor.submit(render_years, chunk, shapefile_dir, all_dir, first_year, base_dir, True) for chunk in chunks]
+        for future in as_completed(futures):
+            rendered, unit_records = future.result()
+            instrumentation.add_units(unit_records)
+            for year in rendered:
+                build.record(units[year])
+    build.save()
+
+
+if __name__ == '__main__':
+    main()
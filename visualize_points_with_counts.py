@@ -2,6 +2,12 @@ import geopandas as gpd
 import os
 import json
 from shapely.geometry import shape
+import region_cache
+import region_hierarchy
+import grid_regions
+import build_engine
+import pipeline_context
+import instrumentation
 
 # Define file paths
 base_dir = '.'
@@ -10,50 +16,84 @@ base_dir = '.'
 overwrite = False
 
 onlygermany = False #if true, only german "Gemeinden" are used, otherwise a european Local Area Units NUTS file is used from http://ec.europa.eu/eurostat/web/gisco/geodata/statistical-units/local-administrative-units
-if onlygermany:
-    shapefile_path = os.path.join(base_dir, 'basisdaten', 'VG5000_GEM.shp')
-    # Load the shapefile
-    shapefile_gdf = gpd.read_file(shapefile_path)
-    shapefile_gdf.set_crs(epsg=25832, inplace=True)  # Set initial CRS to EPSG:25832
-    shapefile_gdf = shapefile_gdf.to_crs(epsg=3857)  # Transform to match the map's CRS
-else:
-    shapefile_path = os.path.join(base_dir, 'basisdaten', 'LAU_RG_01M_2023_3035.shp')
-    # Load the shapefile
-    shapefile_gdf = gpd.read_file(shapefile_path)
-    shapefile_gdf.set_crs(epsg=3035, inplace=True)  # Set initial CRS to EPSG:3035
-    shapefile_gdf = shapefile_gdf.to_crs(epsg=3857)  # Transform to match the map's CRS
-
-output_shapefile_dir = os.path.join(base_dir, 'shapefile_yearly')
-os.makedirs(output_shapefile_dir, exist_ok=True)
-
-# Iterate over each GeoJSON file in points_yearly
-points_yearly_dir = os.path.join(base_dir, 'points_yearly')
-for geojson_file in os.listdir(points_yearly_dir):
-    if geojson_file.endswith('.geojson'):
-        geojson_path = os.path.join(points_yearly_dir, geojson_file)
-        year = geojson_file.split('_')[0]
-        output_shapefile_path = os.path.join(output_shapefile_dir, f'{year}_VG5000_GEM_with_counts.shp')
-
-        # Check if the output file exists and overwrite is False
-        if os.path.exists(output_shapefile_path) and not overwrite:
-            continue
-
-        # Load the GeoJSON file
-        with open(geojson_path, 'r') as f:
-            geojson_data = json.load(f)
-
-        # Create a GeoDataFrame for the GeoJSON points
-        points_gdf = gpd.GeoDataFrame.from_features(geojson_data['features'])
-        points_gdf.set_crs(epsg=4326, inplace=True)
-        points_gdf = points_gdf.to_crs(epsg=3857)
-
-        # Initialize the 'NUMPOINTS' column
-        shapefile_gdf['NUMPOINTS'] = 0
-
-        # Count points within each polygon
-        for idx, poly in shapefile_gdf.iterrows():
-            count = points_gdf.within(poly.geometry).sum()
-            shapefile_gdf.at[idx, 'NUMPOINTS'] = count
-
-        # Save the updated shapefile with the 'NUMPOINTS' attribute
-        shapefile_gdf.to_file(output_shapefile_path, driver='ESRI Shapefile')
+# Coarser levels that are additionally written, derived from the municipality counts (e.g. ['kreis', 'land'])
+rollup_levels = []
+
+# How points are aggregated: 'regions' counts them per region (see onlygermany), 'square' or 'hex'
+# bins them into a regular grid in EPSG:3857 with cells of grid_cell_size meters (no region layer needed)
+aggregation = 'regions'
+grid_cell_size = 5000
+
+
+def rollup_outputs(year, settings):
+    """Paths (relative to base_dir) of the coarser count layers written for a year."""
+    if settings['aggregation'] != 'regions':
+        return []
+    return [os.path.join('shapefile_yearly', f'{year}_{level}_with_counts.shp') for level in settings['rollup_levels']]
+
+
+def main(context=None):
+    settings = pipeline_context.stage_settings(context, 'visualize_points_with_counts', overwrite=overwrite, onlygermany=onlygermany,
+                                               rollup_levels=rollup_levels, aggregation=aggregation, grid_cell_size=grid_cell_size)
+    onlygermany_setting = settings['onlygermany']
+
+    # Load the region layer (reprojected to EPSG:3857, cached in /cache and shared by the stages of one run)
+    if settings['aggregation'] == 'regions':
+        shapefile_gdf = region_cache.load_regions(onlygermany_setting, base_dir).copy(deep=False)
+
+    output_shapefile_dir = os.path.join(base_dir, 'shapefile_yearly')
+    os.makedirs(output_shapefile_dir, exist_ok=True)
+
+    # Everything the counts depend on besides the points
+    count_settings = {name: settings[name] for name in ('onlygermany', 'rollup_levels', 'aggregation', 'grid_cell_size')}
+
+    # Fingerprints of the points every count layer was built from (see build_engine.py)
+    build = build_engine.StageBuild('visualize_points_with_counts', base_dir, settings['overwrite'])
+
+    # Iterate over each GeoJSON file in points_yearly
+    points_yearly_dir = os.path.join(base_dir, 'points_yearly')
+    for geojson_file in os.listdir(points_yearly_dir):
+        if geojson_file.endswith('.geojson'):
+            geojson_path = os.path.join(points_yearly_dir, geojson_file)
+            year = geojson_file.split('_')[0]
+            output_shapefile_path = os.path.join(output_shapefile_dir, f'{year}_VG5000_GEM_with_counts.shp')
+
+            # Skip if the output file exists and was counted from the current points with the same settings
+            unit = build.unit(year, settings=count_settings, extra_outputs=rollup_outputs(year, settings), year=year)
+            if build.stale_reason(unit) is None:
+                continue
+
+            with instrumentation.measure_unit('visualize_points_with_counts', year, unit['inputs'], unit['outputs']):
+                # Load the GeoJSON file
+                with open(geojson_path, 'r') as f:
+                    geojson_data = json.load(f)
+
+                # Create a GeoDataFrame for the GeoJSON points
+                points_gdf = gpd.GeoDataFrame.from_features(geojson_data['features'])
+                points_gdf.set_crs(epsg=4326, inplace=True)
+                points_gdf = points_gdf.to_crs(epsg=3857)
+
+                if settings['aggregation'] == 'regions':
+                    # Count points within each polygon using the cached spatial index
+                    shapefile_gdf['NUMPOINTS'] = region_cache.count_points_in_regions(points_gdf, onlygermany_setting, base_dir)
+
+                    # Save the updated shapefile with the 'NUMPOINTS' attribute
+                    shapefile_gdf.to_file(output_shapefile_path, driver='ESRI Shapefile')
+
+                    # Group the municipality counts up to districts/states, no further point-in-polygon pass needed
+                    for level in settings['rollup_levels']:
+                        level_shapefile_path = os.path.join(output_shapefile_dir, f'{year}_{level}_with_counts.shp')
+                        level_gdf = region_hierarchy.rollup_count_layer(shapefile_gdf['NUMPOINTS'].values, level, onlygermany_setting, base_dir)
+                        level_gdf.to_file(level_shapefile_path, driver='ESRI Shapefile')
+                else:
+                    # Bin the points into grid cells, which take the place of the regions in the shapefile
+                    grid_gdf = grid_regions.count_points_in_grid(points_gdf, settings['grid_cell_size'], settings['aggregation'])
+                    grid_gdf.to_file(output_shapefile_path, driver='ESRI Shapefile')
+
+            build.record(unit)
+
+    build.save()
+
+
+if __name__ == '__main__':
+    main()